@@ -0,0 +1,133 @@
+from chord import Message, RingConfig, MAINTAIN
+from sim import RingBuilder
+from client import Client
+import traceback
+import asyncio
+import random
+import time
+import sys
+
+# Runs ChordNodes as coroutines on one asyncio event loop instead of as threads.
+# Each node's queue in the queues dictionary is a Mailbox, an asyncio.Queue whose put() doesn't need awaiting,
+# so node code sends messages exactly as before.  One task per node waits on its mailbox and hands each message
+# to ChordNode.step(), the same event-driven path the simulator and threaded nodes use, so nothing ever polls
+# with a TIMEOUT.  Maintenance rounds run from timers, which put a MAINTAIN in
+# each node's mailbox every stabilize_interval seconds.  A task costs a few KB where a thread costs a stack and a context switch, so tens
+# of thousands of nodes fit in one process.
+
+
+# A node's queue.  put() doesn't block, so synchronous node code can send to it.
+class Mailbox(asyncio.Queue):
+
+    def __init__(self, runtime):
+        asyncio.Queue.__init__(self)
+        self.runtime = runtime
+
+    def put(self, msg):
+        self.runtime.pending += 1
+        self.put_nowait(msg)
+
+
+class AsyncRuntime(RingBuilder):
+
+    def __init__(self, seed=None, config=None, stabilize_interval=None):
+        self.config = config or RingConfig()    # Passed to every node, so the whole ring agrees on ID width and the like
+        self.rng = random.Random(seed)          # Every node draws from this
+        self.stabilize_interval = stabilize_interval if stabilize_interval is not None else self.config.stabilize_interval    # Seconds between each node's maintenance rounds, or None
+        self.queues = {}                        # Shared with the nodes, exactly like the threaded version
+        self.nodes = {}                         # Every node that has attached to the runtime, by ID
+        self.tasks = []
+        self.pending = 0                        # Messages put in a mailbox and not handled yet
+        self.idle = None                        # Set whenever pending drops to zero
+        self.delivered = 0
+        self.crashed = []                       # IDs of nodes whose handler raised an exception
+
+    @property
+    def now(self):                              # Clients time their requests with this
+        return asyncio.get_running_loop().time()
+
+    def attach(self, node):                     # Called by ChordNode.new_queue() once the node has picked its ID
+        self.nodes[node.id] = node
+        mailbox = Mailbox(self)
+        self.tasks.append(asyncio.get_running_loop().create_task(self.serve(node.id, mailbox, node.step, node)))
+        self.start_rounds(node)
+        return mailbox
+
+    def start_rounds(self, node):               # Start <node>'s maintenance timer, if there is one
+        if self.stabilize_interval is not None:
+            asyncio.get_running_loop().call_later(self.stabilize_interval * self.rng.random(), self.stabilize, node)     # Spread them out
+
+    def listen(self, name, handler):            # Gives a client a mailbox called <name>.  <handler> is called with every message put in it.
+        mailbox = Mailbox(self)
+        self.queues[name] = mailbox
+        self.tasks.append(asyncio.get_running_loop().create_task(self.serve(name, mailbox, handler)))
+        return mailbox
+
+    async def serve(self, id, mailbox, handler, node=None):    # Body of each node's task
+        while node is None or node.active:
+            msg = await mailbox.get()
+            self.delivered += 1
+            try:
+                handler(msg)
+            except Exception:                   # A threaded node would lose its thread here.  Lose the node, not the runtime.
+                traceback.print_exc()
+                self.crashed.append(id)
+                node = None
+                break
+            finally:
+                self.done(1)
+        self.done(mailbox.qsize())              # Nobody will read what's left
+
+    def done(self, count):
+        self.pending -= count
+        if self.pending == 0 and self.idle is not None:
+            self.idle.set()
+
+    def stabilize(self, node):                  # Timer callback.  Send the node a MAINTAIN, so it stabilizes and re-resolves a few fingers in between messages, then go again later.
+        if not node.active or self.queues.get(node.id) is None:
+            return
+        self.queues[node.id].put(Message(MAINTAIN, node.id))
+        asyncio.get_running_loop().call_later(self.stabilize_interval, self.stabilize, node)
+
+    async def settle(self):                     # Wait until every message sent so far, and everything they led to, has been handled
+        if self.idle is None:
+            self.idle = asyncio.Event()
+        while self.pending > 0:
+            self.idle.clear()
+            await self.idle.wait()
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+
+# Main
+# Usage: python aio.py [nodes] [requests] [hash bits]
+# Builds a ring of coroutine nodes, stores and reads back some keys, and prints how long it took, then counts the
+# keys held across the whole ring with a broadcast.
+async def main(n, count, bits):
+    runtime = AsyncRuntime(seed=1, config=RingConfig(hash_bits=bits))
+    start = time.time()
+    runtime.build_ring(n)
+    built = time.time() - start
+    client = Client(runtime.queues, engine=runtime, window=256)
+    for i in range(0, count):
+        client.set('key' + str(i), i)
+    await runtime.settle()
+    gets = [client.get('key' + str(i)) for i in range(0, count)]
+    await runtime.settle()
+    correct = sum(1 for i in range(0, count) if gets[i].result() == i)
+    elapsed = time.time() - start
+    delivered = runtime.delivered
+    keys = client.broadcast('keys')     # Every node counts its keys, and the counts are added up on the way back
+    await runtime.settle()
+    print('---------------------------------------------------')
+    print('Nodes: ' + str(n) + '  Built in: ' + str(round(built, 2)) + 's  Requests: ' + str(2 * count) + '  Correct: ' + str(correct) +
+          '  Delivered: ' + str(delivered) + '  Wall time: ' + str(round(elapsed, 2)) + 's  Keys in the ring: ' + str(keys.result()))
+    runtime.stop()
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    bits = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+    asyncio.run(main(n, count, bits))
@@ -0,0 +1,488 @@
+from chord import ChordNode, Message, RingConfig, LEAVE_NETWORK, GET_REQUEST, SET_REQUEST
+from sim import Simulator
+from client import Client, CACHE_SIZE
+from vnodes import Host
+import metrics
+import vnodes
+import oracle
+import eventlog
+import chord
+import subprocess
+import itertools
+import argparse
+import datetime
+import bisect
+import random
+import json
+import time
+import sys
+
+# Workload-driven benchmarks.
+# A Workload describes a run: how big the ring is, how many keys it holds and how big their values are, the mix
+# of reads and writes, how keys are picked (uniformly, or Zipf-distributed so a few keys are hot), and how much
+# churn there is, either as rounds of one-off joins and leaves or as a steady rate of them.  run() builds the ring on a
+# Simulator (or on threads), loads the keys, applies the one-off churn, then times the requests while applying
+# the steady churn, and returns throughput, latency percentiles, mean hops and message counts.  Every write of a
+# key stores a value of its own.  A GET that returns nothing, or a value that was never written, counts as an error.
+# One that returns an older value than a write that had been acknowledged before the GET was sent is a stale read.
+# An oracle audit of the ring at the end counts misplaced, unreplicated and duplicated keys.
+# node_failures counts nodes whose handler raised, so a protocol bug shows up as itself rather than as errors.
+# SCENARIOS holds named workloads, including the five tests that used to be picked with TEST in chord.py.
+# Run "python bench.py --help" for the options.  --out appends each result as a line of JSON, along with the
+# commit it ran on, so runs can be compared across commits.
+
+# Named workloads.  Options given on the command line override these.
+SCENARIOS = {
+    'default':          {},
+    'smoke':            {'nodes': 5, 'keys': 16, 'requests': 16, 'read_ratio': 1.0},                    # Was TEST 0: a small ring stores and reads back a few keys
+    'join-handoff':     {'nodes': 1, 'keys': 16, 'requests': 16, 'read_ratio': 1.0, 'joins': 5},       # Was TEST 1: nodes join a ring that already holds data
+    'mass-join':        {'nodes': 16, 'keys': 4000, 'requests': 4000, 'read_ratio': 1.0, 'joins': 256, 'together': True},  # Hundreds of nodes join a loaded ring at once
+    'leave':            {'nodes': 6, 'keys': 16, 'requests': 16, 'read_ratio': 1.0, 'leaves': 3},      # Was TEST 2: nodes leave one at a time
+    'leave-fingers':    {'nodes': 10, 'keys': 16, 'requests': 16, 'read_ratio': 1.0, 'leaves': 4},     # Was TEST 3: nodes leave and the rest fix their fingers as they go
+    'concurrent-leave': {'nodes': 10, 'keys': 16, 'requests': 16, 'read_ratio': 1.0, 'leaves': 9, 'together': True},   # Was TEST 4: nine of ten nodes leave at once
+    'leave-churn':      {'nodes': 16, 'keys': 2000, 'requests': 2000, 'read_ratio': 1.0, 'joins': 4, 'leaves': 3, 'together': True, 'rounds': 5},    # Four nodes join, then three leave at once, five times over
+    'zipf':             {'distribution': 'zipf'},
+    'churn':            {'churn': 0.01},
+    'large-values':     {'value_size': 16384, 'keys': 2000, 'requests': 5000},
+    'crash':            {'nodes': 32, 'keys': 2000, 'requests': 2000, 'read_ratio': 1.0, 'crashes': 4, 'replicas': 2},    # Nodes vanish without leaving.  Their replicas take over.
+    'replica-churn':    {'nodes': 16, 'keys': 2000, 'requests': 20000, 'read_ratio': 0.5, 'joins': 4, 'leaves': 3, 'together': True, 'rounds': 5,
+                         'replicas': 2, 'churn': 0.05},                                                                 # Replicas kept up through rounds of concurrent leaves, then steady churn under writes.
+                                                                                                                        # Clients don't retry, so requests on their way to a node as it goes are lost.
+    'hot-replicas':     {'distribution': 'zipf', 'zipf_s': 1.5, 'replicas': 2},                                          # Hot keys' GETs spread over their replicas
+    'vnodes':           {'vnodes': 8, 'imbalance': 1.5},                                                                # Eight virtual nodes per host, rebalanced to within 1.5x of the mean
+}
+
+
+class Workload():
+
+    def __init__(self, nodes=64, keys=10000, value_size=100, read_ratio=0.9, distribution='uniform', zipf_s=1.0, requests=20000,
+                 churn=0.0, joins=0, leaves=0, together=False, rounds=1, crashes=0, engine='sim', hash_bits=32, recursive=False, window=64, client_cache=True,
+                 jitter=0, replicas=0, vnodes=1, imbalance=None, stabilize=None, finger_budget=chord.FINGER_BUDGET, seed=1, timeout=600.0):
+        self.nodes = nodes                  # Ring size to start with
+        self.keys = keys                    # Keys loaded before timing starts.  Requests pick from these.
+        self.value_size = value_size        # Bytes in each value
+        self.read_ratio = read_ratio        # Fraction of requests that are GETs.  The rest are SETs.
+        self.distribution = distribution    # 'uniform' or 'zipf'
+        self.zipf_s = zipf_s                # Zipf exponent.  Higher is more skewed.
+        self.requests = requests            # Requests timed
+        self.churn = churn                  # Joins plus leaves per unit of time while requests run (per second threaded, per unit of virtual time simulated)
+        self.joins = joins                  # Nodes joined after loading, before timing
+        self.leaves = leaves                # Nodes that leave after loading, before timing
+        self.together = together            # The joins all happen at once instead of one at a time, and so do the leaves
+        self.rounds = rounds                # Times the one-off joins and leaves are repeated
+        self.crashes = crashes              # Nodes that vanish without leaving after loading, before timing
+        self.engine = engine                # 'sim' or 'threads'
+        self.hash_bits = hash_bits
+        self.recursive = recursive          # Recursive lookups instead of iterative ones
+        self.window = window                # Requests the client keeps in flight
+        self.client_cache = client_cache    # The client sends requests straight to owners it knows.  Turn off to measure routing.
+        self.jitter = jitter                # Extra random message delay, simulated only
+        self.replicas = replicas            # Successors that keep a copy of each node's keys
+        self.vnodes = vnodes                # Virtual nodes per physical node.  Above 1, nodes is the number of Hosts.
+        self.imbalance = imbalance          # If set, split partitions before timing until no physical node holds more than this times the mean number of keys
+        self.stabilize = stabilize          # Time between each node's maintenance rounds, or None for none
+        self.finger_budget = finger_budget  # Fingers each node re-resolves per maintenance round
+        self.seed = seed
+        self.timeout = timeout              # Wall-clock seconds before giving up on requests that never complete
+
+
+# Keys requests are made for
+class KeyChooser():
+
+    def __init__(self, rng, count, distribution, s):
+        self.rng = rng
+        self.count = count
+        self.cumulative = None
+        if distribution == 'zipf':          # Key i is picked with weight 1 / (i + 1)^s
+            self.cumulative = list(itertools.accumulate(1.0 / (i + 1)**s for i in range(0, count)))
+        elif distribution != 'uniform':
+            raise ValueError('Unknown key distribution ' + distribution)
+
+    def next(self):
+        if self.cumulative is None:
+            return self.rng.randrange(self.count)
+        return min(bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1]), self.count - 1)
+
+
+def key_name(i):
+    return 'key' + str(i)
+
+
+def value_of(i, size, version=0):           # The value key i's <version>th write stores.  Loading it is write 0.
+    tag = (str(i) + '.' + str(version) + ';').encode()
+    return (tag * (size // len(tag) + 1))[:size]
+
+
+def version_of(i, value, size, latest):     # Which of key i's writes stored <value>, or None if none did.  Newest first, since reads mostly see the newest.
+    for version in range(latest, -1, -1):
+        if value_of(i, size, version) == value:
+            return version
+    return None
+
+
+# Runs a workload on the discrete-event simulator
+class SimDriver():
+
+    def __init__(self, w, config):
+        self.sim = Simulator(seed=w.seed, jitter=w.jitter, config=config)
+        self.rng = self.sim.rng
+        self.vnodes = w.vnodes
+        self.hosts = []                     # The physical nodes, if they have virtual nodes
+
+    def build(self, n):
+        if self.vnodes > 1:
+            self.hosts = self.sim.build_hosts(n, self.vnodes)
+        else:
+            self.sim.build_ring(n)
+
+    def client(self, window, cache_size, on_complete):
+        return Client(self.sim.queues, engine=self.sim, window=window, on_complete=on_complete, cache_size=cache_size)
+
+    def nodes(self):
+        return list(self.sim.nodes.values())
+
+    def now(self):
+        return self.sim.now
+
+    def join(self):
+        if self.vnodes > 1:                 # A new host joins all its virtual nodes at once
+            host = Host(self.sim.queues, engine=self.sim)
+            for i in range(0, self.vnodes):
+                host.add()
+            self.hosts.append(host)
+        else:
+            self.sim.add_node()
+
+    def leave(self, member):                # <member> is a ChordNode, or a Host
+        if isinstance(member, Host):
+            member.leave()
+        else:
+            self.sim.queues[member.id].put(Message(LEAVE_NETWORK, 'root'))
+
+    def crash(self, member):                # It vanishes without a word.  Whatever was on its way to it is lost.
+        if isinstance(member, Host):
+            member.crash()
+        else:
+            member.active = False
+            del self.sim.queues[member.id]
+
+    def failures(self):                     # Nodes whose handler raised an exception.  The simulator carries on without them.
+        return len(self.sim.crashed)
+
+    def settle(self, client, deadline):     # Run until nothing is left to deliver
+        while self.sim.busy() and time.time() < deadline:
+            self.sim.run(max_events=100000)
+
+    def advance(self, t, client, deadline): # Run until virtual time <t>.  Returns False if there's nothing left to run, so any requests still pending were lost.
+        while self.sim.events and self.sim.events[0][0] <= t and time.time() < deadline:
+            self.sim.run(until=t, max_events=100000)
+        if not self.sim.busy():
+            self.sim.now = max(self.sim.now, t)
+            return False
+        return True
+
+
+# Runs a workload with a thread per node, as chord.py does
+class ThreadDriver():
+
+    def __init__(self, w, config):
+        self.config = config
+        self.rng = random.Random(w.seed)
+        self.queues = {}
+        self.started = []
+        self.vnodes = w.vnodes
+        self.hosts = []
+
+    def build(self, n):                     # The first node starts the ring on its own.  The rest all join at once.
+        self.join()
+        self.wait()
+        for i in range(1, n):
+            self.join()
+        self.wait()
+
+    def client(self, window, cache_size, on_complete):
+        return Client(self.queues, window=window, on_complete=on_complete, config=self.config, cache_size=cache_size)
+
+    def nodes(self):
+        return self.started
+
+    def now(self):                          # The clock threaded clients time requests with
+        return time.perf_counter()
+
+    def join(self):                         # Start a node joining.  It answers its mailbox while it does, so nothing waits for it to finish.
+        if self.vnodes > 1:                 # A new host joins all its virtual nodes at once
+            host = Host(self.queues, config=self.config)
+            host.start()
+            self.hosts.append(host)
+            for i in range(0, self.vnodes):
+                self.started.append(host.add())
+            return
+        node = ChordNode(self.queues, config=self.config)
+        node.start()
+        self.started.append(node)
+
+    def wait(self, deadline=None):          # Until every node started so far has joined, or left
+        while any(node.active and not node.joined for node in self.started) and (deadline is None or time.time() < deadline):
+            time.sleep(0.01)
+
+    def leave(self, member):
+        if isinstance(member, Host):
+            member.leave()
+        else:
+            self.queues[member.id].put(Message(LEAVE_NETWORK, 'root'))
+
+    def crash(self, member):                # Its thread stops at its next timeout
+        if isinstance(member, Host):
+            member.crash()
+            return
+        member.active = False
+        del self.queues[member.id]
+
+    def failures(self):                     # Nodes, or hosts, whose thread died while they were still in the ring
+        threads = self.hosts if self.vnodes > 1 else self.started
+        return sum(1 for t in threads if t.active and not t.is_alive())
+
+    def settle(self, client, deadline):
+        if client is None:                  # Nothing to watch.  Wait for any joins, then give whatever's been set off a moment to finish.
+            self.wait(deadline)
+            time.sleep(0.25)
+        while client is not None and client.pending() > 0 and time.time() < deadline:
+            time.sleep(0.001)
+
+    def advance(self, t, client, deadline):
+        while self.now() < t and client.pending() > 0 and time.time() < deadline:
+            time.sleep(min(0.01, max(0, t - self.now())))
+        return True
+
+
+def live_nodes(driver):
+    return [n for n in driver.nodes() if n.active and n.joined and not n.leaving and n.id in n.queues]
+
+
+def members(driver):                        # The physical nodes still in the ring: Hosts, or ChordNodes if there are no virtual nodes
+    if driver.vnodes > 1:
+        return [h for h in driver.hosts if len(h.live()) > 0]
+    return live_nodes(driver)
+
+
+def loads(driver):                          # (physical node, keys held, messages handled) for each physical node
+    if driver.vnodes > 1:
+        return [(h, h.keys(), h.handled()) for h in members(driver)]
+    return [(n, len(n.hash_table), n.metrics.total()) for n in members(driver)]
+
+
+def percentile(values, q):                  # Values must be sorted
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(w):                                 # Runs workload <w> and returns its results as a dictionary
+    config = RingConfig(hash_bits=w.hash_bits, recursive_lookup=w.recursive, replicas=w.replicas, stabilize_interval=w.stabilize, finger_budget=w.finger_budget)
+    driver = SimDriver(w, config) if w.engine == 'sim' else ThreadDriver(w, config)
+    rng = driver.rng
+    deadline = time.time() + w.timeout
+    driver.build(w.nodes)
+    latencies = {}                          # Request kind -> latencies of timed requests
+    timing = [False]
+    finished = [0]                          # When the last timed request completed
+    sent = {}                               # GET future -> when it was sent
+    stored = {}                             # SET future -> (when it was sent, when it was acknowledged)
+
+    def on_complete(request):
+        if request.msg.type == GET_REQUEST:
+            sent[request.future] = request.sent
+        elif request.msg.type == SET_REQUEST:
+            stored[request.future] = (request.sent, request.done)
+        if timing[0]:
+            latencies.setdefault(request.msg.type, []).append(request.latency())
+            finished[0] = max(finished[0], request.done)
+
+    client = driver.client(w.window, CACHE_SIZE if w.client_cache else 0, on_complete)
+
+    for start in range(0, w.keys, 256):     # Load every key, in batches
+        client.multi_set(dict((key_name(i), value_of(i, w.value_size)) for i in range(start, min(start + 256, w.keys))))
+    driver.settle(client, deadline)
+
+    leaving = []
+    for r in range(0, w.rounds):            # One-off churn
+        for i in range(0, w.joins):
+            driver.join()
+            if not w.together:
+                driver.settle(None, deadline)
+        driver.settle(None, deadline)
+        picked = rng.sample(members(driver), min(w.leaves, len(members(driver)) - 1))
+        for node in picked:
+            driver.leave(node)
+            if not w.together:
+                driver.settle(None, deadline)
+        driver.settle(None, deadline)
+        leaving.extend(picked)
+    crashing = rng.sample(members(driver), min(w.crashes, len(members(driver)) - 1))
+    for node in crashing:
+        driver.crash(node)
+    driver.settle(None, deadline)
+    splits = 0
+    if w.imbalance is not None and w.vnodes > 1:
+        splits = vnodes.rebalance(driver.hosts, w.imbalance, lambda: driver.settle(None, deadline))
+
+    before = metrics.snapshot(driver.nodes())
+    handled = dict((m, h) for m, k, h in loads(driver))     # Messages each physical node had handled before timing
+    chooser = KeyChooser(rng, w.keys, w.distribution, w.zipf_s)
+    reads = []                              # (key index, future) for every GET
+    writes = []                             # (key index, version, future) for every SET
+    versions = [0] * w.keys                 # The latest version written to each key
+    timing[0] = True
+    start = driver.now()
+    wall = time.time()
+    for r in range(0, w.requests):
+        i = chooser.next()
+        if rng.random() < w.read_ratio:
+            reads.append((i, client.get(key_name(i))))
+        else:
+            versions[i] += 1
+            writes.append((i, versions[i], client.set(key_name(i), value_of(i, w.value_size, versions[i]))))
+    joins = leaves = 0
+    if w.churn > 0:                         # Steady churn, alternating joins and leaves, until the requests are done
+        t = start
+        while client.pending() > 0 and time.time() < deadline:
+            t += 1.0 / w.churn
+            if not driver.advance(t, client, deadline) or client.pending() == 0:
+                break
+            if (joins + leaves) % 2 == 0:
+                driver.join()
+                joins += 1
+            else:
+                candidates = members(driver)
+                if len(candidates) > 1:
+                    driver.leave(candidates[rng.randrange(len(candidates))])
+                    leaves += 1
+    driver.settle(client, deadline)
+    timing[0] = False
+    elapsed = max(finished[0] - start, 0)
+    wall = time.time() - wall
+    after = metrics.snapshot(driver.nodes())
+    final = loads(driver)
+
+    acknowledged = {}                       # Key index -> {version: (sent, acknowledged)} for each write the owner acknowledged
+    for i, version, future in writes:
+        if future in stored:
+            acknowledged.setdefault(i, {})[version] = stored[future]
+    errors = stale = 0
+    for i, future in reads:
+        version = version_of(i, future.result(), w.value_size, versions[i]) if future.done() else None
+        if version is None:
+            errors += 1
+            continue
+        done = acknowledged.get(i, {}).get(version, (None, float('-inf') if version == 0 else float('inf')))[1]
+        if any(s > done and t < sent[future] for s, t in acknowledged.get(i, {}).values()):   # A later write was sent after this one was stored,
+            stale += 1                                                                          # and stored before the GET was sent.  Concurrent writes can land in either order.
+    audit = oracle.audit(driver.nodes(), w.hash_bits)
+    everything = sorted(itertools.chain.from_iterable(latencies.values()))
+    hops = after['hops']['count'] - before['hops']['count']
+    messages = dict((name, after['messages'][name] - before['messages'].get(name, 0)) for name in after['messages']
+                    if after['messages'][name] - before['messages'].get(name, 0) > 0)
+    rounds = messages.pop('MAINTAIN', 0)    # Timers, not traffic
+    completed = len(everything)
+    results = {
+        'completed': completed,
+        'errors': errors,
+        'stale_reads': stale,
+        'elapsed': elapsed,                 # Virtual time simulated, seconds threaded
+        'wall_seconds': wall,
+        'throughput': completed / elapsed if elapsed > 0 else None,     # Per unit of elapsed
+        'wall_throughput': completed / wall if wall > 0 else None,
+        'latency_p50': percentile(everything, 0.5),
+        'latency_p99': percentile(everything, 0.99),
+        'mean_hops': (after['hops']['sum'] - before['hops']['sum']) / hops if hops > 0 else None,
+        'messages': sum(messages.values()),
+        'messages_per_request': sum(messages.values()) / completed if completed > 0 else None,
+        'message_types': messages,
+        'finger_lookups': after['finger_lookups'] - before['finger_lookups'],
+        'maintenance_rounds': rounds,
+        'joins': w.joins * w.rounds + joins,
+        'leaves': len(leaving) + leaves,
+        'crashes': len(crashing),
+        'nodes_at_end': len(live_nodes(driver)),
+        'node_failures': driver.failures(),
+        'misplaced': audit['misplaced'],    # Keys held by a node that doesn't own them
+        'unreplicated': audit['unreplicated'],  # Copies missing from the replicas that should have them
+        'duplicates': audit['duplicates'],  # Keys held by more than one node
+        'key_imbalance': vnodes.imbalance([k for m, k, h in final]),   # Most keys on one physical node over the mean
+        'message_imbalance': vnodes.imbalance([h - handled.get(m, 0) for m, k, h in final]),  # Same for messages handled while timing
+        'splits': splits,
+    }
+    if w.engine != 'sim':
+        chord.running = False               # Let the node threads finish
+    return results
+
+
+def commit():                               # The commit being benchmarked, if this is a git checkout
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, cwd=sys.path[0] or None).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser(description='Benchmark a Chord ring under a workload.')
+    parser.add_argument('--scenario', default='default', choices=sorted(SCENARIOS), help='named workload to start from')
+    parser.add_argument('--nodes', type=int, help='ring size')
+    parser.add_argument('--keys', type=int, help='keys loaded before timing')
+    parser.add_argument('--value-size', type=int, dest='value_size', help='bytes per value')
+    parser.add_argument('--read-ratio', type=float, dest='read_ratio', help='fraction of requests that are GETs')
+    parser.add_argument('--distribution', choices=['uniform', 'zipf'], help='how keys are picked')
+    parser.add_argument('--zipf-s', type=float, dest='zipf_s', help='Zipf exponent')
+    parser.add_argument('--requests', type=int, help='requests timed')
+    parser.add_argument('--churn', type=float, help='joins plus leaves per unit of time while requests run')
+    parser.add_argument('--joins', type=int, help='nodes that join before timing')
+    parser.add_argument('--leaves', type=int, help='nodes that leave before timing')
+    parser.add_argument('--together', action='store_const', const=True, help='the joins happen at once, and so do the leaves')
+    parser.add_argument('--rounds', type=int, help='times the joins and leaves are repeated')
+    parser.add_argument('--crashes', type=int, help='nodes that vanish without leaving before timing')
+    parser.add_argument('--engine', choices=['sim', 'threads'], help='simulated ring or a thread per node')
+    parser.add_argument('--hash-bits', type=int, dest='hash_bits', help='bits per ID')
+    parser.add_argument('--recursive', action='store_const', const=True, help='recursive lookups')
+    parser.add_argument('--window', type=int, help='requests in flight')
+    parser.add_argument('--no-client-cache', action='store_const', const=False, dest='client_cache', help='route every request from the entry node')
+    parser.add_argument('--jitter', type=float, help='extra random message delay, simulated only')
+    parser.add_argument('--replicas', type=int, help='successors that keep a copy of each node\'s keys')
+    parser.add_argument('--vnodes', type=int, help='virtual nodes per physical node')
+    parser.add_argument('--stabilize', type=float, help='time between each node\'s maintenance rounds')
+    parser.add_argument('--finger-budget', type=int, dest='finger_budget', help='fingers each node re-resolves per maintenance round')
+    parser.add_argument('--imbalance', type=float, help='split partitions before timing until no physical node has more than this times the mean number of keys')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--timeout', type=float, help='wall-clock seconds to wait for requests')
+    parser.add_argument('--out', help='append the result to this file as a line of JSON')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='print what the nodes are doing.  Twice to include finger updates.')
+    args = parser.parse_args(argv)
+    options = dict(SCENARIOS[args.scenario])
+    for name, value in vars(args).items():
+        if value is not None and name not in ('scenario', 'out', 'verbose'):
+            options[name] = value
+    return args, Workload(**options)
+
+
+def main(argv=None):
+    args, w = parse(argv)
+    if args.verbose > 0:
+        eventlog.output.level = eventlog.INFO if args.verbose == 1 else eventlog.DEBUG
+    results = run(w)
+    record = {'scenario': args.scenario, 'commit': commit(), 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'workload': vars(w), 'results': results}
+    print('---------------------------------------------------')
+    print('Scenario: ' + args.scenario + '  Engine: ' + w.engine + '  Nodes: ' + str(w.nodes) + '  Keys: ' + str(w.keys) + '  Requests: ' + str(w.requests))
+    for name in results:
+        if name != 'message_types':
+            value = results[name]
+            print(name.ljust(22) + (str(round(value, 4)) if isinstance(value, float) else str(value)))
+    if args.out:
+        with open(args.out, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    return record
+
+
+# Main
+# Usage: python bench.py [--scenario name] [options]
+if __name__ == '__main__':
+    main()
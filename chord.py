@@ -1,28 +1,46 @@
 from hashlib import blake2b
 import threading
 import queue
-import struct
 import time
 import random
 import math
-
-# TEST = 0 # - THE "I HOPE I DIDN'T BREAK ANYTHING I CAN'T FIX" TEST
-# TEST = 1 # - PARTITION PASSING DURING NODE JOIN
-# TEST = 2 # - NODE LEAVING NETWORK
-TEST = 3 # - NODE LEAVING NETWORK + RESPONSIVE FINGER FIXING
-# TEST = 4 # - CONCURRENT NODE DEPARTURES
+import bisect
+import collections
+from storage import RingStore, DiskStore
+from metrics import NodeMetrics
+from eventlog import EventLog
+import eventlog
+import os
 
 TIMEOUT = 2     # How long a message
-HASH_BITS = 8   # The number of bits in each ID on the identifier circle.
+JOIN_ROUNDS = 8 # Maintenance rounds a join request can go unanswered before the node starts over.  It may be waiting on a node that is still joining itself.
+HASH_BITS = 8   # The default number of bits in each ID on the identifier circle.
+ROUTE_CACHE_SIZE = 64   # Default number of looked up ranges each node remembers.
+TRANSFER_CHUNK = 256            # Default most keys in one DATA_TRANSFER
+TRANSFER_BYTES = 64 * 1024      # Default most bytes of data in one DATA_TRANSFER.  A chunk ends at whichever limit it reaches first.
+TRANSFER_WINDOW = 4             # Default number of DATA_TRANSFER chunks a node sends to a joining node before waiting for a DATA_ACK
+REPLICAS = 0                    # Default number of successors that keep a copy of each node's keys
+READ_SPILL = 8                  # Default mailbox depth past which an owner passes GETs on to a less busy replica
+STABILIZE_INTERVAL = None       # Default time between a node's maintenance rounds.  None leaves them off.
+FINGER_BUDGET = 4               # Default fingers past its successor a node re-resolves each maintenance round
+LEAVE_NOTICES = 64              # Default most nodes a leaving node tells to point their fingers at its successor instead
+MAX_HASH_BITS = 160     # The widest IDs a ring can use.  Same size as a SHA-1 digest.
 
 running = True              # Set to false at the end of testing code to stop the simulation
-random.seed(time.time())    # Seed random number generation
+SEED = os.environ.get('CHORD_SEED')                         # Set CHORD_SEED for a repeatable run.  Node IDs and entry points are drawn from it.
+random.seed(int(SEED) if SEED is not None else time.time()) # Seed random number generation
 
 
-def hash(file_name):                            # Returns a the unsigned integer representation of 1 byte hash of the input string
-    h = blake2b(digest_size=1)                  # Used BLAKE2 because it allows you to specify the size of the hash
+def hash(file_name, bits=HASH_BITS):            # Returns the unsigned integer representation of a <bits> bit hash of the input string
+    h = blake2b(digest_size=(bits + 7) // 8)    # Used BLAKE2 because it allows you to specify the size of the hash
     h.update(file_name.encode())
-    return struct.unpack('B', h.digest())[0]
+    return int.from_bytes(h.digest(), 'big') >> (-bits % 8)    # Drop the low bits that don't fit when <bits> isn't a whole number of bytes
+
+
+def data_size(file_data):                       # Roughly how many bytes a value takes up on the wire.  Only strings and byte buffers are counted.
+    if isinstance(file_data, (str, bytes, bytearray, memoryview)):
+        return len(file_data)
+    return 0
 
 
 def mod_between(i, lb, ub):                 # Returns true if i is between lower bound lb and upper bound ub
@@ -30,12 +48,121 @@ def mod_between(i, lb, ub):                 # Returns true if i is between lower
         return True
     if lb > ub and (i >= lb or i <= ub):
         return True
+    if lb == ub and i == lb:                # An interval that starts and ends on the same ID holds just that ID
+        return True
     return False
 
 
-class Message():    # Little more than a struct with a copy function
-
-    def __init__(self, type, sender_id, mode=None, file_name=None, file_id=None, file_data=None, node=None, finger_num=None):
+# Remembers which node owns which range of IDs, so a lookup can skip straight to the owner.
+# Each entry is an owner and its predecessor, covering (predecessor, owner].  Holds at most <size> entries
+# and drops the least recently used first.
+class RangeCache():
+
+    def __init__(self, size):
+        self.size = size
+        self.owners = []                            # Sorted IDs of the owners in the cache, for bisecting
+        self.ranges = collections.OrderedDict()     # owner -> predecessor, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, id):                           # Returns the cached owner of <id>, or None
+        if len(self.owners) > 0:
+            i = bisect.bisect_left(self.owners, id)
+            owner = self.owners[i % len(self.owners)]   # The first owner at or after <id> is the only one that could hold it
+            if mod_between(id, self.ranges[owner] + 1, owner):
+                self.ranges.move_to_end(owner)
+                self.hits += 1
+                return owner
+        self.misses += 1
+        return None
+
+    def learn(self, pred, owner):                   # <owner> has told us it owns (pred, owner]
+        if self.size <= 0:
+            return
+        if len(self.owners) > 0:
+            i = bisect.bisect_left(self.owners, owner)
+            covering = self.owners[i % len(self.owners)]    # An old entry whose range contains <owner>
+            if covering != owner and mod_between(owner, self.ranges[covering] + 1, covering):
+                self.forget(covering)
+            lo = bisect.bisect_right(self.owners, pred)                 # Old entries that end inside the new range
+            hi = bisect.bisect_left(self.owners, owner)
+            if pred < owner:
+                stale = self.owners[lo:hi]
+            else:                                                       # The range wraps past zero
+                stale = self.owners[lo:] + self.owners[:hi]
+            for o in stale:
+                self.forget(o)
+        if owner not in self.ranges:
+            bisect.insort(self.owners, owner)
+        self.ranges[owner] = pred
+        self.ranges.move_to_end(owner)
+        if len(self.ranges) > self.size:
+            self.forget(next(iter(self.ranges)))
+
+    def forget(self, owner):                        # Drop <owner>'s entry, if there is one
+        if owner in self.ranges:
+            del self.ranges[owner]
+            self.owners.pop(bisect.bisect_left(self.owners, owner))
+
+    def forget_containing(self, id):                # Drop whichever entry covers <id>.  Used when a node joins inside a cached range.
+        if len(self.owners) > 0:
+            owner = self.owners[bisect.bisect_left(self.owners, id) % len(self.owners)]
+            if mod_between(id, self.ranges[owner] + 1, owner):
+                self.forget(owner)
+
+
+# Message types.  Small integers so a node can dispatch with a single table lookup.
+GET_REQUEST         = 0
+SET_REQUEST         = 1
+FIND_PRED           = 2
+FIND_PRED_RESULT    = 3
+FIND_SUCC           = 4
+FIND_SUCC_RESULT    = 5
+SUCC_STABALIZE      = 6
+PRED_STABALIZE      = 7
+SET_SUCCESSOR       = 8
+SET_PREDECESSOR     = 9
+DATA_REQUEST        = 10
+DATA_TRANSFER       = 11
+LEAVE_NETWORK       = 12
+GET_RESULT          = 13
+MULTI_GET           = 14
+MULTI_SET           = 15
+MULTI_GET_RESULT    = 16
+SET_RESULT          = 17
+MULTI_SET_RESULT    = 18
+DATA_ACK            = 19
+SUCC_LIST           = 20
+REPLICATE           = 21
+DROP_REPLICAS       = 22
+NODE_LEFT           = 23
+MAINTAIN            = 24
+BROADCAST           = 25
+BROADCAST_RESULT    = 26
+
+MSG_NAMES = ['GET_REQUEST', 'SET_REQUEST', 'FIND_PRED', 'FIND_PRED_RESULT', 'FIND_SUCC', 'FIND_SUCC_RESULT', 'SUCC_STABALIZE',
+             'PRED_STABALIZE', 'SET_SUCCESSOR', 'SET_PREDECESSOR', 'DATA_REQUEST', 'DATA_TRANSFER', 'LEAVE_NETWORK', 'GET_RESULT',
+             'MULTI_GET', 'MULTI_SET', 'MULTI_GET_RESULT', 'SET_RESULT', 'MULTI_SET_RESULT', 'DATA_ACK', 'SUCC_LIST', 'REPLICATE',
+             'DROP_REPLICAS', 'NODE_LEFT', 'MAINTAIN', 'BROADCAST', 'BROADCAST_RESULT']
+
+ROUTED = frozenset([GET_REQUEST, SET_REQUEST, FIND_PRED, MULTI_GET, MULTI_SET])    # Requests nodes pass along through their fingers
+
+# Message modes.  Say which request a FIND_PRED/FIND_SUCC lookup is working for.
+MODE_INIT           = 0
+MODE_GET            = 1
+MODE_SET            = 2
+MODE_FINGER         = 3
+
+MODE_NAMES = ['INIT', 'GET', 'SET', 'FINGER']
+
+
+class Message():    # Little more than a struct with a copy function.  Slotted, since there are a lot of these in flight.
+
+    __slots__ = ('type', 'orig_sender_id', 'sender_id', 'mode', 'file_name', 'file_id', 'file_data', 'node', 'finger_num', 'items',
+                 'requester', 'request_id', 'hops', 'shortcut')
+
+    def __init__(self, type, sender_id, mode=None, file_name=None, file_id=None, file_data=None, node=None, finger_num=None, items=None,
+                 requester=None, request_id=None, hops=0):
         self.type           = type          # Identifies what kind of message this is
         self.orig_sender_id = sender_id     # This should always equal the ID of the Chord Node that received a GET or SET request.  Messages are copied and passed a lot, this is where it started.
         self.sender_id      = sender_id     # The most recent node to copy and send this message.
@@ -45,16 +172,24 @@ class Message():    # Little more than a struct with a copy function
         self.file_data      = file_data     # The file data.
         self.node           = node          # The ID of a node that's important in the message context.  Could be a successor, a predecessor, or a node that a finger should point to.
         self.finger_num     = finger_num    # The index of the finger that needs to be updated.
+        self.items          = items         # A list of (file_id, file_name, file_data) for the MULTI_ messages.  file_id can be None until a node hashes it.
+        self.requester      = sender_id if requester is None else requester     # Who gets the answer to a GET or SET.  Survives the lookup even when orig_sender_id doesn't.
+        self.request_id     = request_id    # Set by a client so it can match the answer to its request.  SETs are only acknowledged when this is set.
+        self.hops           = hops          # How many times nodes have passed this request (or the lookups made for it) along.
+        self.shortcut       = False         # Set once a node sends this straight to a node from its route cache.  Nobody takes a second shortcut, so stale entries can't pass it around in circles.
 
-    # Returns a new message with the same values
+    # Returns a new message with the same values.  Nodes forward the message they received instead, so only use this if you need to keep the original.
     def copy(self):
-        return Message(self.type, self.orig_sender_id, mode=self.mode, file_name=self.file_name, file_id = self.file_id, file_data = self.file_data, node = self.node, finger_num = self.finger_num)
+        msg = Message(self.type, self.orig_sender_id, mode=self.mode, file_name=self.file_name, file_id = self.file_id, file_data = self.file_data, node = self.node, finger_num = self.finger_num, items = self.items,
+                      requester = self.requester, request_id = self.request_id, hops = self.hops)
+        msg.shortcut = self.shortcut
+        return msg
 
     def print(self):
         print('---type:')
-        print(self.type)
+        print(MSG_NAMES[self.type])
         print('---mode:')
-        print(self.mode)
+        print(None if self.mode is None else MODE_NAMES[self.mode])
         print('---orig_sender_id:')
         print(self.orig_sender_id)
         print('---sender_id:')
@@ -67,6 +202,40 @@ class Message():    # Little more than a struct with a copy function
         print(self.node)
         print('---finger_num:')
         print(self.finger_num)
+        print('---items:')
+        print(self.items)
+        print('---requester:')
+        print(self.requester)
+        print('---request_id:')
+        print(self.request_id)
+        print('---hops:')
+        print(self.hops)
+        print('---shortcut:')
+        print(self.shortcut)
+
+
+# Settings shared by every node in a ring.
+class RingConfig():
+
+    def __init__(self, hash_bits=HASH_BITS, recursive_lookup=False, route_cache_size=ROUTE_CACHE_SIZE, transfer_chunk=TRANSFER_CHUNK,
+                 transfer_bytes=TRANSFER_BYTES, transfer_window=TRANSFER_WINDOW, storage_dir=None, log_level=eventlog.INFO, log_capacity=eventlog.CAPACITY,
+                 replicas=REPLICAS, read_spill=READ_SPILL, stabilize_interval=STABILIZE_INTERVAL, finger_budget=FINGER_BUDGET, leave_notices=LEAVE_NOTICES):
+        if hash_bits < 1 or hash_bits > MAX_HASH_BITS:
+            raise ValueError('hash_bits must be between 1 and ' + str(MAX_HASH_BITS))
+        self.hash_bits = hash_bits                  # The number of bits in each ID on the identifier circle
+        self.recursive_lookup = recursive_lookup    # GET and SET requests travel to their owner themselves, instead of the FIND_PRED/FIND_SUCC round trips
+        self.route_cache_size = route_cache_size    # How many looked up ranges each node remembers.  0 turns the cache off.
+        self.transfer_chunk = transfer_chunk        # Most keys sent in one DATA_TRANSFER when handing off a partition
+        self.transfer_bytes = transfer_bytes        # Most bytes of data sent in one DATA_TRANSFER
+        self.transfer_window = transfer_window      # DATA_TRANSFER chunks in flight to a joining node before waiting for a DATA_ACK
+        self.storage_dir = storage_dir              # If set, each node keeps its data in a log file here named after its ID, instead of in memory
+        self.log_level = log_level                  # Events below this level aren't kept in a node's event log.  What gets printed is eventlog.output.level.
+        self.log_capacity = log_capacity            # Recent events each node keeps
+        self.replicas = replicas                    # How many of a node's successors keep a copy of its keys.  0 means only the owner has them.
+        self.read_spill = read_spill                # An owner with more messages than this waiting hands GETs to a replica with fewer
+        self.stabilize_interval = stabilize_interval    # Time between each node's maintenance rounds: seconds threaded, virtual time simulated.  None leaves them off.
+        self.finger_budget = finger_budget          # Fingers re-resolved each maintenance round, going round the table
+        self.leave_notices = leave_notices          # Most nodes that route through a node it tells to repoint their fingers when it leaves
 
 
 # Struct for use in each node's finger table.
@@ -76,237 +245,667 @@ class Message():    # Little more than a struct with a copy function
 # a different node.
 class Finger():
 
+    __slots__ = ('start', 'node')
+
     def __init__(self, start, node):
         self.start = start  # An ID
         self.node = node    # The ID of the nearest node with ID greater than 'start'
 
+
+# Struct for a partition handoff in progress.  The data has already left the hash table; it goes out a chunk at a time.
+class Handoff():
+
+    __slots__ = ('dest', 'items', 'next', 'sent', 'unacked')
+
+    def __init__(self, dest, items):
+        self.dest = dest        # The ID of the node receiving the data
+        self.items = items      # A list of (file_id, file_name, file_data) still to send.  file_name is None.
+        self.next = 0           # Index of the first item that hasn't been sent
+        self.sent = 0           # Chunks sent so far.  Each one's number goes out as its request ID.
+        self.unacked = {}       # Chunk number -> (start, end) of the items it carried, for chunks not acknowledged yet.  If <dest> goes, they come back.
+
+
+# Struct for the copy a node keeps of one of its predecessors' partitions
+class Replica():
+
+    __slots__ = ('owner', 'pred', 'store')
+
+    def __init__(self, owner, pred):
+        self.owner = owner      # The ID of the node the keys belong to
+        self.pred = pred        # The owner's predecessor, as of the last copy it sent.  The owner has (pred, owner].
+        self.store = RingStore()    # The copied keys.  Always in memory, even when the ring keeps its data on disk.
+
+
+# Struct for a broadcast a node has passed on and is collecting the answers to
+class Gather():
+
+    __slots__ = ('parent', 'query', 'value', 'waiting')
+
+    def __init__(self, parent, query, value, waiting):
+        self.parent = parent    # The node (or client) it came from.  The combined answer goes back there.
+        self.query = query      # Its name in QUERIES
+        self.value = value      # Your own answer, combined with your children's so far
+        self.waiting = waiting  # IDs of the nodes you passed it to that haven't answered yet
+
+
+# Ring-wide queries.  Every node answers for its own partition, and the answers are combined on the way back to the client.
+def message_counts(node, arg):          # Messages the node has handled, by type name
+    handled = node.metrics.handled
+    return dict((node.metrics.names[t], handled[t]) for t in range(0, len(handled)) if handled[t] > 0)
+
+def merge_counts(a, b):
+    c = dict(a)
+    for name in b:
+        c[name] = c.get(name, 0) + b[name]
+    return c
+
+def scan(node, arg):                    # Every (file_id, file_data) the node holds for which arg(file_id, file_data) is true.  Over sockets, arg has to be picklable: a module-level function, not a lambda.
+    return [(id, file_data) for id, file_data in node.hash_table.items() if arg(id, file_data)]
+
+def add(a, b):
+    return a + b
+
+QUERIES = {                             # Name -> (what a node answers, given itself and the query's argument; how two answers combine)
+    'nodes':    (lambda node, arg: 1, add),                                                         # Nodes reached
+    'keys':     (lambda node, arg: len(node.hash_table), add),                                      # Keys stored
+    'bytes':    (lambda node, arg: sum(data_size(v) for v in node.hash_table.values()), add),       # Bytes of data stored, counted the way data_size() counts them
+    'messages': (message_counts, merge_counts),
+    'scan':     (scan, add),
+}
+
 # ChordNode threads represent nodes in the Chord Distributed Hash table
 class ChordNode(threading.Thread):
 
-    def __init__(self, queues):
+    trace = None        # A tracelog.TraceWriter recording what every node handles, while tracelog.start() has tracing on
+
+    def __init__(self, queues, engine=None, config=None, id=None):
 
         threading.Thread.__init__(self)
-        self.id = None                          # ID both uniquely identifies this node and specifies the last key in its portion of the identifier circle
+        self.config = config or RingConfig()    # Settings shared with the rest of the ring
+        self.hash_bits = self.config.hash_bits  # The number of bits in each ID
+        self.ring_size = 2**self.hash_bits      # The number of IDs on the identifier circle
+        self.engine = engine                    # The discrete-event engine driving this node, or None if it runs as its own thread
+        self.rng = engine.rng if engine else random     # Simulated nodes draw from the engine's seeded generator so runs are repeatable
+        self.id = id                            # ID both uniquely identifies this node and specifies the last key in its portion of the identifier circle.  Pass the old one to restart a node from its log.
         self.predecessor = None                 # The ID of the previous node in the identifier space
         self.finger_table = []                  # A table of finger objects that point to other nodes in the identifier space
         self.queues = queues                    # Queues for messaging other nodes.  Stored in a dictionary.
-        self.msg_buf = []                       # Stores messages that arrive out of order
-        self.hash_table = {}                    # The hash table part of the distributed hash table
-        self.update_required = False
-
-    def join_network(self):
-
-        self.id = random.randint(0, 255)        # Generate random ID
-        while self.id in self.queues.keys():    # Don't use an ID that is already in use
-            self.id = random.randint(0, 255)    # Keep trying random ID's until you finds a free one
-        self.queues[self.id] = queue.Queue()    # Add a queue for other node's to reach you at
-
-        queue_keys = list(self.queues.keys())   # queue_keys will be used to select a node to help initialzie you.
-        queue_keys.remove(self.id)              # Don't use yourself.  You don't know anything.
-        queue_keys.remove('root')               # Don't use the root message queue.  It won't be helpful.
+        self.msg_buf = []                       # Messages that arrived while joining.  They're answered once you know where you are.
+        self.pending = {}                       # Request ID -> (the maintenance round it went out in, the node it went to), for join requests not answered yet
+        self.requests = 0                       # Request IDs handed out so far
+        self.hash_table = RingStore()           # The hash table part of the distributed hash table.  Kept in ring order so ranges can be split off.
+        self.handoffs = {}                      # Partition handoffs waiting on DATA_ACKs, by the ID of the node receiving them
+        self.successors = []                    # The next config.replicas nodes round the circle, nearest first.  They keep copies of your keys.
+        self.replicas = {}                      # Copies of your predecessors' keys, by owner
+        self.update_required = False            # Set when some fingers need re-resolving.  They're done after the current message.
+        self.vanished = set()                   # Nodes found gone since the last repair pass.  Fingers pointing at them need repair.
+        self.stale = set()                      # Numbers of the fingers that need re-resolving and haven't been asked about yet
+        self.repairs = {}                       # Finger number -> the maintenance round its lookup went out in, for lookups not answered yet
+        self.rounds = 0                         # Maintenance rounds so far
+        self.gathers = {}                       # (requester, request ID) -> Gather, for broadcasts still waiting on answers from the nodes you passed them to
+        self.next_finger = 1                    # Where the next maintenance round starts re-resolving fingers
+        self.referrers = {}                     # Nodes that have passed requests to you, oldest first.  They'll hear about it when you leave.
+        self.route_cache = RangeCache(self.config.route_cache_size)   # Ranges this node has looked up before, and who owns them.  Checked before the fingers.
+        self.metrics = NodeMetrics(MSG_NAMES)   # Message counts, hop and mailbox depth histograms, finger repairs.  See metrics.py.
+        self.mailbox = None                     # This node's own queue, once it has one
+        self.log = EventLog(id, self.config.log_level, self.config.log_capacity)    # Recent events.  Only warnings are printed unless eventlog.output.level says otherwise.
+        self.joined = False                     # Set once the node knows its predecessor and successor
+        self.leaving = False                    # Set once the node has started leaving.  It stays until its successor has everything it held.
+        self.active = True                      # Cleared when the node leaves the network
+
+    def join_network(self):                 # Start joining.  The answers to your join requests arrive in your mailbox like any other message, so you keep reading it while you wait.
+
+        if self.id is None:
+            self.id = self.rng.randrange(self.ring_size)        # Generate random ID
+            while self.id in self.queues:                       # Don't use an ID that is already in use
+                self.id = self.rng.randrange(self.ring_size)    # Keep trying random ID's until you finds a free one
+            self.log.name = self.id
+        self.queues[self.id] = self.new_queue() # Add a queue for other node's to reach you at
+        self.hash_table = self.new_store()      # Open your storage, now that you know what it's called
+        if self.trace is not None:
+            self.trace.join(self)
+
+        queue_keys = self.bootstraps()                              # queue_keys will be used to select a node to help initialzie you.
 
         if len(queue_keys) == 0:                                    # If no nodes are in the network, then initialize yourself as the first node.
             self.predecessor = self.id                              # You are your own predecessor.
             i = 0
-            while i < HASH_BITS:                                    # Set all your finger's to point at yourself.
-                start = (self.id + 2**i) % 2**HASH_BITS             # There's nobody else to point at.
+            while i < self.hash_bits:                               # Set all your finger's to point at yourself.
+                start = (self.id + 2**i) % self.ring_size           # There's nobody else to point at.
                 self.finger_table.append(Finger(start, self.id))
                 i += 1
+            self.joined = True
+            return
+
+        self.start_join(queue_keys)
+
+    def bootstraps(self):                   # Nodes you could ask where you belong.  Only ones whose queues were there before yours, if there are any, so that
+        keys = [k for k in list(self.queues.keys()) if not isinstance(k, str)]     # nodes joining at the same time never end up waiting on eachother.
+        if self.id in keys and keys.index(self.id) > 0:                             # Don't use 'root' or any other client queue either.  Clients have names, nodes have numbers.
+            return keys[:keys.index(self.id)]
+        return [k for k in keys if k != self.id]                                    # Don't use yourself, you don't know anything.
+
+    def start_join(self, queue_keys):
+        rand_queue = queue_keys[self.rng.randint(0, len(queue_keys)) - 1]                           # Select a random node.
+        self.pending.clear()                                                                        # Forget any earlier attempt.  Its answers will be ignored.
+        self.predecessor = None
+        self.queues[rand_queue].put(Message(FIND_PRED, self.id, mode=MODE_INIT, file_id=self.id, request_id=self.request(rand_queue)))    # Ask it to tell you your predecessor.
+
+    def request(self, dest):                # A new request ID for a join request going to <dest>, entered in the pending table
+        self.requests += 1
+        self.pending[self.requests] = (self.rounds, dest)
+        return self.requests
+
+    def retry_join(self):                   # Still joining.  If the node you asked has left, or nothing has come back for JOIN_ROUNDS rounds, start again.
+        if len(self.pending) > 0 and all(sent >= self.rounds - JOIN_ROUNDS and dest in self.queues for sent, dest in self.pending.values()):
             return
+        queue_keys = self.bootstraps()
+        if len(queue_keys) > 0:
+            self.log.info('join request went unanswered, trying again')
+            self.start_join(queue_keys)
 
-        rand_queue = queue_keys[random.randint(0, len(queue_keys)) - 1]                             # Select a random node.
-        self.queues[rand_queue].put(Message('FIND_PRED', self.id, mode='INIT', file_id=self.id))    # Ask it to tell you your predecessor. #FIXME
-        msg = self.wait_for_message_type('FIND_PRED_RESULT')                                        # Wait for the result and buffer any messages you get in the meantime.  You'll answer them when you are live.
+    def join_found_predecessor(self, msg):
+        if self.pending.pop(msg.request_id, None) is None:     # An answer to an attempt you've given up on, or a duplicate
+            return
         self.predecessor = msg.node
+        self.queues[self.predecessor].put(Message(FIND_SUCC, self.id, mode=MODE_INIT, file_id=self.id, request_id=self.request(self.predecessor)))     # Ask your predecessor for your successor.
 
-        self.queues[self.predecessor].put(Message('FIND_SUCC', self.id, mode='INIT', file_id=self.id))   # Ask your predecessor for your successor. #FIXME
-        msg = self.wait_for_message_type('FIND_SUCC_RESULT')                                             # Its current successor is your successor unless two nodes joined right next to eachother, in which case this code is not smart enough to handle it.
-        self.finger_table.append(Finger(self.id + 1, msg.node))                                          # Store your seccessor in your first (and closest) finger.
+    def join_found_successor(self, msg):                                                                 # Its current successor is your successor, unless another node joined right next to you at the same time.  Stabalizing sorts out which of you comes first.
+        if self.pending.pop(msg.request_id, None) is None or self.joined:
+            return
+        self.finger_table.append(Finger((self.id + 1) % self.ring_size, msg.node))                                        # Store your seccessor in your first (and closest) finger.
 
         i = 1
-        while i < HASH_BITS:                                # Only the successor needs to be set for the node to function.  Set all fingers to the successor, and do the updates live.
-            start = (self.id + 2**i) % 2**HASH_BITS         # <start> is an ID some distance away
+        while i < self.hash_bits:                           # Only the successor needs to be set for the node to function.  Set all fingers to the successor, and do the updates live.
+            start = (self.id + 2**i) % self.ring_size       # <start> is an ID some distance away
             succ = self.finger_table[0].node                # <succ> is the successor of <start>, but it will be updated once this node is live.  For now it's set to your successor.
             Finger(start, succ)                             # Each finger on the table should point to an ID twice as far as the one before it.
             self.finger_table.append(Finger(start, succ))   # The last finger will point to the ID on the opposite side of the identifier circle.
             i += 1
 
+        self.stale.update(range(1, self.hash_bits))         # All of them need finding.
         self.update_required = True                         # Set this flag true so that you will update your fingers once you go live.
+        self.joined = True
+        self.log.info('has joined the network')
 
-        self.stabalize()                                                                # Your neigbours should point at you.  Tell them you exist.
-        self.queues[self.finger_table[0].node].put(Message('DATA_REQUEST', self.id))    # Ask your successor for your share of it's partition.
+        self.stabalize()                                    # Your neigbours should point at you.  Tell them you exist.  Your successor sends you your share of its partition when it takes you as its predecessor.
 
 
     def run(self):  # After initializing, thread execution starts here.
 
-        self.join_network();    # Join the network by initializing your predecessor and finger values.  Also tell the neighbouring nodes to point at you.
-        print('Node: ' + str(self.id) + ' has joined the network')
-
-        while running:  # Main loop
-
-            if self.update_required:        # This will be true if you tried to send a message to a node that doesn't exist, or you just joined the network.
-                self.ask_for_fingers()      # Dispatch messages to find your true fingers.
-
-            if len(self.msg_buf) > 0:
-                msg = self.msg_buf.pop(0)                               # Read any messages you buffered while you were waiting for a specific message.
-            else:
-                try:
-                    msg = self.queues[self.id].get(timeout = TIMEOUT)   # Wait some time for a message.  This timeouts so that the node can perform stabalizations, but I didn't get to that.  Left it in.
-                except:
-                    continue
-
-
-            if msg.type == 'GET_REQUEST':           # If you have the value they are looking for, print it.  Otherwise pass it along.
-                self.get(msg)
-
-            elif msg.type == 'SET_REQUEST':         # If the key falls in your partition, set it to your local hash table.  Otherwise look up the node it belongs to.
-                self.set(msg)
+        self.join_network();    # Start joining the network.  The answers are handled below like any other message, through step().
 
-            elif msg.type == 'FIND_PRED':           # A node is looking for a predecessor to some ID.  If it's you, reply with a FIND_PRED_RESULT message.  Otherwise pass it along.
-                self.remote_find_predecessor(msg)
+        interval = self.config.stabilize_interval
+        next_round = time.perf_counter() + (interval * self.rng.random() if interval is not None else 0)   # Spread the nodes' rounds out
 
-            elif msg.type == 'FIND_PRED_RESULT':    # A predecessor node you were looking for returned a result.  Ask it for it's successor.
-                self.find_successor(msg)
+        while running and self.active:  # Main loop
 
-            elif msg.type == 'FIND_SUCC':           # A node is asking for your successor.  Return a message with your successor's ID.
-                self.remote_find_successor(msg)
+            if self.update_required and self.joined:    # This will be true if you tried to send a message to a node that doesn't exist, or you just joined the network.
+                self.ask_for_fingers()      # Dispatch messages to find your true fingers.
 
-            elif msg.type == 'FIND_SUCC_RESULT':    # You've been given the ID of a successor you were looking for.  Do things depending on what the original request was.
-                if msg.mode == 'GET':                   # You were responding to a GET_REQUEST.  Forward the GET_REQUEST to the node where the ID belongs.
-                    self.forward_get(msg)
-                elif msg.mode == 'SET':                 # You were responding to a SET_REQUEST.  Forward the SET_REQUEST to the node where the ID belongs.
-                    self.forward_set(msg)
-                elif msg.mode == 'FINGER':              # You were updating your fingers.  Use the data in the message to update one of your fingers.
-                    self.update_finger(msg)
+            if interval is not None and time.perf_counter() >= next_round:     # Time for a maintenance round.  It goes through handle() like any message, so traces have it.
+                next_round = time.perf_counter() + interval
+                self.step(Message(MAINTAIN, self.id))
+                continue
 
-            elif msg.type == 'SUCC_STABALIZE':      # A node has joined the network and it thinks it's your predecessor.  Check the ID it sent you and update accordingly.
-                self.succ_stabalize(msg)
+            try:
+                msg = self.queues[self.id].get(timeout = TIMEOUT if interval is None else max(0, next_round - time.perf_counter()))  # Wait some time for a message.  Times out in time for the next maintenance round.
+            except:
+                if (not self.joined or self.leaving) and interval is None:  # Nothing heard for a while and still joining, or leaving.  Without rounds, the timeout has to stand in for one.
+                    self.step(Message(MAINTAIN, self.id))
+                continue
 
-            elif msg.type == 'PRED_STABALIZE':      # A node has joined the network and it thinks it's your successor.  Check the ID it sent you and update accordingly.
-                self.pred_stabalize(msg)
+            self.step(msg)
+            msg = None
 
-            elif msg.type == 'SET_SUCCESSOR':       # A node has left the network and it's telling you that you have a new successor.  Update it!
-                self.set_successor(msg)
+        if self.active:
+            self.log.info('exiting')    # End
+        exit()
 
-            elif msg.type == 'SET_PREDECESSOR':     # A node has left the network and it's telling you that you have a new predecessor.  Update it!
-                self.set_predecessor(msg)
 
-            elif msg.type == 'DATA_REQUEST':        # A node has joined the network and is now responsible for some of your partition.  Send them their share!
-                self.send_partition_data(msg)
+    def step(self, msg):    # Handles a single delivered message.  Threaded nodes call it from run(), and engines call it for every delivery.
+        if not self.joined and msg.type != MAINTAIN and (msg.mode != MODE_INIT or msg.type == FIND_PRED or msg.type == FIND_SUCC):  # Hold on to anything that isn't an answer to your join requests until you know where you are.
+            self.msg_buf.append(msg)
+            return
+        self.handle(msg)
+        if self.joined and len(self.msg_buf) > 0:   # You just finished joining.  Answer everything that arrived in the meantime.
+            buffered = self.msg_buf
+            self.msg_buf = []
+            for m in buffered:
+                self.handle(m)
+        if self.update_required and self.active and self.joined:
+            self.ask_for_fingers()
+
+
+    def handle(self, msg):
+        if self.trace is not None:
+            self.trace.deliver(self, msg)
+        self.metrics.handled[msg.type] += 1
+        if msg.type in ROUTED and type(msg.sender_id) is int and msg.sender_id not in self.referrers:  # It reached you through the sender's fingers or route cache.  Tell it if you leave.
+            self.referrers[msg.sender_id] = None
+            if len(self.referrers) > self.config.leave_notices:
+                del self.referrers[next(iter(self.referrers))]
+        if self.mailbox is not None:
+            self.metrics.depth.observe(self.mailbox.qsize())    # What's still waiting behind this message
+        if len(self.handoffs) > 0:                                  # A node you're handing data to may have gone since the last message.
+            self.drop_gone_handoffs()
+            if not self.active:
+                return
+        if self.leaving and msg.type in self.LEAVING_HANDLERS:      # On your way out, some messages are dealt with differently.
+            self.LEAVING_HANDLERS[msg.type](self, msg)
+        else:
+            self.HANDLERS[msg.type](self, msg)  # Look up what to do with this type of message in the table at the bottom of the class.
 
-            elif msg.type == 'DATA_TRANSFER':       # A node has sent some data that should be in your partition.  Store it!
-                self.insert_data(msg)
 
-            elif msg.type == 'LEAVE_NETWORK':       # Its time to get out of here.  Send your data to your successor and let your neighbours know you've left.
-                self.leave_network()
+    def find_pred_result(self, msg):        # A predecessor node you were looking for returned a result.  What happens next depends on why you were looking.
+        self.PRED_RESULT_HANDLERS[msg.mode](self, msg)
 
-            msg = None
 
-        print('Node ' + str(self.id) + ' exiting')  # End
-        exit()
+    def find_succ_result(self, msg):        # You've been given the ID of a successor you were looking for.  Do things depending on what the original request was.
+        if msg.mode != MODE_INIT:           # The sender is the predecessor of the ID and msg.node is its successor, so msg.node owns everything in between.  Remember that.
+            self.route_cache.learn(msg.sender_id, msg.node)
+        self.SUCC_RESULT_HANDLERS[msg.mode](self, msg)
 
 
-    def get(self, msg):                                                                                 # Hash the filename
-        id = hash(msg.file_name)                                                                        # Check if the ID falls in your partition...
-        if mod_between(id, self.predecessor + 1, self.id):                                              #       It does.  Store it locally.
-            print('Node ' + str(self.id) + ' performed GET on ' + str(msg.file_name) + ' (Hashes to ' + str(id) + ') retrieving value: ' + str(self.hash_table[id]))
+    def get(self, msg):
+        id = msg.file_id                                                                                # Hash the filename, unless a node before you already did
+        if id is None:
+            id = msg.file_id = hash(msg.file_name, self.hash_bits)
+        if mod_between(id, self.predecessor + 1, self.id):                                              # Check if the ID falls in your partition...
+            if len(self.successors) > 0 and not msg.shortcut and self.spill(msg):                       #       It does.  If you're swamped, a replica answers instead.
+                return
+            value = self.hash_table.get(id)                                                             #       Otherwise look it up locally.
+            self.metrics.hops.observe(msg.hops)
+            self.log.info('performed GET on %s (Hashes to %s) retrieving value: %s', msg.file_name, id, value)
+            self.queues[msg.requester].put(Message(GET_RESULT, self.id, file_name=msg.file_name, file_id=id, file_data=value, node=self.predecessor,    # Send the requester the value.  Include your predecessor so it knows which range you own.
+                                                   request_id=msg.request_id))
+        elif len(self.replicas) > 0 and self.read_replica(msg, id):                                     #       It doesn't.  If you keep a copy of the owner's keys, answer from that.
+            return
+        elif self.send_to_cached_owner(msg, id):                                                        #       If you've looked up its range before, it's already been sent to the owner.
+            return
+        elif self.config.recursive_lookup or mod_between(id, self.id + 1, self.successor()):
+            self.route(msg, id)                                                                         #       Otherwise pass the request itself towards the owner.  If that's your successor, it goes straight there.
         else:
-            new_msg = Message('FIND_PRED', self.id, mode='GET', file_name=msg.file_name, file_id=id)    #       It doesn't.  First step is to find the ID's predecessor.
+            new_msg = Message(FIND_PRED, self.id, mode=MODE_GET, file_name=msg.file_name, file_id=id,   #       Or first find the ID's predecessor.
+                              requester=msg.requester, request_id=msg.request_id, hops=msg.hops + 1)
             self.queues[self.closest_preceding_finger(id)].put(new_msg)                                 #       Send the message along.  It will come back and invoke a different function.
 
     def forward_get(self, msg):             # You received a GET_REQUEST a while ago.  The ID doesn't belong to you, but by now you've identified which node is responsible for it.
-        new_msg = msg.copy()                # Copy the message.  It contains the file_name.
-        new_msg.type = 'GET_REQUEST'        # Change the message type.  You're forwarding the GET_REQUEST that you received earlier.
-        new_msg.sender_id = self.id         # Set yourself as the most recent sender.
-        self.queues[msg.node].put(new_msg)  # Send the message along.
+        msg.type = GET_REQUEST              # Reuse the message.  It contains the file_name.  You're forwarding the GET_REQUEST that you received earlier.
+        msg.sender_id = self.id             # Set yourself as the most recent sender.
+        msg.hops += 1
+        self.queues[msg.node].put(msg)      # Send the message along.
 
 
     # Writes data to the DHT under hash(file_name)
     def set(self, msg):
-        id = hash(msg.file_name)                                                                                                # Hash the filename
+        id = msg.file_id                                                                                                        # Hash the filename, unless a node before you already did
+        if id is None:
+            id = msg.file_id = hash(msg.file_name, self.hash_bits)
         if mod_between(id, self.predecessor + 1, self.id):                                                                      # Check if the ID falls in your partition...
             self.hash_table[id] = msg.file_data                                                                                 #       It does.  Store it locally.
-            print('Node ' + str(self.id) + ' performed SET on ' + str(msg.file_name) + ' (Hashes to ' + str(id) + ') setting value: ' + str(self.hash_table[id]))
+            if len(self.successors) > 0:
+                self.replicate([(id, None, msg.file_data)])                                                                     #       And on your replicas.
+            self.metrics.hops.observe(msg.hops)
+            self.log.info('performed SET on %s (Hashes to %s) setting value: %s', msg.file_name, id, msg.file_data)
+            if msg.request_id is not None:                                                                                      #       Let a client know it's done.
+                self.queues[msg.requester].put(Message(SET_RESULT, self.id, file_name=msg.file_name, file_id=id, node=self.predecessor, request_id=msg.request_id))
+        elif self.send_to_cached_owner(msg, id):                                                                                #       It doesn't.  If you've looked up its range before, it's already been sent to the owner.
+            return
+        elif self.config.recursive_lookup or mod_between(id, self.id + 1, self.successor()):
+            self.route(msg, id)                                                                                                 #       Otherwise pass the request itself towards the owner.  If that's your successor, it goes straight there.
         else:
-            new_msg = Message('FIND_PRED', self.id, mode='SET', file_name=msg.file_name, file_id=id, file_data=msg.file_data)   #       It doesn't.  First step is to find the ID's predecessor.
+            new_msg = Message(FIND_PRED, self.id, mode=MODE_SET, file_name=msg.file_name, file_id=id, file_data=msg.file_data, #       Or first find the ID's predecessor.
+                              requester=msg.requester, request_id=msg.request_id, hops=msg.hops + 1)
             self.queues[self.closest_preceding_finger(id)].put(new_msg)                                                         #       Send the message along.  It will come back and invoke a find_successor.
 
 
     def forward_set(self, msg):             # You received a SET_REQUEST a while ago.  The ID doesn't belong to you, but by now you've identified which node is responsible for it.
-        new_msg = msg.copy()                # Copy the message.  It contains the file_name and file_data.
-        new_msg.type = 'SET_REQUEST'        # Change the message type.  You're forwarding the SET_REQUEST that you received earlier.
-        new_msg.sender_id = self.id         # Set yourself as the most recent sender.
-        self.queues[msg.node].put(new_msg)  # Send the message along.
+        msg.type = SET_REQUEST              # Reuse the message.  It contains the file_name and file_data.  You're forwarding the SET_REQUEST that you received earlier.
+        msg.sender_id = self.id             # Set yourself as the most recent sender.
+        msg.hops += 1
+        self.queues[msg.node].put(msg)      # Send the message along.
+
+
+    def send_to_cached_owner(self, msg, id):                        # Sends the request straight to the owner of <id> if it's in your route cache.  Returns whether it did.
+        if msg.shortcut:
+            return False
+        owner = self.route_cache.lookup(id)
+        if owner is None or owner == self.id or not self.node_exists(owner):
+            return False
+        msg.sender_id = self.id
+        msg.hops += 1
+        msg.shortcut = True
+        self.queues[owner].put(msg)
+        return True
+
+
+    def route(self, msg, id):                                       # Recursive lookups: send the request one hop closer to the node that owns <id>.
+        msg.sender_id = self.id                                     # Set yourself as the most recent sender.
+        msg.hops += 1
+        succ = self.successor()
+        if mod_between(id, self.id + 1, succ):                      # Your successor owns it.  It gets the request directly.
+            self.queues[succ].put(msg)
+        else:
+            self.queues[self.closest_preceding_finger(id)].put(msg) # Otherwise send it as far around the circle as your fingers allow without passing the ID.
+
+
+    def multi_request(self, msg):                                   # A batch of keys to GET or SET.  Keep the ones you own and split the rest up by the next hop they need.
+        size = self.ring_size
+        pred = self.predecessor
+        succ = self.successor()
+        succ_dist = (succ - self.id) % size or size                 # Anything this far around the circle or less belongs to your successor.
+        next_hops = {}                                              # The distance to each live finger, mapped to the finger's node
+        for f in self.finger_table:
+            d = (f.node - self.id) % size
+            if d != 0 and d not in next_hops and self.node_exists(f.node):
+                next_hops[d] = f.node
+        dists = sorted(next_hops)
+        local = []
+        batches = {}                                                # Next hop -> the items that go through it
+        for item in msg.items:
+            id = item[0]
+            if id is None:                                          # Nobody has hashed this one yet
+                id = hash(item[1], self.hash_bits)
+                item = (id, item[1], item[2])
+            if mod_between(id, pred + 1, self.id):                  # It's yours.
+                local.append(item)
+                continue
+            d = (id - self.id) % size
+            if d <= succ_dist:                                      # It's your successor's.
+                dest = succ
+            else:                                                   # Otherwise it goes to the furthest finger that doesn't pass it.  Same as closest_preceding_finger, for many keys at once.
+                dest = next_hops[dists[bisect.bisect_left(dists, d) - 1]]
+            if dest in batches:
+                batches[dest].append(item)
+            else:
+                batches[dest] = [item]
+        for dest in batches:                                        # One message per next hop, however many keys it carries.
+            new_msg = Message(msg.type, msg.orig_sender_id, items=batches[dest], requester=msg.requester, request_id=msg.request_id, hops=msg.hops + 1)
+            new_msg.sender_id = self.id
+            self.queues[dest].put(new_msg)
+        if len(local) == 0:
+            return
+        if msg.type == MULTI_SET:
+            for item in local:
+                self.hash_table[item[0]] = item[2]
+            if len(self.successors) > 0:
+                self.replicate(local)
+            self.log.info('performed MULTI_SET on %s keys', len(local))
+            if msg.request_id is not None:                          # Tell a client how many of its keys are done.
+                self.queues[msg.requester].put(Message(MULTI_SET_RESULT, self.id, file_data=len(local), node=pred, request_id=msg.request_id))
+        else:
+            local = [(item[0], item[1], self.hash_table.get(item[0])) for item in local]
+            self.log.info('performed MULTI_GET on %s keys', len(local))
+            self.queues[msg.requester].put(Message(MULTI_GET_RESULT, self.id, items=local, node=pred, request_id=msg.request_id))  # Everything you own goes back to the requester in one reply.
 
 
     def find_successor(self, msg):                      # Your request to find the ID's predecessor has come back.  Now it's time to get the ID of it's successor.
         sender_id = msg.sender_id                       # Copy the sender ID so you don't lose it.
-        new_msg = msg.copy()                            # Copy the message.  It contains all the data needed to process this request, so it must be maintained.
-        new_msg.sender_id = self.id                     # Set yourself as the most recent sender (but leave orig_sender_id alone.  It was you, but seriously, don't touch it).
-        new_msg.type = 'FIND_SUCC'                      # Change the message type.  You're asking for a successor now.
-        self.queues[sender_id].put(new_msg)             # Send the message back to the ID's predecessor.
+        if not self.node_exists(sender_id):             # It left since it answered.  Start over.
+            if msg.mode == MODE_FINGER:
+                self.repairs.pop(msg.finger_num, None)
+                self.stale.add(msg.finger_num)
+            else:
+                msg.type = GET_REQUEST if msg.mode == MODE_GET else SET_REQUEST
+                self.HANDLERS[msg.type](self, msg)
+            return
+        msg.hops += 1
+        msg.sender_id = self.id                         # Reuse the message, it has everything this request needs.  Set yourself as the most recent sender (but leave orig_sender_id alone.  It was you, but seriously, don't touch it).
+        msg.type = FIND_SUCC                            # Change the message type.  You're asking for a successor now.
+        self.queues[sender_id].put(msg)                 # Send the message back to the ID's predecessor.
 
     def remote_find_successor(self, msg):               # You've received a request for the ID of your successor
-        new_msg = msg.copy()                            # Copy the message.  It contains all the data needed to process this request, so it must be maintained.
-        new_msg.sender_id = self.id                     # Set yourself as the most recent sender (but leave orig_sender_id alone).
-        new_msg.type = 'FIND_SUCC_RESULT'               # Change the message type to a result.
-        new_msg.node = self.finger_table[0].node        # Add your successor's ID to the message.
-        self.queues[msg.orig_sender_id].put(new_msg)    # Return it to the original sender.
+        msg.sender_id = self.id                         # Reuse the message.  Set yourself as the most recent sender (but leave orig_sender_id alone).
+        msg.hops += 1
+        msg.type = FIND_SUCC_RESULT                     # Change the message type to a result.
+        msg.node = self.successor()                     # Add your successor's ID to the message.
+        if msg.mode == MODE_INIT and msg.node == msg.orig_sender_id:   # It's your successor restarting under its old ID.  Its successor is further on.
+            msg.node = self.id                          # Give it the nearest node past it that you know of.  If that's wrong, stabalizing will correct it.
+            for f in self.finger_table:
+                if f.node != msg.orig_sender_id and f.node != self.id and self.node_exists(f.node):
+                    msg.node = f.node
+                    break
+        if self.node_exists(msg.orig_sender_id):
+            self.queues[msg.orig_sender_id].put(msg)    # Return it to the original sender.  Unless it has left, and nobody's waiting.
 
 
     def remote_find_predecessor(self, msg):                                         # You've received a request to find the predecessor of an ID.
-        new_msg = msg.copy()                                                        # Copy the message.  It contains all the data needed to process this request, so it must be maintained.
-        new_msg.sender_id = self.id                                                 # Set yourself as the most recent sender (but leave orig_sender_id alone).
-        if mod_between(msg.file_id, self.id + 1, self.finger_table[0].node):        # If this node is the predecessor...
-            new_msg.type = 'FIND_PRED_RESULT'                                       #       Change the message type to a result.
-            new_msg.node = self.id                                                  #       Add your ID to the message.
-            self.queues[msg.orig_sender_id].put(new_msg)                            #       Return it to the original sender.
-        else:                                                                       # If this node is NOT the predecessor...
-            self.queues[self.closest_preceding_finger(msg.file_id)].put(new_msg)    #       Pass the message along to the closest preceding finger to the ID in the message.
+        msg.sender_id = self.id                                                     # Reuse the message.  Set yourself as the most recent sender (but leave orig_sender_id alone).
+        msg.hops += 1
+        if mod_between(msg.file_id, self.id + 1, self.successor()):                 # If this node is the predecessor...
+            msg.type = FIND_PRED_RESULT                                             #       Change the message type to a result.
+            msg.node = self.id                                                      #       Add your ID to the message.
+            if self.node_exists(msg.orig_sender_id):
+                self.queues[msg.orig_sender_id].put(msg)                            #       Return it to the original sender, if it's still there.
+            return
+        owner = None if msg.shortcut else self.route_cache.lookup(msg.file_id)     # If this node is NOT the predecessor...
+        pred = self.route_cache.ranges[owner] if owner is not None else None
+        if pred is not None and pred != self.id and self.node_exists(pred):         #       Skip to the predecessor if you've looked up this range before.
+            msg.shortcut = True
+            self.queues[pred].put(msg)
+        else:
+            self.queues[self.closest_preceding_finger(msg.file_id)].put(msg)        #       Otherwise pass the message along to the closest preceding finger to the ID in the message.
 
 
     def closest_preceding_finger(self, id):
+        lb = (self.id + 1) % self.ring_size                                         # Fingers strictly between me and the ID are behind it.
+        ub = (id - 1) % self.ring_size
+        if id == lb:                                                                # The ID is right after me.  Nothing sits between us, so no finger is behind it.
+            return self.id
         for f in reversed(self.finger_table):                                       # Go through my finger table, starting with the furthest finger.
-            if mod_between(f.node, self.id + 1, id) and self.node_exists(f.node):   # Check if the node this finger points to is behind the ID I'm looking for.
+            if mod_between(f.node, lb, ub) and self.node_exists(f.node):            # Check if the node this finger points to is behind the ID I'm looking for.  A node sitting exactly on the ID is not behind it.
                 return f.node                                                       # If so, send to this node.
         return self.id                                                              # If none of my fingers are behind it, then it must be me.  This should never happen.
 
 
     def node_exists(self, id):                                                                                              # Check if the node is still in the network
-        if id in self.queues.keys():                                                                                        # It's queue still exists, so it is.
+        if id in self.queues:                                                                                               # It's queue still exists, so it is.
             return True
         else:                                                                                                               # It's queue does not exist.  He's gone.
-            print('Node: ' + str(self.id) + ' could not send message to ' + str(id) + ' because there was no queue for it')
-            self.update_required = True                                                                                     # I'll update my fingers so it doesn't happen again next time.
+            self.log.warning('could not send message to %s because there was no queue for it', id)
+            self.route_cache.forget(id)                                                                                     # Don't send it any more lookups either.
+            self.vanished.add(id)
+            self.update_required = True                                                                                     # I'll update the fingers pointing at it so it doesn't happen again next time.
             return False
 
 
     def stabalize(self):                                                                                    # I need to make sure that my neighbours are pointing at me.
-        if self.id != self.finger_table[0].node:                                                            # If I'm not my own successor... (only node in the network)
-            self.queues[self.finger_table[0].node].put(Message('SUCC_STABALIZE', self.id, node=self.id))    #       Tell my successor to check if I'm its predecessor.
-        if self.id != self.predecessor:                                                                     # If I'm not my own predecessor... (only node in the network)
-            self.queues[self.predecessor].put(Message('PRED_STABALIZE', self.id, node=self.id))             #       Tell my predecessor to check if I'm its successor.
+        succ = self.successor()
+        if self.id != succ and succ in self.queues:                                                         # If I'm not my own successor... (only node in the network)
+            self.queues[succ].put(Message(SUCC_STABALIZE, self.id, node=self.id))                          #       Tell my successor to check if I'm its predecessor.
+        if self.id != self.predecessor and self.predecessor in self.queues:                                 # If I'm not my own predecessor... (only node in the network)
+            self.queues[self.predecessor].put(Message(PRED_STABALIZE, self.id, node=self.id))             #       Tell my predecessor to check if I'm its successor.
 
     def succ_stabalize(self, msg):                                                                          # A new node thinks its my predecessor.  Check if it's right.
-        if self.id == self.predecessor or mod_between(msg.node, self.predecessor, self.id):                 # It was right.
+        if msg.node not in self.queues:     # It has left since it sent this
+            return
+        self.route_cache.forget_containing(msg.node)                                                        # Whichever cached range it landed in has been split.
+        if self.id == self.predecessor or mod_between(msg.node, self.predecessor, self.id) or self.predecessor not in self.queues:    # It was right, or my predecessor vanished and it's the next one back.
+            old = self.predecessor
             self.predecessor = msg.node                                                                     #       Update my predecessor.
+            if old != self.id and old != msg.node and old in self.queues:                                   #       The old one is still there, behind the new one.  Its successor is the new one, or closer.
+                self.queues[old].put(Message(SET_SUCCESSOR, self.id, node=msg.node))
+            if self.config.replicas > 0:
+                self.promote_replicas()                                                                     #       If my range grew, my copies of it are mine now.
+                self.send_successors()                                                                      #       It keeps copies of its keys on the nodes after it.  Tell it who they are.
+            self.send_partition_data()                                                                      #       If it joined inside my range, it gets its share of my keys.
         else:                                                                                               # It was wrong.
-            self.queues[msg.orig_sender_id].put(Message('SET_SUCCESSOR', self.id, node=self.predecessor))   #       Tell it that it's actually the predecessor of the node behind me.
+            self.queues[msg.orig_sender_id].put(Message(SET_SUCCESSOR, self.id, node=self.predecessor))   #       Tell it that it's actually the predecessor of the node behind me.
 
 
     def pred_stabalize(self, msg):                                                                                      # A new node thinks its my successor.  Check if it's right.
+        if msg.node not in self.queues:     # It has left since it sent this
+            return
+        self.route_cache.forget_containing(msg.node)                                                                    # Whichever cached range it landed in has been split.
         if self.id == self.finger_table[0].node or mod_between(msg.node, self.id, self.finger_table[0].node):           # It was right.
             self.finger_table[0].node = msg.node                                                                        #       Update my successor.
+            if self.config.replicas > 0:
+                self.update_successors([msg.node] + self.successors)                                                    #       It goes at the front of my successor list until it sends me its own.
         else:                                                                                                           # It was wrong.
-            self.queues[msg.orig_sender_id].put(Message('SET_PREDECESSOR', self.id, node=self.finger_table[0].node))    #       Tell it that it's actually the successor of the node in front of me.
+            self.queues[msg.orig_sender_id].put(Message(SET_PREDECESSOR, self.id, node=self.finger_table[0].node))    #       Tell it that it's actually the successor of the node in front of me.
 
 
     def set_successor(self, msg):
+        self.acknowledge(msg)
+        succ = self.finger_table[0].node
+        if msg.node == succ:                    # Already knew.
+            return
+        if succ in self.queues and not mod_between(msg.sender_id, self.id + 1, succ):  # It isn't my successor, or between us, so it knows less than I do.  A leaving node that has lost its
+            return                                                                      # predecessor tells the nearest node behind it that it knows of, which may not be right behind it.
         self.finger_table[0].node = msg.node    # My successor left, but he told me who my new successor is.
+        self.route_cache.forget(msg.sender_id)  # The node that sent this is leaving (or was wrong about where it belonged).
+        correcting = mod_between(msg.node, self.id + 1, msg.sender_id)  # The new one is between us, so it's a correction.  Otherwise the sender is leaving.
+        if self.config.replicas > 0:
+            self.update_successors([msg.node] + [s for s in self.successors if s != msg.sender_id or correcting])
+        if correcting and msg.node in self.queues:  # It was correcting me, so my new successor doesn't know about me yet.
+            self.queues[msg.node].put(Message(SUCC_STABALIZE, self.id, node=self.id))
 
 
     def set_predecessor(self, msg):
+        pred = self.predecessor
+        if pred != self.id and pred in self.queues and msg.sender_id != pred:                           # It isn't my predecessor.  It may be out of date: someone may have joined in front of me
+            if not mod_between(msg.sender_id, pred, self.id) or mod_between(msg.node, pred + 1, self.id - 1):  # since it thought it was, or it may be leaving and only know of a node
+                return                                                                                  # behind me that has left too.  Only my predecessor can shrink my range.
         self.predecessor = msg.node     # My predecessor left, but he told me who my new predecessor is.
+        self.route_cache.forget(msg.sender_id)
+        handoff = self.handoffs.get(msg.sender_id)
+        if handoff is not None:         # I was still handing it its keys.  They're mine again.  If it's still there, it passes on what it got.
+            self.take_back(handoff, unsent_only=msg.sender_id in self.queues)
+        if self.config.replicas > 0:
+            self.promote_replicas()     # I already have copies of its keys.  They're mine now.
+            self.send_successors()
+
+
+    def successor(self):                                            # Your successor.  If it vanished without leaving, the next live node on your successor list (or your fingers) takes its place.
+        succ = self.finger_table[0].node                            # If they've all gone too, the nearest of the nodes that route through you, or your predecessor.
+        if succ != self.id and succ not in self.queues:
+            behind = sorted(list(self.referrers) + [self.predecessor], key=lambda s: (s - self.id) % self.ring_size)
+            for s in self.successors + [f.node for f in self.finger_table] + behind:
+                if s != succ and s != self.id and s in self.queues:
+                    self.log.warning('successor %s has vanished.  Failing over to %s', succ, s)
+                    self.finger_table[0].node = s
+                    self.route_cache.forget(succ)
+                    self.vanished.add(succ)
+                    self.update_required = True                     # Fingers might point at it too
+                    if self.config.replicas > 0:
+                        self.update_successors(self.successors[self.successors.index(s):] if s in self.successors else [s])
+                    self.queues[s].put(Message(SUCC_STABALIZE, self.id, node=self.id))    # Tell it you're its predecessor now.  If it has copies of the lost keys, they're its own.
+                    break
+        return self.finger_table[0].node
+
+
+    def send_successors(self):                                      # Tell your predecessor who comes after you, so it can keep its successor list.
+        if self.predecessor != self.id and self.predecessor in self.queues:
+            self.queues[self.predecessor].put(Message(SUCC_LIST, self.id, file_data=self.successors[:self.config.replicas - 1]))
+
+
+    def successor_list(self, msg):                                  # Your successor sent its successor list.  Yours is your successor followed by its list.
+        if msg.sender_id == self.finger_table[0].node:              # Ignore it if your successor has changed since.
+            self.update_successors([msg.sender_id] + msg.file_data)
+
+
+    def update_successors(self, succs):                             # Replace your successor list, copying your keys to new replicas and releasing old ones
+        new = []
+        for s in succs:
+            if s == self.id:                                        # Gone all the way round a small ring
+                break
+            if s not in new:
+                new.append(s)
+            if len(new) == self.config.replicas:
+                break
+        if new == self.successors:
+            return
+        old = self.successors
+        self.successors = new
+        for s in old:
+            if s not in new and s in self.queues:
+                self.queues[s].put(Message(DROP_REPLICAS, self.id))
+        items = None
+        for s in new:
+            if s not in old and s in self.queues:
+                if items is None:
+                    items = [(id, None, file_data) for id, file_data in self.hash_table.items()]
+                self.send_replicas(s, items)
+        self.send_successors()                                      # Your predecessor's list is built from yours
+
+
+    def replicate(self, items):                                     # Copy (file_id, file_name, file_data) <items> to every node on your successor list
+        for s in self.successors:
+            if s in self.queues:
+                self.send_replicas(s, items)
+
+
+    def send_replicas(self, dest, items):                           # Copy <items> to <dest> a chunk at a time.  Always sends at least one message, so an empty list still tells it your range.
+        handoff = Handoff(dest, items)
+        self.send_chunk(dest, handoff, ack=False, type=REPLICATE)
+        while handoff.next < len(items):
+            self.send_chunk(dest, handoff, ack=False, type=REPLICATE)
+
+
+    def store_replicas(self, msg):                                  # A predecessor sent copies of its keys.  msg.node is its predecessor, so it owns (msg.node, sender].
+        replica = self.replicas.get(msg.sender_id)
+        if replica is None:
+            replica = self.replicas[msg.sender_id] = Replica(msg.sender_id, msg.node)
+        elif replica.pred != msg.node:                              # Its range has changed.  Drop whatever is outside it now.
+            replica.pred = msg.node
+            if msg.node != msg.sender_id:
+                replica.store.pop_range(msg.sender_id, msg.node)
+        replica.store.update((item[0], item[2]) for item in msg.items)
+        for owner in [o for o in self.replicas if o != msg.sender_id and o not in self.queues and mod_between(o, msg.node + 1, msg.sender_id)]:
+            del self.replicas[owner]                                # The sender has taken over the range of an owner that has gone.  That copy is out of date.
+
+
+    def drop_replicas(self, msg):                                   # You're no longer on the sender's successor list
+        self.replicas.pop(msg.sender_id, None)
+
+
+    def promote_replicas(self):                                     # Your range has grown over nodes that left or vanished.  Your copies of their keys become the real thing.
+        items = []
+        for owner in list(self.replicas):
+            if owner != self.id and mod_between(owner, self.predecessor + 1, self.id):     # Only the keys in your range.  A copy can hold keys its owner has since handed on.
+                items.extend((id, None, file_data) for id, file_data in self.replicas.pop(owner).store.items() if mod_between(id, self.predecessor + 1, self.id))
+        if len(items) > 0:
+            self.log.info('took over %s keys from replicas', len(items))
+            self.hash_table.update((item[0], item[2]) for item in items)
+            self.replicate(items)
+
+
+    def read_replica(self, msg, id):                                # Answer a GET from a copy of its owner's keys.  Returns whether you dealt with it.
+        for replica in self.replicas.values():
+            if mod_between(id, replica.pred + 1, replica.owner):
+                if id in replica.store or msg.sender_id == replica.owner:   # The owner sends its copies before it passes on a GET, so if it sent this, what you have is current.
+                    self.metrics.hops.observe(msg.hops)
+                    self.queues[msg.requester].put(Message(GET_RESULT, self.id, file_name=msg.file_name, file_id=id, file_data=replica.store.get(id),
+                                                           request_id=msg.request_id))     # No range in the reply.  The client should keep going to the owner.
+                    return True
+                if not msg.shortcut and replica.owner in self.queues:   # Not copied here yet.  Ask the owner.
+                    msg.sender_id = self.id
+                    msg.hops += 1
+                    msg.shortcut = True
+                    self.queues[replica.owner].put(msg)
+                    return True
+                return False
+        return False
+
+
+    def spill(self, msg):                                           # If your mailbox is deep, pass a GET you own to the replica with the shortest one.  Returns whether you did.
+        depth = self.mailbox.qsize() if self.mailbox is not None else 0
+        if depth <= self.config.read_spill:
+            return False
+        best = None
+        for s in self.successors:
+            q = self.queues.get(s)
+            if q is not None and q.qsize() < depth:
+                best = s
+                depth = q.qsize()
+        if best is None:
+            return False
+        msg.sender_id = self.id
+        msg.hops += 1
+        msg.shortcut = True                                         # It stops at the replica.  Nobody passes it back.
+        self.queues[best].put(msg)
+        return True
 
 
     def report(self):                                               # Used for testing, nothing to see here.
@@ -315,369 +914,486 @@ class ChordNode(threading.Thread):
         print('Predecessor: ' + str(self.predecessor))
         for f in range(0, len(self.finger_table)):
             print('Finger ' + str(f) + ': starts at ' + str(self.finger_table[f].start) + ' and points at Node ' + str(self.finger_table[f].node))
+        if len(self.successors) > 0:
+            print('Successors: ' + ', '.join(str(s) for s in self.successors) + '  Replicas kept for: ' + ', '.join(str(o) for o in self.replicas))
+        cache = self.route_cache
+        if cache.hits + cache.misses > 0:
+            print('Route cache: ' + str(cache.hits) + ' hits, ' + str(cache.misses) + ' misses (' + str(round(100.0 * cache.hits / (cache.hits + cache.misses), 1)) + '% hit rate)')
+        if self.metrics.hops.count > 0:
+            print('Requests served: ' + str(self.metrics.hops.count) + ', mean hops: ' + str(round(self.metrics.hops.mean(), 2)))
         print('Local Hash Table Contents:')
-        for id in list(self.hash_table.keys()):
-            print(str(id) + '\t= ' + str(self.hash_table[id]))
+        for id, file_data in self.hash_table.range_items(self.predecessor, self.predecessor):   # In ring order, starting after your predecessor
+            print(str(id) + '\t= ' + str(file_data))
 
 
     def update_finger(self, msg):
-        if TEST == 3:   # Only print during test 3.  Too much clutter.
-            print('Node: ' + str(self.id) + ' updating finger ' + str(msg.finger_num) + ' (start = ' + str(msg.file_id) + ') to point at node: ' + str(msg.node))
-        self.finger_table[msg.finger_num].node = msg.node   # Your finger update request came back.  Update your finger with the node in the message.
+        self.log.debug('updating finger %s (start = %s) to point at node: %s', msg.finger_num, msg.file_id, msg.node)  # Too much clutter for anything above DEBUG
+        i = msg.finger_num
+        start = self.finger_table[i].start
+        self.repairs.pop(i, None)
+        while True:                                             # Your finger update request came back.  Update your finger with the node in the message.
+            if self.finger_table[i].node != msg.node:
+                self.metrics.finger_repairs += 1
+            self.finger_table[i].node = msg.node
+            self.stale.discard(i)
+            i += 1
+            if i == len(self.finger_table) or not mod_between(self.finger_table[i].start, start, msg.node):
+                break
+            self.repairs.pop(i, None)                           # There are no nodes between the start and the node, so the next fingers that start in there point at it too.
+        if i in self.stale:                                     # The next finger was waiting on this answer.  It's a different node, so it needs a lookup of its own.
+            self.update_required = True
 
 
-    def ask_for_fingers(self):
-        if TEST == 3:   # Only print during test 3.  Too much clutter.
-            print('Node ' + str(self.id) + ' is asking for finger updates')
-        for i in range(1, len(self.finger_table)):                                                                                                          # For all of your fingers...
-            if mod_between(self.finger_table[i].start, self.id, self.finger_table[0].node):                                                                 # Check if it should point to your successor.
-                self.finger_table[i].node = self.finger_table[0].node                                                                                       #       It should point at my successor.  No need to ask questions.
+    def ask_for_fingers(self):                                  # Re-resolve the fingers that need it: the ones pointing at nodes that have gone, and any marked stale.
+        self.log.debug('is asking for finger updates')
+        succ = self.successor()                                 # Fail over first if your successor is the node that vanished.
+        if succ not in self.queues:                             # Everyone you know of has gone.  There's nobody to ask.
+            return
+        if len(self.vanished) > 0:
+            for i in range(1, len(self.finger_table)):
+                f = self.finger_table[i]
+                if f.node in self.vanished:
+                    f.node = self.next_live(f.node)             # Point it somewhere live until the answer comes back, so nobody else trips over it.
+                    self.stale.add(i)
+            self.vanished.clear()
+        for i in range(1, len(self.finger_table)):              # Fingers that start before your successor should point at it.  No need to ask questions.
+            f = self.finger_table[i]
+            if not mod_between(f.start, self.id, succ):         # The rest start further round
+                break
+            f.node = succ
+            self.stale.discard(i)
+            self.repairs.pop(i, None)
+        asked = 0
+        for i in sorted(self.stale):                            # Lowest first, so the fingers after one know whether to wait for it.
+            f = self.finger_table[i]
+            if i in self.repairs:                             # Already asked about.  Wait for the answer instead of asking again.
+                pass
+            elif i - 1 in self.repairs or i - 1 in self.stale:  # The finger before it is being looked up, or waiting.  Its answer probably covers this one too.
+                continue
             else:
-                self.queues[self.finger_table[0].node].put(Message('FIND_PRED', self.id, mode='FINGER', finger_num=i, file_id=self.finger_table[i].start))  #       It is not my successor.  Send a message out to find it.
-        self.update_required = False                                                                                                                        # Gotta reset that flag or we'll come striaght back here.
+                self.queues[succ].put(Message(FIND_PRED, self.id, mode=MODE_FINGER, finger_num=i, file_id=f.start))   # Send a message out to find it.
+                self.repairs[i] = self.rounds
+                asked += 1
+            self.stale.discard(i)
+        if asked > 0:
+            self.metrics.finger_refreshes += 1
+            self.metrics.finger_lookups += asked
+        self.update_required = False                            # Gotta reset that flag or we'll come striaght back here.
+
+
+    def next_live(self, id):                                    # The nearest node you know of past <id> that's still there.  A gone finger points here until it's repaired.
+        size = self.ring_size
+        dist = (id - self.id) % size
+        best = None
+        best_dist = size
+        for s in self.successors + [f.node for f in self.finger_table]:
+            d = (s - self.id) % size
+            if dist < d < best_dist and s in self.queues:
+                best = s
+                best_dist = d
+        return best if best is not None else self.finger_table[0].node
+
+
+    def fix_fingers(self, budget):                              # Mark the next <budget> fingers past your successor for re-resolving.  Successive rounds go round the whole table.
+        succ = self.successor()
+        n = len(self.finger_table)
+        for k in range(1, n):
+            if budget == 0:
+                break
+            i = self.next_finger
+            self.next_finger = i % (n - 1) + 1
+            if i not in self.repairs and not mod_between(self.finger_table[i].start, self.id, succ):
+                self.stale.add(i)
+                budget -= 1
+        self.update_required = True
+
+
+    def maintain(self, msg):                                    # A maintenance round.  Make sure your neighbours point at you, and re-resolve a few fingers.
+        self.rounds += 1
+        if not self.joined:
+            self.retry_join()
+            return
+        for i in [i for i in self.repairs if self.repairs[i] < self.rounds - 1]:   # Still no answer after a whole round.  The lookup was lost with a node that went.
+            del self.repairs[i]
+            self.stale.add(i)
+        for key in list(self.gathers):                          # A broadcast waiting on a node that has gone will never hear from it.  Stop waiting.
+            gather = self.gathers[key]
+            gather.waiting = set(id for id in gather.waiting if id in self.queues)
+            if len(gather.waiting) == 0:
+                self.finish_gather(key)
+        self.drop_gone_handoffs()                               # The same goes for a handoff.  Nobody will acknowledge the rest.
+        if self.leaving:                                        # Nothing to maintain.  Just wait for the acks.
+            return
+        self.stabalize()
+        self.fix_fingers(self.config.finger_budget)
+
+
+    def node_left(self, msg):                                   # A node you route through has left.  Its successor, msg.node, has its range now.
+        self.route_cache.forget(msg.sender_id)
+        for i in range(1, len(self.finger_table)):              # Your successor pointer is SET_SUCCESSOR's job
+            if self.finger_table[i].node == msg.sender_id:
+                self.finger_table[i].node = msg.node
+                self.metrics.finger_repairs += 1
+
+
+    def broadcast(self, msg):                                   # A ring-wide query.  Answer for yourself, and pass it on to cover (you, msg.file_id).  A client sends it with no file_id, meaning the whole ring.
+        limit = msg.file_id if msg.file_id is not None else self.id
+        key = (msg.requester, msg.request_id)
+        local, combine = QUERIES[msg.file_name]
+        value = local(self, msg.file_data)
+        children = []
+        for f in self.finger_table:                             # Each distinct finger inside the interval takes the part of it up to the next one.  Every node gets it exactly once,
+            if f.node != self.id and f.node != limit and (limit == self.id or mod_between(f.node, self.id, limit)) and f.node not in children and self.node_exists(f.node):
+                children.append(f.node)                         # and the tree is as deep as a lookup is long.
+        for i in range(0, len(children)):
+            end = children[i + 1] if i + 1 < len(children) else limit
+            self.queues[children[i]].put(Message(BROADCAST, self.id, file_name=msg.file_name, file_data=msg.file_data, file_id=end, requester=msg.requester, request_id=msg.request_id, hops=msg.hops + 1))
+        self.gathers[key] = Gather(msg.sender_id, msg.file_name, value, set(children))
+        if len(children) == 0:                                  # A leaf.  Answer straight away.
+            self.finish_gather(key)
+
+    def broadcast_result(self, msg):                            # A node you passed a broadcast to has answered for itself and everything it passed it on to
+        gather = self.gathers.get((msg.requester, msg.request_id))
+        if gather is None or msg.sender_id not in gather.waiting:   # Too late.  You've already answered without it.
+            return
+        gather.value = QUERIES[gather.query][1](gather.value, msg.file_data)
+        gather.waiting.discard(msg.sender_id)
+        if len(gather.waiting) == 0:
+            self.finish_gather((msg.requester, msg.request_id))
+
+    def finish_gather(self, key):                               # Send the combined answer back the way the broadcast came
+        gather = self.gathers.pop(key)
+        if gather.parent in self.queues:
+            self.queues[gather.parent].put(Message(BROADCAST_RESULT, self.id, file_name=gather.query, file_data=gather.value, requester=key[0], request_id=key[1]))
 
 
-    def send_partition_data(self, msg):
-        for id in list(self.hash_table.keys()):                                                                                         # Send your data to your new predecessor.
-            if not mod_between(id, self.predecessor + 1, self.id):                                                                      # Only send the data that falls in their partition.
-                self.queues[msg.orig_sender_id].put(Message('DATA_TRANSFER', self.id, file_id=id, file_data=self.hash_table[id]))       # Send the data.
-                self.hash_table.pop(id, None)                                                                                           # Delete your copy.  Gotta let it fly.
+    def send_partition_data(self, msg=None):                                            # Send your data to your predecessor.  Only the data that falls outside your partition, (pred, id].
+        dest = self.predecessor                                                         # Done whenever a node joins in front of you, or asks.
+        if dest == self.id or dest not in self.queues:
+            return
+        items = [(id, None, file_data) for id, file_data in
+                 self.hash_table.pop_range(self.id, self.predecessor)]                  # Delete your copy.  Gotta let it fly.
+        if len(items) == 0:
+            return
+        if len(self.successors) > 0:
+            self.replicate([])                                                          # Your replicas should let go of it too.
+        self.hand_over(dest, items)
+
+
+    def hand_over(self, dest, items):                                                   # Send <items> to <dest> in acknowledged chunks.
+        handoff = self.handoffs.get(dest)
+        if handoff is not None:                                                         # Already sending them some.  Add this to the end.
+            handoff.items.extend(items)
+        else:
+            handoff = self.handoffs[dest] = Handoff(dest, items)
+        self.send_chunks(handoff)
+
+
+    def send_chunks(self, handoff):                                                     # Send chunks of a handoff until the window is full or there's nothing left.  A leaving node sends it all now,
+        while (self.leaving or len(handoff.unacked) < self.config.transfer_window) and handoff.next < len(handoff.items):   # so the requests it passes on arrive after it.
+            self.send_chunk(handoff.dest, handoff, ack=True)
+        if len(handoff.unacked) == 0:                                                   # Everything has been acknowledged
+            del self.handoffs[handoff.dest]
+
+
+    def send_chunk(self, dest, handoff, ack, type=DATA_TRANSFER):                      # Send the next chunk of <handoff> to <dest>.  Ask for a DATA_ACK if <ack>.
+        items = handoff.items
+        start = handoff.next
+        end = min(start + self.config.transfer_chunk, len(items))
+        size = 0
+        for i in range(start, end):
+            size += data_size(items[i][2])
+            if size >= self.config.transfer_bytes:                                      # Big values.  Cut the chunk short, but always send at least one.
+                end = i + 1
+                break
+        handoff.next = end
+        if ack:
+            handoff.sent += 1
+            handoff.unacked[handoff.sent] = (start, end)
+        self.queues[dest].put(Message(type, self.id, items=items[start:end], node=self.predecessor if type == REPLICATE else None, request_id=handoff.sent if ack else None))
+
+
+    def data_ack(self, msg):                                                            # The node you're handing data to has stored a chunk.  Send another.
+        handoff = self.handoffs.get(msg.sender_id)
+        if handoff is None:
+            return
+        handoff.unacked.pop(msg.request_id, None)
+        if self.node_exists(handoff.dest):
+            self.send_chunks(handoff)
+        else:                                                                           # It left before you finished.
+            self.take_back(handoff)
+        if self.leaving and len(self.handoffs) == 0:                                    # That was the last of it.  You can go.
+            self.depart()
+
+
+    def take_back(self, handoff, unsent_only=False):                                   # <handoff>'s node has gone, or is going.  Whatever it hasn't stored is yours again.  If it's still there
+        del self.handoffs[handoff.dest]                                                 # to store what you've sent, only take back what you haven't.
+        items = handoff.items[handoff.next:]
+        if not unsent_only:
+            for start, end in handoff.unacked.values():
+                items.extend(handoff.items[start:end])
+        self.log.info('taking back %s keys %s did not store', len(items), handoff.dest)
+        if self.leaving:
+            self.hand_on(items)                                                         # You're leaving.  They go to your successor with the rest.
+        elif len(items) > 0:
+            self.insert_data(Message(DATA_TRANSFER, self.id, items=items))             # Any that aren't yours any more go on to your predecessor.
+
+
+    def drop_gone_handoffs(self):                                                      # Take back what you were handing to nodes that have gone.  If you're leaving and that was all you
+        for handoff in [h for h in self.handoffs.values() if h.dest not in self.queues]:   # were waiting on, go.
+            self.take_back(handoff)
+        if self.leaving and len(self.handoffs) == 0:
+            self.depart()
+
+
+    def relinquish_partition_data(self):                                               # Hand all your data to your successor.  You go once it has acknowledged every chunk.
+        succ = self.finger_table[0].node
+        items = [(id, None, file_data) for id, file_data in self.hash_table.items()]
+        self.hash_table.clear()                                                         # Delete your copy.  Its important to let go of the past.
+        handoff = self.handoffs.get(succ)
+        if handoff is not None:
+            handoff.items.extend(items)
+        else:
+            handoff = self.handoffs[succ] = Handoff(succ, items)
+            if succ in self.successors or len(items) == 0:                              # Your successor already has a copy of everything, or there's nothing to send.  One empty chunk
+                self.log.info('leaving %s keys with the replica that has them.', len(items))    # stands in for it all.  If your successor goes before acknowledging it, you still have them to send.
+                handoff.next = len(items)
+                handoff.sent = 1
+                handoff.unacked[1] = (0, len(items))
+                self.queues[succ].put(Message(DATA_TRANSFER, self.id, items=[], request_id=1))
+            else:
+                self.log.info('giving away %s keys before I die.', len(items))
+        for handoff in list(self.handoffs.values()):                                   # Finish any handoff to a node that just joined, too.
+            if handoff.dest in self.queues:
+                self.send_chunks(handoff)
+            else:
+                self.take_back(handoff)
 
 
-    def relinquish_partition_data(self):
-        for id in list(self.hash_table.keys()):                                                                                         # Give all your data to your successor.
-            print('Node ' + str(self.id) + ' giving away ' + str(id) + ' before I die.')
-            self.queues[self.finger_table[0].node].put(Message('DATA_TRANSFER', self.id, file_id=id, file_data=self.hash_table[id]))    # Send a piece of data.
-            self.hash_table.pop(id, None)                                                                                               # Delete your copy.  Its important to let go of the past.
+    def hand_on(self, items):                                                           # Leaving.  <items> go to your successor, with everything else you're handing it.
+        succ = self.finger_table[0].node
+        if self.successor() != succ:                                                    # It has gone.  The next one needs to know who's in front of it.
+            succ = self.finger_table[0].node
+            self.announce_leave()
+        if succ == self.id or succ not in self.queues:                                  # Nobody left to take them
+            return
+        self.hand_over(succ, items)
 
 
     def insert_data(self, msg):
-        self.hash_table[msg.file_id] = msg.file_data    # Someone sent you data.  You should trust them and store it here without doing any kind of validation.
+        items = msg.items
+        pred = self.predecessor
+        if pred != self.id and pred in self.queues:                                     # Another node may have joined in front of you while this was on its way.  Its keys go on back to it.
+            mine = [item for item in items if mod_between(item[0], pred + 1, self.id)]
+            if len(mine) < len(items):                                                  # It may be leaving, so make sure they got there.
+                self.hand_over(pred, [item for item in items if not mod_between(item[0], pred + 1, self.id)])
+                items = mine
+        self.hash_table.update((item[0], item[2]) for item in items)                    # Someone sent you data.  You should trust them and store it here without doing any kind of validation.
+        if len(self.successors) > 0:
+            self.replicate(items)                                                       # It's yours now, so your replicas need it too.
+        self.acknowledge(msg)                                                           # They're waiting to hear you got it before sending more.
 
 
-    def wait_for_message_type(self, type):
-        msg = self.queues[self.id].get()    # Get a message from your queue.
-        while msg.type != type:             # This is not the message I wanted.
-            self.msg_buf.append(msg)        # Keep getting messages till you get the one you are expecting.
-        return msg
+    def acknowledge(self, msg):                                                         # Answer a DATA_TRANSFER, or a leaving node's SET_SUCCESSOR, if the sender is waiting to hear you got it
+        if msg.request_id is not None and msg.sender_id in self.queues:
+            self.queues[msg.sender_id].put(Message(DATA_ACK, self.id, request_id=msg.request_id))
 
 
-    def leave_network(self):
-        self.queues[self.finger_table[0].node].put(Message('SET_PREDECESSOR', self.id, node=self.predecessor))  # Tell your successor that your predecessor is now its predecessor.
-        self.queues[self.predecessor].put(Message('SET_SUCCESSOR', self.id, node=self.finger_table[0].node))    # Tell your predecessor that your successor is now its successor.
-        del self.queues[self.id]                                                                                # Delete your message queue so you won't get any more pesky messages.
+    def new_store(self):                    # Data lives in memory, unless the ring keeps it on disk.  A restarted node with the same ID finds its old data there.
+        if self.config.storage_dir is None:
+            return RingStore()
+        return DiskStore(os.path.join(self.config.storage_dir, str(self.id) + '.log'))
+
+
+    def new_queue(self):                    # Threaded nodes read a real queue.  Simulated nodes get one from the engine that schedules deliveries.
+        if self.engine is None:
+            self.mailbox = queue.Queue()
+        else:
+            self.mailbox = self.engine.attach(self)
+        return self.mailbox
+
+
+    def leave_network(self, msg=None):                                                                          # Time to go.  You stay, passing on whatever reaches you, until your successor has your data.
+        if self.leaving:
+            return
+        self.leaving = True
+        succ = self.successor()
+        for id in self.referrers:                                                                               # Nodes that route through you can point their fingers at your successor instead of finding out the hard way.
+            if id != self.predecessor and id != succ and id != self.id and id in self.queues:
+                self.queues[id].put(Message(NODE_LEFT, self.id, node=succ))
+        for key in list(self.gathers):                                                                          # Answer any broadcasts you're waiting on with what you have.
+            self.finish_gather(key)
+        self.log.info('leaving network')
+        if succ == self.id:                                                                                     # The last node.  There's nobody to tell.
+            self.depart()
+            return
+        self.announce_leave()
         self.relinquish_partition_data()                                                                        # Send your data to your successor before you disappear forever.
-        print('Node ' + str(self.id) + ' leaving network and exiting')                                          # Say goodbye!
-        exit()
+
+    def announce_leave(self):                                                                                   # Introduce your neighbours to eachother.  Done again whenever they change while you're leaving.
+        succ = self.finger_table[0].node
+        pred = self.live_predecessor()
+        if succ == self.id or succ not in self.queues:                                                          # Nobody left that you know of
+            return
+        self.queues[succ].put(Message(SET_PREDECESSOR, self.id, node=self.predecessor))                        # Tell your successor that your predecessor is now its predecessor.  Even if it has gone: the one you
+        if pred != self.id:                                                                                     # found instead may not be right behind you, and your successor can't own a range it doesn't.
+            self.queues[pred].put(Message(SET_SUCCESSOR, self.id, node=succ, request_id=self.expect_ack(pred)))    # Tell your predecessor that your successor is now its successor.  Wait for it to
+                                                                                                                # answer: anything it sent you before, like its own data if it's leaving too, arrives first.
+    def expect_ack(self, dest):                                                                                 # A request ID for a message <dest> has to acknowledge before you go.  It counts as an empty chunk
+        handoff = self.handoffs.get(dest)                                                                       # of a handoff to <dest>, so it's dealt with like one if <dest> goes first.
+        if handoff is None:
+            handoff = self.handoffs[dest] = Handoff(dest, [])
+        handoff.sent += 1
+        handoff.unacked[handoff.sent] = (handoff.next, handoff.next)
+        return handoff.sent
+
+    def live_predecessor(self):                                                                                 # Your predecessor, or if it has gone, the nearest node behind you that you know of.  Yourself if there's none.
+        if self.predecessor in self.queues:
+            return self.predecessor
+        size = self.ring_size
+        best = self.id
+        best_dist = size
+        for s in self.successors + [f.node for f in self.finger_table] + list(self.referrers):
+            d = (self.id - s) % size
+            if 0 < d < best_dist and s in self.queues:
+                best = s
+                best_dist = d
+        return best
+
+    def depart(self):                                                                                           # Everything you held has been handed on.
+        del self.queues[self.id]                                                                                # Delete your message queue so you won't get any more pesky messages.
+        for key in list(self.gathers):
+            self.finish_gather(key)
+        self.log.info('leaving network and exiting')                                                           # Say goodbye!
+        self.active = False
+
+
+    # While leaving, you own nothing.  Requests go on to your successor, and so does any data sent to you.
+    def pass_on(self, msg):
+        msg.sender_id = self.id
+        msg.hops += 1
+        succ = self.successor()
+        if self.node_exists(succ):
+            self.queues[succ].put(msg)
+
+    def pass_data_on(self, msg):
+        self.hand_on(msg.items)
+        self.acknowledge(msg)                                                                                   # It's your job to get it there now.
+        if len(self.handoffs) == 0:
+            self.depart()
+
+    def new_neighbours(self, pred, succ):                                                                       # Your neighbours have changed while you're leaving.  Introduce the new ones to eachother.
+        self.predecessor = pred
+        self.finger_table[0].node = succ
+        if self.config.replicas > 0:
+            self.promote_replicas()                                                                             # Your range grew over a node that left.  Your copies of its keys go on too.
+        if len(self.hash_table) > 0:
+            items = [(id, None, file_data) for id, file_data in self.hash_table.items()]
+            self.hash_table.clear()
+            self.hand_on(items)
+        self.announce_leave()
+        if succ == self.id or succ not in self.queues or len(self.handoffs) == 0:                              # Everyone else has gone, or there was nothing left to send
+            self.depart()
+
+    def leaving_set_successor(self, msg):
+        self.acknowledge(msg)
+        if msg.node != self.finger_table[0].node:
+            self.new_neighbours(self.predecessor, msg.node)
+
+    def leaving_set_predecessor(self, msg):
+        if msg.node != self.predecessor and msg.node in self.queues:                                            # If it has gone too, whoever told you will hear who's behind it, and tell you.
+            self.new_neighbours(msg.node, self.finger_table[0].node)
+
+    def leaving_succ_stabalize(self, msg):                                                                      # A node thinks it's your predecessor.  If it is, your successor is its successor.
+        if msg.node not in self.queues:
+            return
+        pred = self.predecessor
+        if msg.node == pred:
+            self.queues[pred].put(Message(SET_SUCCESSOR, self.id, node=self.finger_table[0].node))
+        elif mod_between(msg.node, pred, self.id) or pred not in self.queues:
+            self.new_neighbours(msg.node, self.finger_table[0].node)
+        else:
+            self.queues[msg.orig_sender_id].put(Message(SET_SUCCESSOR, self.id, node=pred))
+
+    def leaving_pred_stabalize(self, msg):                                                                      # A node thinks it's your successor.  If it is, your predecessor is its predecessor.
+        if msg.node not in self.queues:
+            return
+        succ = self.finger_table[0].node
+        if msg.node == succ:
+            self.queues[succ].put(Message(SET_PREDECESSOR, self.id, node=self.predecessor))
+        elif mod_between(msg.node, self.id, succ):
+            self.new_neighbours(self.predecessor, msg.node)
+        else:
+            self.queues[msg.orig_sender_id].put(Message(SET_PREDECESSOR, self.id, node=succ))
+
+    def ignore(self, msg):
+        pass
+
+
+    # What to do with each type of message
+    HANDLERS = {
+        GET_REQUEST:        get,                        # If you have the value they are looking for, print it.  Otherwise pass it along.
+        SET_REQUEST:        set,                        # If the key falls in your partition, set it to your local hash table.  Otherwise look up the node it belongs to.
+        FIND_PRED:          remote_find_predecessor,    # A node is looking for a predecessor to some ID.  If it's you, reply with a FIND_PRED_RESULT message.  Otherwise pass it along.
+        FIND_PRED_RESULT:   find_pred_result,           # A predecessor node you were looking for returned a result.  Depends on the mode.
+        FIND_SUCC:          remote_find_successor,      # A node is asking for your successor.  Return a message with your successor's ID.
+        FIND_SUCC_RESULT:   find_succ_result,           # You've been given the ID of a successor you were looking for.  Depends on the mode.
+        SUCC_STABALIZE:     succ_stabalize,             # A node has joined the network and it thinks it's your predecessor.  Check the ID it sent you and update accordingly.
+        PRED_STABALIZE:     pred_stabalize,             # A node has joined the network and it thinks it's your successor.  Check the ID it sent you and update accordingly.
+        SET_SUCCESSOR:      set_successor,              # A node has left the network and it's telling you that you have a new successor.  Update it!
+        SET_PREDECESSOR:    set_predecessor,            # A node has left the network and it's telling you that you have a new predecessor.  Update it!
+        DATA_REQUEST:       send_partition_data,        # Your predecessor wants any keys you hold that are in its partition.  Send them their share!
+        DATA_TRANSFER:      insert_data,                # A node has sent some chunk of data that should be in your partition.  Store it!
+        DATA_ACK:           data_ack,                   # A node you're handing data to has stored a chunk.  Send the next one.
+        MULTI_GET:          multi_request,              # A batch of keys to look up.  Answer for the ones you own and pass the rest along in batches.
+        MULTI_SET:          multi_request,              # A batch of keys to store.  Store the ones you own and pass the rest along in batches.
+        LEAVE_NETWORK:      leave_network,              # Its time to get out of here.  Send your data to your successor and let your neighbours know you've left.
+        SUCC_LIST:          successor_list,             # Your successor has told you who follows it.  Update your successor list, and your replicas with it.
+        REPLICATE:          store_replicas,             # A predecessor has sent copies of its keys.  Keep them in case it goes away.
+        DROP_REPLICAS:      drop_replicas,              # A predecessor doesn't need your copies any more.  Throw them out.
+        NODE_LEFT:          node_left,                  # A node you route through has left.  Point any fingers at it at its successor.
+        MAINTAIN:           maintain,                   # A maintenance round.  Stabilize, and re-resolve the next few fingers.
+        BROADCAST:          broadcast,                  # A ring-wide query.  Answer it for yourself and pass it on to the nodes between you and its limit.
+        BROADCAST_RESULT:   broadcast_result,           # A node you passed a broadcast to has answered for its part of the ring.  Add it to yours.
+    }
+
+    # What to do with some messages while you're leaving, instead
+    LEAVING_HANDLERS = {
+        GET_REQUEST:        pass_on,                    # You don't own anything.  Your successor does.
+        SET_REQUEST:        pass_on,
+        MULTI_GET:          pass_on,
+        MULTI_SET:          pass_on,
+        DATA_TRANSFER:      pass_data_on,               # It goes to your successor with the rest of your data.
+        SET_SUCCESSOR:      leaving_set_successor,      # Your neighbours have changed.  Tell the new ones about eachother.
+        SET_PREDECESSOR:    leaving_set_predecessor,
+        SUCC_STABALIZE:     leaving_succ_stabalize,
+        PRED_STABALIZE:     leaving_pred_stabalize,
+        DATA_REQUEST:       ignore,                     # Everything you had is on its way to your successor.
+        SUCC_LIST:          ignore,                     # Your successor already has copies of your keys.  Don't tell it to drop them.
+        LEAVE_NETWORK:      ignore,                     # Once is enough.
+    }
+
+    # What to do with a FIND_PRED_RESULT, by mode
+    PRED_RESULT_HANDLERS = {
+        MODE_INIT:          join_found_predecessor,     # You are joining and this is your predecessor.
+        MODE_GET:           find_successor,             # Otherwise ask the predecessor for its successor.
+        MODE_SET:           find_successor,
+        MODE_FINGER:        find_successor,
+    }
+
+    # What to do with a FIND_SUCC_RESULT, by mode
+    SUCC_RESULT_HANDLERS = {
+        MODE_INIT:          join_found_successor,       # You are joining and this is your successor.
+        MODE_GET:           forward_get,                # You were responding to a GET_REQUEST.  Forward the GET_REQUEST to the node where the ID belongs.
+        MODE_SET:           forward_set,                # You were responding to a SET_REQUEST.  Forward the SET_REQUEST to the node where the ID belongs.
+        MODE_FINGER:        update_finger,              # You were updating your fingers.  Use the data in the message to update one of your fingers.
+    }
 
 
 # Main
-# UNIVERSAL TEST SET UP
-queues = {}
-queues['root'] = queue.Queue()
-
-# TEST 0: THE "I HOPE I DIDN'T BREAK ANYTHING I CAN'T FIX" TEST---------
-if TEST == 0:
-    nodes = []
-    nodes.append(ChordNode(queues))
-    nodes[0].start()
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-
-    nodes.append(ChordNode(queues))
-    nodes.append(ChordNode(queues))
-    nodes.append(ChordNode(queues))
-    nodes.append(ChordNode(queues))
-
-    for i in range(1, len(nodes)):
-        nodes[i].start()
-        time.sleep(0.25)
-
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Chinchilla', file_data='Chinchilla'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Artichoke', file_data='Artichoke'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mozzerella', file_data='Mozzerella'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Spinnach', file_data='Spinnach'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Alfredo', file_data='Alfredo'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Komquat', file_data='Komquat'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Rosemary', file_data='Rosemary'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Shrimp', file_data='Shrimp'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Halibut', file_data='Halibut'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Corn', file_data='Corn'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Yams', file_data='Yams'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Horseraddish', file_data='Horseraddish'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Garlic', file_data='Garlic'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Cauliflower', file_data='Cauliflower'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Pasta', file_data='Pasta'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mushroom', file_data='Mushroom'))
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Chinchilla'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Artichoke'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Mozzerella'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Spinnach'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Alfredo'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Komquat'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Rosemary'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Shrimp'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Halibut'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Corn'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Yams'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Horseraddish'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Garlic'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Cauliflower'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Pasta'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Mushroom'))
-
-    time.sleep(0.25)
-# TEST 0 END -----------------------
-
-# TEST 1: PARTITION PASSING DURING NODE JOIN---
-if TEST == 1:
-    nodes = []
-    nodes.append(ChordNode(queues))
-    nodes[0].start()
-
-    time.sleep(0.25)
-
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Chinchilla', file_data='Chinchilla'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Artichoke', file_data='Artichoke'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mozzerella', file_data='Mozzerella'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Spinnach', file_data='Spinnach'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Alfredo', file_data='Alfredo'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Komquat', file_data='Komquat'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Rosemary', file_data='Rosemary'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Shrimp', file_data='Shrimp'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Halibut', file_data='Halibut'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Corn', file_data='Corn'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Yams', file_data='Yams'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Horseraddish', file_data='Horseraddish'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Garlic', file_data='Garlic'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Cauliflower', file_data='Cauliflower'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Pasta', file_data='Pasta'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mushroom', file_data='Mushroom'))
-
-    time.sleep(0.25)
-    print('---------------------------------------------------')
-
-    # Add New Nodes now that there is data in the first node
-    new_nodes = []
-    for i in range(0,5):
-        new_nodes.append(ChordNode(queues))
-        # time.sleep(1)
-
-    for n in new_nodes:
-        n.start()
-        time.sleep(1)
-
-    print('---------------------------------------------------')
-    print('FINAL VALUES')
-
-    nodes[0].report()
-    for n in new_nodes:
-        n.report()
-        time.sleep(0.25)
-
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Chinchilla'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Artichoke'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Mozzerella'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Spinnach'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Alfredo'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Komquat'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Rosemary'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Shrimp'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Halibut'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Corn'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Yams'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Horseraddish'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Garlic'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Cauliflower'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Pasta'))
-    queues[nodes[0].id].put(Message('GET_REQUEST', 'root', file_name='Mushroom'))
-# TEST 1 END----------------------------------
-
-# TEST 2: NODE LEAVING NETWORK----------------
-if TEST == 2:
-    nodes = []
-    for i in range(0,6):
-        nodes.append(ChordNode(queues))
-
-    for n in nodes:
-        n.start()
-        time.sleep(0.25)
-
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Chinchilla', file_data='Chinchilla'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Artichoke', file_data='Artichoke'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mozzerella', file_data='Mozzerella'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Spinnach', file_data='Spinnach'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Alfredo', file_data='Alfredo'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Komquat', file_data='Komquat'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Rosemary', file_data='Rosemary'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Shrimp', file_data='Shrimp'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Halibut', file_data='Halibut'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Corn', file_data='Corn'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Yams', file_data='Yams'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Horseraddish', file_data='Horseraddish'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Garlic', file_data='Garlic'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Cauliflower', file_data='Cauliflower'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Pasta', file_data='Pasta'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mushroom', file_data='Mushroom'))
-
-    time.sleep(0.25)
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-
-    print('---------------------------------------------------')
-    print('---------------SENDING LEAVE MESSAGEs--------------')
-    print('---------------------------------------------------')
-
-    queues[nodes[0].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-    time.sleep(0.25)
-    queues[nodes[2].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-    time.sleep(0.25)
-    queues[nodes[3].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-    time.sleep(0.25)
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-
-    print('---------------------------------------------------')
-# TEST 2 END----------------------------------
-
-# TEST 3: NODE LEAVING NETWORK + RESPONSIVE FINGER FIXING------
-if TEST == 3:
-    nodes = []
-    for i in range(0,10):
-        nodes.append(ChordNode(queues))
-
-    for n in nodes:
-        n.start()
-        time.sleep(0.25)
-
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Chinchilla', file_data='Chinchilla'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Artichoke', file_data='Artichoke'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mozzerella', file_data='Mozzerella'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Spinnach', file_data='Spinnach'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Alfredo', file_data='Alfredo'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Komquat', file_data='Komquat'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Rosemary', file_data='Rosemary'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Shrimp', file_data='Shrimp'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Halibut', file_data='Halibut'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Corn', file_data='Corn'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Yams', file_data='Yams'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Horseraddish', file_data='Horseraddish'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Garlic', file_data='Garlic'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Cauliflower', file_data='Cauliflower'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Pasta', file_data='Pasta'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mushroom', file_data='Mushroom'))
-
-    time.sleep(0.25)
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-
-    print('---------------------------------------------------')
-    print('---------------SENDING LEAVE MESSAGE---------------')
-    print('---------------------------------------------------')
-
-    queues[nodes[0].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-    time.sleep(0.25)
-    queues[nodes[2].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-    time.sleep(0.25)
-    queues[nodes[4].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-    time.sleep(0.25)
-    queues[nodes[6].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-    time.sleep(0.25)
-
-    print('---------------------------------------------------')
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-
-    print('---------------------------------------------------')
-
-    queues[nodes[1].id].put(Message('GET_REQUEST', 'root', file_name='Chinchilla'))
-    queues[nodes[3].id].put(Message('GET_REQUEST', 'root', file_name='Artichoke'))
-    queues[nodes[5].id].put(Message('GET_REQUEST', 'root', file_name='Mozzerella'))
-    queues[nodes[7].id].put(Message('GET_REQUEST', 'root', file_name='Spinnach'))
-    queues[nodes[1].id].put(Message('GET_REQUEST', 'root', file_name='Alfredo'))
-    queues[nodes[3].id].put(Message('GET_REQUEST', 'root', file_name='Komquat'))
-    queues[nodes[5].id].put(Message('GET_REQUEST', 'root', file_name='Rosemary'))
-    queues[nodes[7].id].put(Message('GET_REQUEST', 'root', file_name='Shrimp'))
-    queues[nodes[1].id].put(Message('GET_REQUEST', 'root', file_name='Halibut'))
-    queues[nodes[3].id].put(Message('GET_REQUEST', 'root', file_name='Corn'))
-    queues[nodes[5].id].put(Message('GET_REQUEST', 'root', file_name='Yams'))
-    queues[nodes[7].id].put(Message('GET_REQUEST', 'root', file_name='Horseraddish'))
-    queues[nodes[1].id].put(Message('GET_REQUEST', 'root', file_name='Garlic'))
-    queues[nodes[3].id].put(Message('GET_REQUEST', 'root', file_name='Cauliflower'))
-    queues[nodes[5].id].put(Message('GET_REQUEST', 'root', file_name='Pasta'))
-    queues[nodes[7].id].put(Message('GET_REQUEST', 'root', file_name='Mushroom'))
-
-    time.sleep(0.25)
-
-    print('---------------------------------------------------')
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-# TEST 3 END----------------------------------
-
-# TEST 4 CONCURRENT NODE DEPARTURES-----------------------
-if TEST == 4:
-    nodes = []
-    for i in range(0,10):
-        nodes.append(ChordNode(queues))
-
-    for n in nodes:
-        n.start()
-        time.sleep(0.25)
-
-    print('---------------------------------------------------')
-
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Chinchilla', file_data='Chinchilla'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Artichoke', file_data='Artichoke'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mozzerella', file_data='Mozzerella'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Spinnach', file_data='Spinnach'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Alfredo', file_data='Alfredo'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Komquat', file_data='Komquat'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Rosemary', file_data='Rosemary'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Shrimp', file_data='Shrimp'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Halibut', file_data='Halibut'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Corn', file_data='Corn'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Yams', file_data='Yams'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Horseraddish', file_data='Horseraddish'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Garlic', file_data='Garlic'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Cauliflower', file_data='Cauliflower'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Pasta', file_data='Pasta'))
-    queues[nodes[0].id].put(Message('SET_REQUEST', 'root', file_name='Mushroom', file_data='Mushroom'))
-
-    time.sleep(0.25)
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-
-    print('---------------------------------------------------')
-    print('---------------SENDING LEAVE MESSAGE---------------')
-    print('---------------------------------------------------')
-
-    for i in range(0,9):
-        queues[nodes[i].id].put(Message('LEAVE_NETWORK', 'root', None, None))
-
-    print('---------------------------------------------------')
-
-    for n in nodes:
-        n.report()
-        time.sleep(0.25)
-# TEST 4 -------------------------------------
-
-running = False
+# The tests that used to be chosen with TEST here are scenarios in bench.py now: smoke, join-handoff, leave,
+# leave-fingers and concurrent-leave.  Running this file runs the one that was picked by default, on threads,
+# printing everything the nodes do.  Use bench.py directly for the rest.
+if __name__ == '__main__':
+    import bench
+    bench.main(['--scenario', 'leave-fingers', '--engine', 'threads', '-vv'])
@@ -0,0 +1,171 @@
+from chord import Message, RangeCache, RingConfig, hash, GET_REQUEST, SET_REQUEST, MULTI_GET, MULTI_SET, BROADCAST, GET_RESULT, SET_RESULT, MULTI_GET_RESULT, MULTI_SET_RESULT, BROADCAST_RESULT
+from metrics import ClientMetrics
+from concurrent.futures import Future
+import collections
+import threading
+import queue
+import random
+import time
+
+# A client gateway for the ring.
+# Every request gets a request ID that the node answering it copies into its reply, so replies can be matched
+# to requests in any order.  Each call returns a Future.  Up to <window> requests are in flight at a time; the
+# rest wait their turn inside the client, so a caller can queue up as many as it likes without flooding the ring.
+# Replies say which range of IDs their sender owns.  The client caches those ranges and sends later GETs and SETs
+# for keys in them straight to the owner, skipping finger routing altogether.
+# broadcast() asks every node in the ring one of the queries in chord.QUERIES, and gets back a single answer
+# combined from all of theirs.
+
+WINDOW = 64         # Default number of requests a client keeps in flight
+CACHE_SIZE = 1024   # Default number of owner ranges a client remembers
+KINDS = {GET_REQUEST: 'get', SET_REQUEST: 'set', MULTI_GET: 'multi_get', MULTI_SET: 'multi_set', BROADCAST: 'broadcast'}  # What each request's latency is filed under
+
+
+# Struct for one request the client has made
+class Request():
+
+    __slots__ = ('id', 'msg', 'future', 'sent', 'done', 'expected', 'received', 'values', 'target')
+
+    def __init__(self, id, msg, expected):
+        self.id = id            # The request ID carried by the message and its replies
+        self.msg = msg          # The message to send
+        self.future = Future()  # Resolved with the result when the request is complete
+        self.sent = None        # When the message was sent
+        self.done = None        # When the last reply arrived
+        self.expected = expected    # Number of keys this request covers.  Multi-key requests are answered by many nodes.
+        self.received = 0       # Number of keys answered so far
+        self.values = None      # Values collected for a MULTI_GET
+        self.target = None      # The node the request went to, if the cache said it owns the key
+
+    def latency(self):
+        return self.done - self.sent
+
+
+class Client():
+
+    def __init__(self, queues, name='root', entry=None, window=WINDOW, engine=None, on_complete=None, config=None, cache_size=CACHE_SIZE):
+        self.queues = queues            # The same queues dictionary the nodes use
+        self.name = name                # Replies are sent to queues[name]
+        self.entry = entry              # ID of the node requests are sent to.  Picked at random if None, or if it leaves.
+        self.window = window            # Most requests allowed in flight at once
+        self.engine = engine            # The simulator, if the ring is simulated
+        self.on_complete = on_complete  # Called with each Request as it completes
+        self.config = config or (engine.config if engine else RingConfig())    # The ring's settings.  The client hashes keys itself to use the cache.
+        self.cache = RangeCache(cache_size)     # Ranges of IDs learned from replies, and who owns them
+        self.rng = engine.rng if engine else random
+        self.next_id = 0
+        self.outstanding = {}           # Requests in flight, by request ID
+        self.waiting = collections.deque()  # Requests waiting for room in the window
+        self.completed = 0
+        self.metrics = ClientMetrics()  # Latency histograms for each kind of request
+        self.lock = threading.Lock()
+        if engine is not None:
+            engine.listen(name, self.receive)   # The simulator delivers replies by calling receive()
+        else:
+            if name not in queues:
+                queues[name] = queue.Queue()
+            threading.Thread(target=self.listen, daemon=True).start()
+
+    def now(self):
+        if self.engine is not None:
+            return self.engine.now
+        return time.perf_counter()
+
+    def get(self, file_name):           # Future resolves to the stored value, or None
+        return self.submit(Message(GET_REQUEST, self.name, file_id=hash(file_name, self.config.hash_bits)), 1, file_name=file_name)
+
+    def set(self, file_name, file_data):    # Future resolves to True once the owner has stored it
+        return self.submit(Message(SET_REQUEST, self.name, file_id=hash(file_name, self.config.hash_bits)), 1, file_name=file_name, file_data=file_data)
+
+    def multi_get(self, file_names):    # Future resolves to a dictionary of file_name -> value
+        return self.submit(Message(MULTI_GET, self.name), len(file_names), items=[(None, n, None) for n in file_names])
+
+    def multi_set(self, files):         # Takes a dictionary of file_name -> file_data.  Future resolves to True once every key is stored.
+        return self.submit(Message(MULTI_SET, self.name), len(files), items=[(None, n, files[n]) for n in files])
+
+    def broadcast(self, query, arg=None):   # Future resolves to the named query (see chord.QUERIES) answered by every node and combined.  Answers lost with nodes that left are left out.
+        return self.submit(Message(BROADCAST, self.name), 1, file_name=query, file_data=arg)
+
+    def submit(self, msg, expected, file_name=None, file_data=None, items=None):
+        msg.file_name = file_name
+        msg.file_data = file_data
+        msg.items = items
+        with self.lock:
+            msg.request_id = self.next_id
+            self.next_id += 1
+            request = Request(msg.request_id, msg, expected)
+            if len(self.outstanding) < self.window:
+                self.send(request)
+            else:
+                self.waiting.append(request)
+        return request.future
+
+    def send(self, request):            # Called with the lock held
+        self.outstanding[request.id] = request
+        request.sent = self.now()
+        if request.msg.file_id is not None:
+            owner = self.cache.lookup(request.msg.file_id)
+            if owner is not None:
+                q = self.queues.get(owner)
+                if q is not None:           # Go straight to the node that owns the key
+                    request.target = owner
+                    q.put(request.msg)
+                    return
+                self.cache.forget(owner)    # It left the network.  Fall back to routing.
+        self.queues[self.pick_entry()].put(request.msg)
+
+    def pick_entry(self):
+        if self.entry is None or self.entry not in self.queues:     # No entry node, or it left the network.  Find another.
+            nodes = [k for k in self.queues.keys() if not isinstance(k, str)]
+            self.entry = nodes[self.rng.randrange(len(nodes))]
+        return self.entry
+
+    def listen(self):                   # Threaded mode: a daemon thread waits for replies
+        inbox = self.queues[self.name]
+        while True:
+            self.receive(inbox.get())
+
+    def receive(self, msg):
+        with self.lock:
+            request = self.outstanding.get(msg.request_id)
+            if request is None:         # Not one of ours, or a duplicate
+                return
+            if msg.node is not None:
+                if request.target is not None and request.target != msg.sender_id:   # The cached owner passed the request on.  Its range has changed.
+                    self.cache.forget(request.target)
+                self.cache.learn(msg.node, msg.sender_id)   # The sender owns (msg.node, sender]
+            if msg.type == GET_RESULT:
+                result = msg.file_data
+                request.received = 1
+            elif msg.type == SET_RESULT:
+                result = True
+                request.received = 1
+            elif msg.type == MULTI_GET_RESULT:
+                if request.values is None:
+                    request.values = {}
+                for item in msg.items:
+                    request.values[item[1]] = item[2]
+                request.received += len(msg.items)
+                result = request.values
+            elif msg.type == MULTI_SET_RESULT:
+                request.received += msg.file_data   # The number of keys that node stored
+                result = True
+            elif msg.type == BROADCAST_RESULT:
+                result = msg.file_data
+                request.received = 1
+            else:
+                return
+            if request.received < request.expected:
+                return
+            del self.outstanding[request.id]
+            request.done = self.now()
+            self.completed += 1
+            self.metrics.observe(KINDS[request.msg.type], request.latency())
+            while len(self.waiting) > 0 and len(self.outstanding) < self.window:    # Make room for the next request
+                self.send(self.waiting.popleft())
+        request.future.set_result(result)
+        if self.on_complete is not None:
+            self.on_complete(request)
+
+    def pending(self):                  # Requests sent or waiting that haven't completed
+        return len(self.outstanding) + len(self.waiting)
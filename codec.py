@@ -0,0 +1,353 @@
+from chord import Message, RingConfig, MSG_NAMES, HASH_BITS
+from chord import GET_REQUEST, FIND_PRED, FIND_SUCC_RESULT, SUCC_STABALIZE, DATA_TRANSFER, MULTI_GET_RESULT, MODE_GET
+import itertools
+import struct
+import pickle
+import time
+import sys
+
+# A compact binary form for Message, for anything that crosses a process or socket boundary.
+# Every message starts with a fixed header: codec version, message type, mode, how many bytes each ring ID
+# takes, a bit for each optional field that is present, and the hop count.  The fields that are present
+# follow in a fixed order.  Ring IDs are unsigned big-endian integers of the width in the header.  Anything
+# that can be either a node ID or a client name (senders, the requester, queue keys) and all file data are
+# tagged with their type.  Names and data are length-prefixed.
+# encode_into() appends to a bytearray, so a connection can pack many messages into one buffer and send it
+# in one write.  decode() reads straight out of a bytes, bytearray or memoryview with unpack_from, without
+# slicing the buffer up first.  Pass copy=False to get bytes values back as memoryviews of the buffer.
+
+VERSION = 1
+
+HEADER = struct.Struct('>BBBBHH')   # version, type, mode, ID width, presence bits, hops
+SIZED = struct.Struct('>BI')        # A tag and a length
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+U64 = struct.Struct('>Q')
+I64 = struct.Struct('>q')
+F64 = struct.Struct('>d')
+
+NO_MODE = 0xFF                      # Mode byte for a message without one
+
+# Presence bits
+HAS_ORIG_SENDER = 0x0001
+HAS_SENDER      = 0x0002
+HAS_REQUESTER   = 0x0004
+HAS_FILE_ID     = 0x0008
+HAS_NODE        = 0x0010
+HAS_FINGER_NUM  = 0x0020
+HAS_REQUEST_ID  = 0x0040
+HAS_FILE_NAME   = 0x0080
+HAS_FILE_DATA   = 0x0100
+HAS_ITEMS       = 0x0200
+SHORTCUT        = 0x0400            # Not a field.  The message's shortcut flag.
+
+# Value tags
+TAG_NONE    = 0
+TAG_ID      = 1     # Unsigned, the ring's ID width
+TAG_INT     = 2     # Signed, 8 bytes
+TAG_BIGINT  = 3     # Signed, length-prefixed
+TAG_STR     = 4
+TAG_BYTES   = 5
+TAG_TRUE    = 6
+TAG_FALSE   = 7
+TAG_FLOAT   = 8
+TAG_TUPLE   = 9     # Count, then each value tagged
+TAG_LIST    = 10
+TAG_PICKLE  = 11    # Anything else
+
+# Item lists are sent a column at a time (every file_id, then every file_name, then every file_data), so a
+# column that is all one kind can be packed and unpacked in bulk instead of value by value.
+COL_NONE    = 0     # Nothing follows
+COL_IDS     = 1     # The IDs back to back, the ring's ID width each
+COL_STR     = 2     # Every length, then every string back to back
+COL_BYTES   = 3     # The same, for bytes
+COL_VALUES  = 4     # Each value tagged
+
+UINT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}  # ID widths struct can unpack a whole column of at once
+
+
+def id_bytes(config=None):          # The ID width a ring's messages use
+    bits = config.hash_bits if config is not None else HASH_BITS
+    return (bits + 7) // 8
+
+
+def encode_key(buf, key, width):    # A node ID or a client name
+    if type(key) is int:
+        buf.append(TAG_ID)
+        buf += key.to_bytes(width, 'big')
+    else:
+        encode_value(buf, key, width)
+
+
+def encode_value(buf, value, width):
+    kind = type(value)              # Most common first
+    if kind is str:
+        data = value.encode()
+        buf += SIZED.pack(TAG_STR, len(data))
+        buf += data
+    elif value is None:
+        buf.append(TAG_NONE)
+    elif kind is bytes or kind is memoryview or kind is bytearray:
+        buf += SIZED.pack(TAG_BYTES, len(value))
+        buf += value
+    elif value is True:
+        buf.append(TAG_TRUE)
+    elif value is False:
+        buf.append(TAG_FALSE)
+    elif kind is int:
+        if -2**63 <= value < 2**63:
+            buf.append(TAG_INT)
+            buf += I64.pack(value)
+        else:
+            data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+            buf += SIZED.pack(TAG_BIGINT, len(data))
+            buf += data
+    elif kind is float:
+        buf.append(TAG_FLOAT)
+        buf += F64.pack(value)
+    elif kind is tuple or kind is list:
+        buf += SIZED.pack(TAG_TUPLE if kind is tuple else TAG_LIST, len(value))
+        for v in value:
+            encode_value(buf, v, width)
+    else:                           # Subclasses of the above end up here too, so they come back as what they were
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        buf += SIZED.pack(TAG_PICKLE, len(data))
+        buf += data
+
+
+def encode_column(buf, values, width, ids=False):   # One field of every item in a list
+    kinds = set(map(type, values))
+    if kinds == {type(None)}:
+        buf.append(COL_NONE)
+    elif ids and kinds == {int}:
+        buf.append(COL_IDS)
+        if width in UINT_CODES:
+            buf += struct.pack('>' + str(len(values)) + UINT_CODES[width], *values)
+        else:
+            buf += b''.join([value.to_bytes(width, 'big') for value in values])
+    elif kinds == {str} or kinds <= {bytes, bytearray, memoryview}:
+        if str in kinds:
+            values = [value.encode() for value in values]
+        buf.append(COL_STR if str in kinds else COL_BYTES)
+        buf += struct.pack('>' + str(len(values)) + 'I', *map(len, values))
+        buf += b''.join(values)
+    else:
+        buf.append(COL_VALUES)
+        for value in values:
+            (encode_key if ids else encode_value)(buf, value, width)
+
+
+def encode_into(buf, msg, width=None):  # Append <msg> to the bytearray <buf>
+    if width is None:
+        width = id_bytes()
+    flags = 0
+    if msg.orig_sender_id is not None:
+        flags |= HAS_ORIG_SENDER
+    if msg.sender_id is not None:
+        flags |= HAS_SENDER
+    if msg.requester is not None:
+        flags |= HAS_REQUESTER
+    if msg.file_id is not None:
+        flags |= HAS_FILE_ID
+    if msg.node is not None:
+        flags |= HAS_NODE
+    if msg.finger_num is not None:
+        flags |= HAS_FINGER_NUM
+    if msg.request_id is not None:
+        flags |= HAS_REQUEST_ID
+    if msg.file_name is not None:
+        flags |= HAS_FILE_NAME
+    if msg.file_data is not None:
+        flags |= HAS_FILE_DATA
+    if msg.items is not None:
+        flags |= HAS_ITEMS
+    if msg.shortcut:
+        flags |= SHORTCUT
+    buf += HEADER.pack(VERSION, msg.type, NO_MODE if msg.mode is None else msg.mode, width, flags, msg.hops)
+    if flags & HAS_ORIG_SENDER:
+        encode_key(buf, msg.orig_sender_id, width)
+    if flags & HAS_SENDER:
+        encode_key(buf, msg.sender_id, width)
+    if flags & HAS_REQUESTER:
+        encode_key(buf, msg.requester, width)
+    if flags & HAS_FILE_ID:
+        buf += msg.file_id.to_bytes(width, 'big')
+    if flags & HAS_NODE:
+        buf += msg.node.to_bytes(width, 'big')
+    if flags & HAS_FINGER_NUM:
+        buf += U16.pack(msg.finger_num)
+    if flags & HAS_REQUEST_ID:
+        buf += U64.pack(msg.request_id)
+    if flags & HAS_FILE_NAME:
+        encode_value(buf, msg.file_name, width)
+    if flags & HAS_FILE_DATA:
+        encode_value(buf, msg.file_data, width)
+    if flags & HAS_ITEMS:
+        buf += U32.pack(len(msg.items))
+        if len(msg.items) > 0:      # (file_id, file_name, file_data)
+            ids, names, data = zip(*msg.items)
+            encode_column(buf, ids, width, True)
+            encode_column(buf, names, width)
+            encode_column(buf, data, width)
+    return buf
+
+
+def encode(msg, width=None):        # Returns <msg> as a new bytearray
+    return encode_into(bytearray(), msg, width)
+
+
+def decode_value(buf, pos, width, copy):    # Returns (value, position after it)
+    tag = buf[pos]
+    pos += 1
+    if tag == TAG_ID:
+        return int.from_bytes(buf[pos:pos + width], 'big'), pos + width
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_STR:
+        size = U32.unpack_from(buf, pos)[0]
+        pos += 4
+        return str(buf[pos:pos + size], 'utf-8'), pos + size
+    if tag == TAG_BYTES:
+        size = U32.unpack_from(buf, pos)[0]
+        pos += 4
+        view = memoryview(buf)[pos:pos + size]
+        return (bytes(view) if copy else view), pos + size
+    if tag == TAG_INT:
+        return I64.unpack_from(buf, pos)[0], pos + 8
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_BIGINT:
+        size = U32.unpack_from(buf, pos)[0]
+        pos += 4
+        return int.from_bytes(buf[pos:pos + size], 'big', signed=True), pos + size
+    if tag == TAG_FLOAT:
+        return F64.unpack_from(buf, pos)[0], pos + 8
+    if tag == TAG_TUPLE or tag == TAG_LIST:
+        count = U32.unpack_from(buf, pos)[0]
+        pos += 4
+        values = []
+        for i in range(0, count):
+            value, pos = decode_value(buf, pos, width, copy)
+            values.append(value)
+        return (tuple(values) if tag == TAG_TUPLE else values), pos
+    if tag == TAG_PICKLE:
+        size = U32.unpack_from(buf, pos)[0]
+        pos += 4
+        return pickle.loads(memoryview(buf)[pos:pos + size]), pos + size
+    raise ValueError('Unknown value tag ' + str(tag))
+
+
+def decode_column(buf, pos, count, width, copy):   # Returns (list of <count> values, position after them)
+    kind = buf[pos]
+    pos += 1
+    if kind == COL_NONE:
+        return [None] * count, pos
+    if kind == COL_IDS:
+        end = pos + count * width
+        if width in UINT_CODES:
+            return list(struct.unpack_from('>' + str(count) + UINT_CODES[width], buf, pos)), end
+        view = memoryview(buf)
+        return [int.from_bytes(view[p:p + width], 'big') for p in range(pos, end, width)], end
+    if kind == COL_STR or kind == COL_BYTES:
+        sizes = struct.unpack_from('>' + str(count) + 'I', buf, pos)
+        offsets = list(itertools.accumulate(sizes, initial=pos + 4 * count))
+        view = memoryview(buf)
+        if kind == COL_STR:
+            values = [str(view[a:b], 'utf-8') for a, b in zip(offsets, offsets[1:])]
+        elif copy:
+            values = [bytes(view[a:b]) for a, b in zip(offsets, offsets[1:])]
+        else:
+            values = [view[a:b] for a, b in zip(offsets, offsets[1:])]
+        return values, offsets[-1]
+    if kind == COL_VALUES:
+        values = []
+        for i in range(0, count):
+            value, pos = decode_value(buf, pos, width, copy)
+            values.append(value)
+        return values, pos
+    raise ValueError('Unknown column kind ' + str(kind))
+
+
+def decode_from(buf, pos=0, copy=True):     # Returns (message, position after it) for a message starting at <pos> in <buf>
+    version, type, mode, width, flags, hops = HEADER.unpack_from(buf, pos)
+    if version != VERSION:
+        raise ValueError('Unknown codec version ' + str(version))
+    pos += HEADER.size
+    msg = Message.__new__(Message)
+    msg.type = type
+    msg.mode = None if mode == NO_MODE else mode
+    msg.hops = hops
+    msg.shortcut = flags & SHORTCUT != 0
+    msg.orig_sender_id = msg.sender_id = msg.requester = msg.file_id = msg.node = msg.finger_num = None
+    msg.request_id = msg.file_name = msg.file_data = msg.items = None
+    if flags & HAS_ORIG_SENDER:
+        msg.orig_sender_id, pos = decode_value(buf, pos, width, copy)
+    if flags & HAS_SENDER:
+        msg.sender_id, pos = decode_value(buf, pos, width, copy)
+    if flags & HAS_REQUESTER:
+        msg.requester, pos = decode_value(buf, pos, width, copy)
+    if flags & HAS_FILE_ID:
+        msg.file_id = int.from_bytes(buf[pos:pos + width], 'big')
+        pos += width
+    if flags & HAS_NODE:
+        msg.node = int.from_bytes(buf[pos:pos + width], 'big')
+        pos += width
+    if flags & HAS_FINGER_NUM:
+        msg.finger_num = U16.unpack_from(buf, pos)[0]
+        pos += 2
+    if flags & HAS_REQUEST_ID:
+        msg.request_id = U64.unpack_from(buf, pos)[0]
+        pos += 8
+    if flags & HAS_FILE_NAME:
+        msg.file_name, pos = decode_value(buf, pos, width, copy)
+    if flags & HAS_FILE_DATA:
+        msg.file_data, pos = decode_value(buf, pos, width, copy)
+    if flags & HAS_ITEMS:
+        count = U32.unpack_from(buf, pos)[0]
+        pos += 4
+        if count == 0:
+            msg.items = []
+        else:
+            ids, pos = decode_column(buf, pos, count, width, copy)
+            names, pos = decode_column(buf, pos, count, width, copy)
+            data, pos = decode_column(buf, pos, count, width, copy)
+            msg.items = list(zip(ids, names, data))
+    return msg, pos
+
+
+def decode(buf, copy=True):         # Returns the message encoded in <buf>
+    return decode_from(buf, 0, copy)[0]
+
+
+# Main
+# Usage: python codec.py [hash bits] [rounds]
+# Encodes and decodes a few typical messages many times with this codec and with pickle, and prints the cost of each.
+if __name__ == '__main__':
+    bits = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    width = id_bytes(RingConfig(hash_bits=bits))
+    top = 2**bits - 1
+    samples = [
+        Message(FIND_PRED, top // 3, mode=MODE_GET, file_name='Artichoke', file_id=top // 5, requester='root', request_id=42),
+        Message(FIND_SUCC_RESULT, top // 7, mode=MODE_GET, file_id=top // 5, node=top // 2, hops=3),
+        Message(SUCC_STABALIZE, top // 9, node=top // 9),
+        Message(GET_REQUEST, 'root', file_name='Mozzerella', file_id=top // 11, request_id=7),
+        Message(DATA_TRANSFER, top // 13, items=[(top // (i + 2), None, str(i).encode() * 30) for i in range(0, 64)], request_id=0),
+        Message(MULTI_GET_RESULT, top // 17, items=[(top // (i + 2), 'key' + str(i), 'value' + str(i)) for i in range(0, 16)], node=top // 19, request_id=9),
+    ]
+    print('Message type          codec bytes   pickle bytes   codec enc+dec us   pickle enc+dec us')
+    for msg in samples:
+        data = bytes(encode(msg, width))
+        assert decode(data).items == msg.items and decode(data).file_id == msg.file_id
+        start = time.perf_counter()
+        for i in range(0, rounds):
+            decode(encode(msg, width))
+        ours = (time.perf_counter() - start) / rounds * 1e6
+        pickled = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        start = time.perf_counter()
+        for i in range(0, rounds):
+            pickle.loads(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+        theirs = (time.perf_counter() - start) / rounds * 1e6
+        print(MSG_NAMES[msg.type].ljust(22) + str(len(data)).rjust(11) + str(len(pickled)).rjust(15) + str(round(ours, 2)).rjust(19) + str(round(theirs, 2)).rjust(20))
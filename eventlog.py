@@ -0,0 +1,124 @@
+import collections
+import threading
+import atexit
+import time
+import sys
+
+# Event logging for nodes, in place of printing as things happen.
+# Each node has an EventLog.  A call like log.info('performed GET on %s', name) compares the level against two
+# thresholds before doing anything else: the node's own level, which decides what goes into its in-memory ring
+# buffer of recent events, and the output level, which decides what gets written out.  An event that passes is
+# kept as a tuple of its format string and arguments; nothing is turned into text until it's written.  Writing
+# is done by one Flusher thread per process, which collects events from every node and writes them in a batch
+# every FLUSH_INTERVAL seconds, so nodes never wait on stdout.  By default only warnings are written out, and
+# dump() prints a node's recent events when you want them.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+SILENT = 100        # Higher than any event.  Turns recording or output off.
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+CAPACITY = 256      # Default number of recent events each node keeps
+FLUSH_INTERVAL = 0.1
+
+
+def format(event):  # Turns an event into a line of text
+    t, level, name, text, args = event
+    if args:
+        text = text % args
+    if name is None:
+        return text + '\n'
+    return 'Node ' + str(name) + ' ' + text + '\n'
+
+
+# Writes events out in batches from a background thread
+class Flusher():
+
+    def __init__(self, stream=None, level=WARNING, interval=FLUSH_INTERVAL):
+        self.stream = stream            # Where lines go.  None means whatever sys.stdout is when they're written.
+        self.level = level              # Events below this level aren't written
+        self.interval = interval        # Seconds between writes
+        self.pending = []               # Events waiting for the next write
+        self.lock = threading.Lock()
+        self.thread = None              # Started by the first event
+        atexit.register(self.flush)     # Don't lose the last batch when the program ends
+
+    def put(self, event):
+        with self.lock:
+            self.pending.append(event)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):                    # Write everything waiting, in one go
+        with self.lock:
+            events = self.pending
+            self.pending = []
+        if len(events) == 0:
+            return
+        stream = self.stream or sys.stdout
+        stream.write(''.join([format(e) for e in events]))
+        stream.flush()
+
+
+output = Flusher()      # Shared by every EventLog in the process unless it's given its own.  Set output.level to see more.
+
+
+class EventLog():
+
+    def __init__(self, name=None, level=INFO, capacity=CAPACITY, flusher=None):
+        self.name = name                # Written in front of every event.  A node sets this to its ID.
+        self.level = level              # Events below this level aren't kept
+        self.events = collections.deque(maxlen=capacity)    # The most recent events kept, oldest first
+        self.flusher = flusher or output
+
+    def enabled(self, level):           # Whether an event at <level> would be kept or written.  Check this before working out expensive arguments.
+        return level >= self.level or level >= self.flusher.level
+
+    def log(self, level, text, *args):  # <text> is a % format string for <args>.  It is only formatted if the event is written.
+        if level < self.level and level < self.flusher.level:
+            return
+        event = (time.time(), level, self.name, text, args)
+        if level >= self.level:
+            self.events.append(event)
+        if level >= self.flusher.level:
+            self.flusher.put(event)
+
+    def debug(self, text, *args):
+        if DEBUG >= self.level or DEBUG >= self.flusher.level:
+            self.log(DEBUG, text, *args)
+
+    def info(self, text, *args):
+        if INFO >= self.level or INFO >= self.flusher.level:
+            self.log(INFO, text, *args)
+
+    def warning(self, text, *args):
+        self.log(WARNING, text, *args)
+
+    def error(self, text, *args):
+        self.log(ERROR, text, *args)
+
+    def recent(self, level=DEBUG):      # Kept events at or above <level>, oldest first
+        return [e for e in self.events if e[1] >= level]
+
+    def dump(self, stream=None, level=DEBUG):   # Write out the kept events, with their times and levels
+        write(self.recent(level), stream)
+
+
+def write(events, stream=None):     # Write <events> with their times and levels in front
+    stream = stream or sys.stdout
+    stream.write(''.join([time.strftime('%H:%M:%S', time.localtime(e[0])) + ('%.3f' % (e[0] % 1))[1:] + ' ' +
+                          LEVEL_NAMES.get(e[1], str(e[1])).ljust(8) + format(e) for e in events]))
+    stream.flush()
+
+
+def dump(logs, stream=None, level=DEBUG):   # Write the kept events of several logs (a ring's nodes', say) merged in time order
+    write(sorted((e for log in logs for e in log.recent(level)), key=lambda e: e[0]), stream)
@@ -0,0 +1,181 @@
+import bisect
+import json
+
+# Counters and histograms for watching a ring under load.
+# Every ChordNode keeps a NodeMetrics: how many messages of each type it has handled, how many hops each request
+# it served took to reach it, how deep its mailbox was when it got to each message, and how often it had to
+# repair its fingers.  Every Client keeps a ClientMetrics with end-to-end latency histograms for each kind of
+# request.  Recording is a few integer additions, so it is always on.  snapshot() adds up a whole ring (and any
+# clients) into one dictionary, which to_json() and to_prometheus() turn into something a dashboard can read.
+
+HOP_BOUNDS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 12, 16, 20, 24, 32, 48, 64)   # Upper bounds of the hop histogram's buckets
+DEPTH_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)
+LATENCY_BOUNDS = tuple(0.0001 * 2**i for i in range(0, 24))             # 100us up to about 14 minutes.  Simulated rings count in virtual time units instead.
+HOT_NODES = 10      # Busiest nodes listed in a snapshot
+
+
+class Histogram():
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds                        # Upper bound of each bucket, ascending.  Anything larger goes in one more bucket at the end.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):                         # Add <other>'s observations to this one.  Both must have the same bounds.
+        for i in range(0, len(self.counts)):
+            self.counts[i] += other.counts[i]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else 0
+
+    def quantile(self, q):                          # Upper bound of the bucket the <q> quantile falls in
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i in range(0, len(self.bounds)):
+            seen += self.counts[i]
+            if seen >= rank:
+                return self.bounds[i]
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'mean': self.mean(),
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': dict((str(self.bounds[i]), self.counts[i]) for i in range(0, len(self.bounds))), 'overflow': self.counts[-1]}
+
+
+class NodeMetrics():
+
+    def __init__(self, names):
+        self.names = names                          # Name of each message type, indexed by type
+        self.handled = [0] * len(names)             # Messages handled, indexed by type
+        self.hops = Histogram(HOP_BOUNDS)           # Hops taken by each GET or SET this node served as the owner
+        self.depth = Histogram(DEPTH_BOUNDS)        # Messages still waiting in the mailbox each time one was taken out
+        self.finger_repairs = 0                     # Finger updates that moved a finger to a different node
+        self.finger_refreshes = 0                   # Finger repair passes that sent out lookups
+        self.finger_lookups = 0                     # Lookups sent to re-resolve fingers
+
+    def merge(self, other):
+        for i in range(0, len(self.handled)):
+            self.handled[i] += other.handled[i]
+        self.hops.merge(other.hops)
+        self.depth.merge(other.depth)
+        self.finger_repairs += other.finger_repairs
+        self.finger_refreshes += other.finger_refreshes
+        self.finger_lookups += other.finger_lookups
+
+    def total(self):
+        return sum(self.handled)
+
+
+class ClientMetrics():
+
+    def __init__(self):
+        self.latency = {}                           # Request kind ('get', 'set', 'multi_get', 'multi_set', 'broadcast') -> Histogram of send-to-completion time
+
+    def observe(self, kind, latency):
+        histogram = self.latency.get(kind)
+        if histogram is None:
+            histogram = self.latency[kind] = Histogram(LATENCY_BOUNDS)
+        histogram.observe(latency)
+
+    def merge(self, other):
+        for kind in other.latency:
+            if kind not in self.latency:
+                self.latency[kind] = Histogram(LATENCY_BOUNDS)
+            self.latency[kind].merge(other.latency[kind])
+
+
+def snapshot(nodes, clients=(), hot=HOT_NODES):    # Ring-wide totals for <nodes> (ChordNodes) and <clients>, as a dictionary
+    ring = None
+    busiest = []
+    count = 0
+    for node in nodes:
+        m = node.metrics
+        if ring is None:
+            ring = NodeMetrics(m.names)
+        ring.merge(m)
+        busiest.append((m.total(), node.id, node.mailbox.qsize() if node.mailbox is not None else 0, m.depth.max))
+        count += 1
+    busiest.sort(reverse=True)
+    latency = ClientMetrics()
+    for client in clients:
+        latency.merge(client.metrics)
+    if ring is None:
+        ring = NodeMetrics(())
+    return {
+        'nodes': count,
+        'messages': dict((ring.names[t], ring.handled[t]) for t in range(0, len(ring.names)) if ring.handled[t] > 0),
+        'hops': ring.hops.to_dict(),
+        'mailbox_depth': ring.depth.to_dict(),
+        'finger_repairs': ring.finger_repairs,
+        'finger_refreshes': ring.finger_refreshes,
+        'finger_lookups': ring.finger_lookups,
+        'hot_nodes': [{'id': id, 'messages': total, 'depth': depth, 'max_depth': max_depth} for total, id, depth, max_depth in busiest[:hot]],
+        'latency': dict((kind, latency.latency[kind].to_dict()) for kind in sorted(latency.latency)),
+    }
+
+
+def to_json(snap):
+    return json.dumps(snap, indent=2, sort_keys=True)
+
+
+def to_prometheus(snap, prefix='chord'):            # The Prometheus text exposition format
+    lines = []
+
+    def metric(name, kind, help):
+        lines.append('# HELP ' + prefix + '_' + name + ' ' + help)
+        lines.append('# TYPE ' + prefix + '_' + name + ' ' + kind)
+
+    def histogram(name, h, labels=''):
+        seen = 0
+        for bound in h['buckets']:
+            seen += h['buckets'][bound]
+            lines.append(prefix + '_' + name + '_bucket{' + labels + 'le="' + bound + '"} ' + str(seen))
+        lines.append(prefix + '_' + name + '_bucket{' + labels + 'le="+Inf"} ' + str(h['count']))
+        lines.append(prefix + '_' + name + '_sum' + ('{' + labels.rstrip(',') + '}' if labels else '') + ' ' + str(h['sum']))
+        lines.append(prefix + '_' + name + '_count' + ('{' + labels.rstrip(',') + '}' if labels else '') + ' ' + str(h['count']))
+
+    metric('nodes', 'gauge', 'Nodes in the ring.')
+    lines.append(prefix + '_nodes ' + str(snap['nodes']))
+    metric('messages_total', 'counter', 'Messages handled, by type.')
+    for name in snap['messages']:
+        lines.append(prefix + '_messages_total{type="' + name + '"} ' + str(snap['messages'][name]))
+    metric('lookup_hops', 'histogram', 'Hops each GET or SET took to reach its owner.')
+    histogram('lookup_hops', snap['hops'])
+    metric('mailbox_depth', 'histogram', 'Messages waiting in a mailbox each time a node took one out.')
+    histogram('mailbox_depth', snap['mailbox_depth'])
+    metric('finger_repairs_total', 'counter', 'Finger updates that pointed a finger at a different node.')
+    lines.append(prefix + '_finger_repairs_total ' + str(snap['finger_repairs']))
+    metric('finger_refreshes_total', 'counter', 'Finger repair passes that sent out lookups.')
+    lines.append(prefix + '_finger_refreshes_total ' + str(snap['finger_refreshes']))
+    metric('finger_lookups_total', 'counter', 'Lookups sent to re-resolve fingers.')
+    lines.append(prefix + '_finger_lookups_total ' + str(snap['finger_lookups']))
+    metric('node_messages', 'gauge', 'Messages handled by the busiest nodes.')
+    for hot in snap['hot_nodes']:
+        lines.append(prefix + '_node_messages{node="' + str(hot['id']) + '"} ' + str(hot['messages']))
+    metric('node_mailbox_depth', 'gauge', 'Messages waiting in the busiest nodes\' mailboxes right now.')
+    for hot in snap['hot_nodes']:
+        lines.append(prefix + '_node_mailbox_depth{node="' + str(hot['id']) + '"} ' + str(hot['depth']))
+    metric('node_max_mailbox_depth', 'gauge', 'Deepest mailbox seen at the busiest nodes.')
+    for hot in snap['hot_nodes']:
+        lines.append(prefix + '_node_max_mailbox_depth{node="' + str(hot['id']) + '"} ' + str(hot['max_depth']))
+    metric('request_latency', 'histogram', 'Time from a client sending a request to its completion, by kind.')
+    for kind in snap['latency']:
+        histogram('request_latency', snap['latency'][kind], 'kind="' + kind + '",')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,168 @@
+import bisect
+import random
+import time
+import sys
+
+try:
+    import numpy
+except ImportError:     # Everything still works without NumPy, one ID at a time
+    numpy = None
+
+# A model of a stabilized ring, worked out directly from its sorted node IDs instead of by sending messages.
+# The node responsible for a key is the first node ID at or after it, going round past zero, so finding the owners
+# of a whole array of keys is one searchsorted() over the node IDs.  Every node's finger table is the owners of
+# (id + 2**k) % 2**bits for each k, so the fingers of the whole ring come out of the same search over an
+# n-by-bits array.  RingBuilder.build_ring() uses this to place large rings, and audit() uses it as the ground
+# truth a live ring's predecessors, fingers, hash tables and replicas are checked against.
+# NumPy does the searching when it is installed and the IDs fit in 64 bits.  Otherwise it falls back on bisect.
+
+WIDEST = 64             # Most hash bits NumPy can handle.  Wider IDs fall back on bisect.
+CHUNK = 2**22           # Most finger starts searched in one pass, to keep the temporary arrays a sensible size
+SAMPLE = 10             # Problems listed by name in an audit report.  The rest are only counted.
+
+
+class RingOracle():
+
+    def __init__(self, ids, hash_bits):
+        self.bits = hash_bits
+        self.size = 2**hash_bits
+        self.ids = sorted(ids)          # Node IDs, in ring order
+        self.array = None               # The same IDs as a NumPy array, if NumPy is doing the work
+        if numpy is not None and hash_bits <= WIDEST:
+            self.array = numpy.array(self.ids, dtype=numpy.uint64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def owner(self, key):               # ID of the node responsible for the ID <key>
+        return self.ids[bisect.bisect_left(self.ids, key) % len(self.ids)]
+
+    def owners(self, keys):             # IDs of the nodes responsible for each ID in <keys>.  An array if NumPy is in use, a list otherwise.
+        if self.array is None:
+            ids = self.ids
+            n = len(ids)
+            return [ids[bisect.bisect_left(ids, key) % n] for key in keys]
+        keys = numpy.asarray(keys, dtype=numpy.uint64)
+        return self.array[numpy.searchsorted(self.array, keys) % len(self.array)]
+
+    def predecessor(self, id):          # The node before <id>, which must be one of the ring's nodes
+        return self.ids[bisect.bisect_left(self.ids, id) - 1]
+
+    def starts(self, id):               # The start of each of <id>'s fingers
+        return [(id + 2**k) % self.size for k in range(0, self.bits)]
+
+    def finger_nodes(self, id):         # The node each of <id>'s fingers should point at
+        return [self.owner(start) for start in self.starts(id)]
+
+    def fingers(self, lo=0, hi=None):   # A list of finger nodes for each of the nodes ids[lo:hi], in order.  Plain ints either way.
+        if hi is None:
+            hi = len(self.ids)
+        if self.array is None:
+            return [self.finger_nodes(id) for id in self.ids[lo:hi]]
+        ids = self.array
+        n = len(ids)
+        steps = numpy.array([2**k for k in range(0, self.bits)], dtype=numpy.uint64)
+        rows = max(1, CHUNK // self.bits)
+        table = []
+        for first in range(lo, hi, rows):
+            starts = ids[first:min(first + rows, hi), None] + steps[None, :]   # Can't overflow below 64 bits.  At 64 bits, wrapping round is exactly the ring.
+            if self.bits < WIDEST:
+                starts %= numpy.uint64(self.size)
+            table.extend(ids[numpy.searchsorted(ids, starts) % n].tolist())
+        return table
+
+    def audit(self, nodes):             # Compare live ChordNodes against the model.  Returns a report dictionary.
+        report = {'nodes': 0, 'predecessors': 0, 'fingers': 0, 'keys': 0, 'misplaced': 0, 'unreplicated': 0, 'duplicates': 0, 'errors': []}
+        errors = report['errors']
+        holders = []                    # The node holding each key, in the same order as keys
+        keys = []
+        table = self.fingers()
+        index = dict((self.ids[i], i) for i in range(0, len(self.ids)))
+        nodes = list(nodes)
+        by_id = dict((node.id, node) for node in nodes)
+        for node in nodes:
+            i = index.get(node.id)
+            if i is None:
+                errors.append('Node ' + str(node.id) + ' is not part of the ring')
+                continue
+            report['nodes'] += 1
+            if node.predecessor != self.ids[i - 1]:
+                report['predecessors'] += 1
+                if len(errors) < SAMPLE:
+                    errors.append('Node ' + str(node.id) + ' has predecessor ' + str(node.predecessor) + ', should be ' + str(self.ids[i - 1]))
+            want = table[i]
+            for k in range(0, self.bits):
+                have = node.finger_table[k].node if k < len(node.finger_table) else None
+                if have != want[k]:
+                    report['fingers'] += 1
+                    if len(errors) < SAMPLE:
+                        errors.append('Node ' + str(node.id) + ' finger ' + str(k) + ' points at ' + str(have) + ', should be ' + str(want[k]))
+            stored = list(node.hash_table.keys())
+            keys.extend(stored)
+            holders.extend([node.id] * len(stored))
+            for j in range(1, min(node.config.replicas, len(self.ids) - 1) + 1):    # The next config.replicas nodes should each have a copy of every key
+                holder = by_id.get(self.ids[(i + j) % len(self.ids)])
+                if holder is None:
+                    continue
+                replica = holder.replicas.get(node.id)
+                missing = len(stored) if replica is None else sum(1 for id in stored if id not in replica.store)
+                report['unreplicated'] += missing
+                if missing > 0 and len(errors) < SAMPLE:
+                    errors.append('Node ' + str(holder.id) + ' is missing ' + str(missing) + ' of node ' + str(node.id) + '\'s keys')
+        report['keys'] = len(keys)
+        report['duplicates'] = len(keys) - len(set(keys))   # Extra copies in hash_tables.  One of each is misplaced, too.
+        if len(keys) > 0 and len(self.ids) > 0:
+            owners = self.owners(keys)
+            if self.array is None:
+                wrong = [j for j in range(0, len(keys)) if owners[j] != holders[j]]
+            else:
+                wrong = numpy.nonzero(owners != numpy.array(holders, dtype=numpy.uint64))[0].tolist()
+                owners = owners.tolist()
+            report['misplaced'] = len(wrong)
+            for j in wrong[:max(0, SAMPLE - len(errors))]:
+                errors.append('Key ' + str(keys[j]) + ' is stored on node ' + str(holders[j]) + ', should be on ' + str(owners[j]))
+        return report
+
+
+def audit(nodes, hash_bits=None):       # Build a model from the live <nodes> themselves and audit them against it
+    nodes = [node for node in nodes if node.joined and node.queues.get(node.id) is not None]
+    if hash_bits is None:
+        hash_bits = nodes[0].config.hash_bits if nodes else 32
+    return RingOracle([node.id for node in nodes], hash_bits).audit(nodes)
+
+
+# Main
+# Usage: python oracle.py [nodes] [hash bits] [keys]
+# Builds a ring with the oracle and checks it, finds the owners of a batch of random keys, then stores some
+# keys through the ring and audits where they ended up.
+if __name__ == '__main__':
+    from sim import Simulator
+    from client import Client
+    from chord import RingConfig
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    bits = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 1000000
+    print('NumPy: ' + ('yes' if numpy is not None and bits <= WIDEST else 'no'))
+
+    sim = Simulator(seed=1, config=RingConfig(hash_bits=bits))
+    start = time.time()
+    nodes = sim.build_ring(n)
+    print('Built ' + str(n) + ' nodes in ' + str(round(time.time() - start, 3)) + 's')
+
+    oracle = RingOracle([node.id for node in nodes], bits)
+    rng = random.Random(1)
+    keys = [rng.randrange(2**bits) for i in range(0, count)]
+    start = time.time()
+    owners = oracle.owners(keys)
+    print('Found owners of ' + str(count) + ' keys in ' + str(round(time.time() - start, 3)) + 's')
+
+    client = Client(sim.queues, entry=nodes[0].id, engine=sim)
+    for i in range(0, 1000):
+        client.set('key' + str(i), i)
+    sim.run()
+    start = time.time()
+    report = audit(nodes)
+    print('Audited in ' + str(round(time.time() - start, 3)) + 's: ' + str(report['nodes']) + ' nodes, ' + str(report['keys']) + ' keys, ' +
+          str(report['predecessors']) + ' wrong predecessors, ' + str(report['fingers']) + ' wrong fingers, ' + str(report['misplaced']) + ' misplaced keys, ' + str(report['duplicates']) + ' duplicates, ' + str(report['unreplicated']) + ' missing copies')
+    for error in report['errors']:
+        print(error)
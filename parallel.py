@@ -0,0 +1,299 @@
+from chord import ChordNode, Message, RingConfig, LEAVE_NETWORK
+from sim import Simulator, SimQueue, LATENCY
+from client import Client
+from oracle import RingOracle
+import multiprocessing
+import random
+import bisect
+import time
+import sys
+
+# Sharded discrete-event simulation across worker processes.
+# The identifier circle is cut into contiguous ranges, one per worker, and each worker runs an ordinary
+# Simulator for the nodes whose IDs fall in its range.  Node code doesn't change: local IDs in the queues
+# dictionary map to SimQueues, and every other ID maps to a RemoteQueue that holds messages for the owning
+# shard.  Time advances in windows.  Every message takes at least <latency> to arrive, so if every worker
+# stops at the earliest pending event plus the latency, nothing sent during a window is due inside it.  At
+# the end of each window the coordinator swaps the held messages between workers, one batch per pipe, along
+# with the IDs of nodes that joined or left, so every shard's queues dictionary stays in step.
+
+
+# Stands in for the queue of a node in another shard.  Messages wait here until the end of the window.
+class RemoteQueue():
+
+    def __init__(self, engine, id, shard):
+        self.engine = engine    # The local shard's simulator
+        self.id = id            # The key this queue is stored under in the queues dictionary
+        self.shard = shard      # Index of the shard the node or client lives in
+        self.last = 0           # Time of the latest delivery scheduled here, like SimQueue.last
+
+    def put(self, msg):
+        self.engine.outbox[self.shard].append((self.engine.delivery_time(self), self.id, msg, self.engine.quiet))
+
+    def qsize(self):            # Another shard's mailbox can't be seen from here
+        return 0
+
+
+# The queues dictionary for one shard.  Notes local nodes and clients coming and going so the other shards can be told.
+class ShardQueues(dict):
+
+    def __init__(self):
+        dict.__init__(self)
+        self.changes = []       # (key, present) for each local queue added or removed since the last window
+
+    def __setitem__(self, key, q):
+        dict.__setitem__(self, key, q)
+        if isinstance(q, SimQueue):
+            self.changes.append((key, True))
+
+    def __delitem__(self, key):
+        if isinstance(self.get(key), SimQueue):
+            self.changes.append((key, False))
+        dict.__delitem__(self, key)
+
+
+class Shard(Simulator):
+
+    def __init__(self, index, bounds, seed=0, latency=LATENCY, jitter=0, config=None):
+        Simulator.__init__(self, seed=seed, latency=latency, jitter=jitter, config=config)
+        self.index = index          # Which shard this is
+        self.bounds = bounds        # The lowest ID in each shard.  Shard i holds IDs from bounds[i] up to bounds[i + 1].
+        queues = ShardQueues()
+        dict.update(queues, self.queues)    # Keep 'root', but don't announce it.  Every shard has its own.
+        self.queues = queues
+        self.outbox = [[] for b in bounds]  # (time, key, message, background) held for each shard until the end of the window
+
+    def shard_of(self, id):
+        return bisect.bisect_right(self.bounds, id) - 1
+
+    def build(self, ids):                   # Place this shard's nodes of a ready-made ring, and point at everyone else's
+        nodes = []
+        lo = bisect.bisect_left(ids, self.bounds[self.index])      # This shard's nodes are ids[lo:hi]
+        hi = bisect.bisect_left(ids, self.bounds[self.index + 1]) if self.index + 1 < len(self.bounds) else len(ids)
+        table = RingOracle(ids, self.config.hash_bits).fingers(lo, hi)
+        for i in range(0, len(ids)):
+            shard = self.shard_of(ids[i])
+            if shard == self.index:
+                nodes.append(self.place_node(ids, i, table[i - lo]))
+            else:
+                dict.__setitem__(self.queues, ids[i], RemoteQueue(self, ids[i], shard))
+        self.queues.changes = []            # Every shard built the same ring.  Nothing to tell the others.
+        return nodes
+
+    def learn(self, changes):               # Apply (key, shard, present) changes from the other shards
+        for key, shard, present in changes:
+            if present:
+                dict.__setitem__(self.queues, key, RemoteQueue(self, key, shard))
+            elif isinstance(self.queues.get(key), RemoteQueue):
+                dict.__delitem__(self.queues, key)
+
+    def deliver(self, batch):               # Schedule (time, key, message, background) deliveries sent from other shards
+        for t, key, msg, quiet in batch:
+            q = self.queues.get(key)
+            if isinstance(q, SimQueue):
+                self.schedule(q, msg, t, quiet)
+            else:                           # It left before the message got here
+                self.dropped += 1
+
+    def next_time(self):
+        return self.events[0][0] if self.busy() else None
+
+    def flush(self):                        # Hand over what the coordinator needs at the end of a window
+        outbox = self.outbox
+        self.outbox = [[] for b in self.bounds]
+        changes = [(key, self.index, present) for key, present in self.queues.changes]
+        self.queues.changes = []
+        return self.next_time(), outbox, changes
+
+
+def work(conn, index, bounds, seed, latency, jitter, config):    # Body of each worker process.  Carries out the coordinator's commands until told to stop.
+    shard = Shard(index, bounds, seed=seed, latency=latency, jitter=jitter, config=config)
+    client = None
+    futures = []                            # Futures for the requests this shard's client has submitted, in order
+    while True:
+        cmd = conn.recv()
+        op = cmd[0]
+        if op == 'build':
+            nodes = shard.build(cmd[1])
+            client = Client(shard.queues, name='client' + str(index), entry=nodes[0].id if nodes else None, engine=shard, window=cmd[2])
+        elif op == 'join':
+            ChordNode(shard.queues, engine=shard, config=shard.config, id=cmd[1]).join_network()
+        elif op == 'leave':
+            shard.queues[cmd[1]].put(Message(LEAVE_NETWORK, client.name))
+        elif op == 'ops':
+            for request in cmd[1]:
+                futures.append(getattr(client, request[0])(*request[1:]))
+        elif op == 'step':
+            shard.learn(cmd[2])
+            shard.deliver(cmd[3])
+            shard.run(until=cmd[1])
+        elif op == 'results':
+            conn.send([f.result() if f.done() else None for f in futures])
+            futures = []
+            continue
+        elif op == 'stats':
+            conn.send({'nodes': sum(1 for k in shard.queues if isinstance(shard.queues[k], SimQueue) and not isinstance(k, str)),
+                       'delivered': shard.delivered, 'dropped': shard.dropped, 'crashed': shard.crashed,
+                       'completed': client.completed, 'pending': client.pending()})
+            continue
+        elif op == 'stop':
+            conn.close()
+            return
+        conn.send(shard.flush())
+
+
+class ParallelSimulator():
+
+    def __init__(self, workers, seed=0, latency=LATENCY, jitter=0, config=None, window=64):
+        self.config = config or RingConfig()
+        self.latency = latency
+        self.window = window                # Each shard's client keeps this many requests in flight
+        self.rng = random.Random(seed)      # Draws node IDs.  Each shard seeds its own generator from <seed> and its index.
+        size = 2**self.config.hash_bits
+        self.bounds = [size * i // workers for i in range(0, workers)]
+        self.ids = set()                    # IDs of every node, wherever it lives
+        self.now = 0
+        self.windows = 0                    # Time windows run so far
+        self.next_times = [None] * workers  # When each shard's next event is due
+        self.incoming = [[] for i in range(0, workers)]     # Messages waiting to be handed to each shard
+        self.changes = []                   # Membership changes waiting to be passed on
+        self.conns = []
+        self.procs = []
+        for i in range(0, workers):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=work, args=(child, i, self.bounds, seed * workers + i, latency, jitter, self.config), daemon=True)
+            proc.start()
+            self.conns.append(conn)
+            self.procs.append(proc)
+
+    def shard_of(self, id):
+        return bisect.bisect_right(self.bounds, id) - 1
+
+    def command(self, i, cmd):              # Send one shard a command and take in what it sends back
+        self.conns[i].send(cmd)
+        self.collect(i, self.conns[i].recv())
+
+    def collect(self, i, reply):
+        self.next_times[i], outbox, changes = reply
+        for j in range(0, len(outbox)):
+            self.incoming[j].extend(outbox[j])
+        self.changes.extend(changes)
+
+    def build_ring(self, n):                # Create a stabilized ring of n nodes spread over the shards
+        size = 2**self.config.hash_bits
+        while len(self.ids) < n:
+            self.ids.add(self.rng.randrange(size))
+        ids = sorted(self.ids)
+        for conn in self.conns:             # Let all the shards build at once
+            conn.send(('build', ids, self.window))
+        for i in range(0, len(self.conns)):
+            self.collect(i, self.conns[i].recv())
+        return ids
+
+    def add_node(self):                     # Join a new node through the normal protocol.  Returns its ID.
+        size = 2**self.config.hash_bits
+        id = self.rng.randrange(size)
+        while id in self.ids:
+            id = self.rng.randrange(size)
+        self.ids.add(id)
+        self.command(self.shard_of(id), ('join', id))
+        return id
+
+    def remove_node(self, id):              # Tell a node to leave the network
+        self.ids.discard(id)
+        self.command(self.shard_of(id), ('leave', id))
+
+    def submit(self, requests):             # Takes a list of client calls like ('get', name) or ('set', name, data).  They're dealt out to the shards' clients in turn.
+        n = len(self.conns)
+        for i in range(0, n):
+            if len(requests) > i:
+                self.command(i, ('ops', requests[i::n]))
+
+    def results(self):                      # Results of the requests submitted since the last call, in the order they were submitted.  None if not finished.
+        n = len(self.conns)
+        parts = []
+        for conn in self.conns:
+            conn.send(('results',))
+            parts.append(conn.recv())
+        results = [None] * sum(len(p) for p in parts)
+        for i in range(0, n):
+            results[i::n] = parts[i]
+        return results
+
+    def stats(self):                        # Totals across all the shards
+        totals = {'windows': self.windows, 'now': self.now}
+        for conn in self.conns:
+            conn.send(('stats',))
+            for key, value in conn.recv().items():
+                if key in totals:
+                    totals[key] += value
+                else:
+                    totals[key] = value
+        return totals
+
+    def run(self, until=None):              # Run windows until nothing but background work is left to deliver, or the next event is past <until>
+        while True:
+            times = [t for t in self.next_times if t is not None] + [m[0] for batch in self.incoming for m in batch if not m[3]]
+            if len(times) == 0 and len(self.changes) == 0:
+                break
+            start = min(times) if times else self.now
+            if until is not None and start > until:
+                self.now = until
+                break
+            end = start + self.latency      # Nothing sent in this window can arrive before <end>
+            incoming = self.incoming
+            changes = self.changes
+            self.incoming = [[] for conn in self.conns]
+            self.changes = []
+            for i in range(0, len(self.conns)):
+                self.conns[i].send(('step', end, [c for c in changes if c[1] != i], incoming[i]))
+            for i in range(0, len(self.conns)):
+                self.collect(i, self.conns[i].recv())
+            self.now = end
+            self.windows += 1
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('stop',))
+        for proc in self.procs:
+            proc.join()
+
+
+# Main
+# Usage: python parallel.py [nodes] [workers] [requests] [hash bits]
+# Stores and reads back <requests> keys on the same ring, first in one process and then sharded, and prints both times.
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    bits = int(sys.argv[4]) if len(sys.argv) > 4 else 32
+    config = RingConfig(hash_bits=bits)
+    sets = [('set', 'key' + str(i), i) for i in range(0, count)]
+    gets = [('get', 'key' + str(i)) for i in range(0, count)]
+
+    start = time.time()
+    sim = Simulator(seed=1, config=config)
+    sim.build_ring(n)
+    clients = [Client(sim.queues, name='client' + str(i), engine=sim, window=64) for i in range(0, workers)]
+    for i in range(0, count):
+        clients[i % workers].set(*sets[i][1:])
+    sim.run()
+    futures = [clients[i % workers].get(*gets[i][1:]) for i in range(0, count)]
+    sim.run()
+    correct = sum(1 for i in range(0, count) if futures[i].result() == i)
+    print('One process:  ' + str(round(time.time() - start, 2)) + 's  delivered ' + str(sim.delivered) + '  correct ' + str(correct))
+
+    start = time.time()
+    psim = ParallelSimulator(workers, seed=1, config=config)
+    psim.build_ring(n)
+    psim.submit(sets)
+    psim.run()
+    psim.results()
+    psim.submit(gets)
+    psim.run()
+    results = psim.results()
+    stats = psim.stats()
+    psim.close()
+    correct = sum(1 for i in range(0, count) if results[i] == i)
+    print(str(workers) + ' workers:    ' + str(round(time.time() - start, 2)) + 's  delivered ' + str(stats['delivered']) + '  correct ' + str(correct) +
+          '  windows ' + str(stats['windows']))
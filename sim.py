@@ -0,0 +1,219 @@
+from chord import ChordNode, Finger, Message, RingConfig, MAINTAIN, GET_REQUEST
+from client import Client
+from oracle import RingOracle
+from vnodes import Host
+import heapq
+import random
+import bisect
+import traceback
+import time
+import sys
+
+# Discrete-event simulation of a Chord ring.
+# Instead of giving every ChordNode its own thread, a single loop pops timestamped deliveries off a
+# priority queue and hands each message to the receiving node's handlers.  Time is virtual, so nothing
+# sleeps, and every random choice comes from one seeded generator, so the same seed gives the same run.
+# If the ring's config sets a stabilize_interval, each node also gets a MAINTAIN message that often.  The timers,
+# and whatever the rounds they start send, are background work: once nothing else is left, the ring is idle and
+# run() returns.  The timers carry on from there the next time it's run.
+
+LATENCY = 1     # Virtual time a message spends in flight between two nodes
+
+
+# Stands in for a node's queue.Queue.  Putting a message on it schedules a delivery instead of storing it.
+class SimQueue():
+
+    def __init__(self, engine, id, handler):
+        self.engine = engine    # The simulator that owns the event queue
+        self.id = id            # The key this queue is stored under in the queues dictionary
+        self.handler = handler  # Called with each message when it is delivered.  None once the owner has crashed.
+        self.last = 0           # Time of the latest delivery scheduled here.  Keeps deliveries in order when latency jitters.
+        self.depth = 0          # Messages scheduled here and not delivered yet
+
+    def put(self, msg):
+        self.engine.schedule(self, msg)
+
+    def qsize(self):            # Like queue.Queue.qsize().  Messages still in flight to this queue count as waiting in it.
+        return self.depth
+
+
+# Ways to set up a ring that work the same for any engine with queues, config and rng attributes
+class RingBuilder():
+
+    def add_node(self):                     # Start joining a node through the normal protocol.  It finishes as the simulation runs.
+        node = ChordNode(self.queues, engine=self, config=self.config)
+        node.join_network()
+        return node
+
+    def build_ring(self, n):                # Create n nodes at once with correct predecessors and finger tables.  Skips the join protocol entirely.
+        ids = self.draw_ids(n)
+        table = RingOracle(ids, self.config.hash_bits).fingers()     # Every node's fingers in one pass
+        return [self.place_node(ids, i, table[i]) for i in range(0, n)]
+
+    def build_hosts(self, n, count):        # Like build_ring(), but n Hosts of <count> virtual nodes each, their IDs dealt out at random
+        ids = self.draw_ids(n * count)
+        table = RingOracle(ids, self.config.hash_bits).fingers()
+        hosts = [Host(self.queues, engine=self) for i in range(0, n)]
+        order = list(range(0, len(ids)))
+        self.rng.shuffle(order)
+        for j in range(0, len(order)):
+            self.place_node(ids, order[j], table[order[j]], engine=hosts[j % n])
+        return hosts
+
+    def draw_ids(self, n):                  # n unique random node IDs, sorted
+        size = 2**self.config.hash_bits
+        ids = set()
+        while len(ids) < n:                 # random.sample() can't take a range wider than 64 bits
+            ids.add(self.rng.randrange(size))
+        return sorted(ids)
+
+    def place_node(self, ids, i, fingers=None, engine=None):    # Create the node with ID ids[i] as if the sorted <ids> were already a stabilized ring.  <fingers> are its finger nodes, if already known.
+        bits = self.config.hash_bits                                # <engine> is the Host it runs on, if it's a virtual node.
+        size = 2**bits
+        node = ChordNode(self.queues, engine=engine or self, config=self.config, id=ids[i])
+        node.queues[node.id] = node.new_queue()
+        node.hash_table = node.new_store()
+        node.predecessor = ids[i - 1]
+        node.successors = [ids[(i + k) % len(ids)] for k in range(1, min(self.config.replicas, len(ids) - 1) + 1)]
+        for k in range(0, bits):
+            start = (node.id + 2**k) % size
+            node.finger_table.append(Finger(start, fingers[k] if fingers is not None else ids[bisect.bisect_left(ids, start) % len(ids)]))
+        node.joined = True
+        if node.trace is not None:
+            node.trace.place(node)
+        return node
+
+
+class Simulator(RingBuilder):
+
+    def __init__(self, seed=0, latency=LATENCY, jitter=0, config=None):
+        self.config = config or RingConfig()    # Passed to every node, so the whole ring agrees on ID width and the like
+        self.rng = random.Random(seed)      # Every node in the simulation draws from this, so the seed fixes the whole run
+        self.latency = latency              # Fixed part of the message delay
+        self.jitter = jitter                # Random extra delay, up to this much, added to each message
+        self.now = 0                        # The virtual clock
+        self.events = []                    # Heap of (time, sequence, queue, message, background) deliveries
+        self.seq = 0                        # Breaks ties between deliveries at the same time in the order they were sent
+        self.nodes = {}                     # Every node that has attached to the simulator, by ID
+        self.inbox = []                     # Messages delivered to 'root'
+        self.queues = {}                    # Shared with the nodes, exactly like the threaded version
+        self.queues['root'] = SimQueue(self, 'root', self.inbox.append)
+        self.delivered = 0                  # Messages handed to a node
+        self.dropped = 0                    # Messages whose destination left the network before they arrived
+        self.crashed = []                   # IDs of nodes whose handler raised an exception
+        self.background = 0                 # Events in the queue that are maintenance timers, or were sent because of one
+        self.quiet = False                  # Set while handling a background event.  Everything it sends is background too.
+
+    def attach(self, node):                 # Called by ChordNode.new_queue() once the node has picked its ID
+        self.nodes[node.id] = node
+        self.start_rounds(node)
+        return SimQueue(self, node.id, node.step)
+
+    def start_rounds(self, node, delay=None):   # Set <node>'s maintenance timer, if the ring has one.  The first goes off somewhere in the first interval, to spread them out.
+        interval = self.config.stabilize_interval
+        if interval is None:
+            return
+        if delay is None:
+            delay = interval * self.rng.random()
+        self.seq += 1
+        self.background += 1
+        heapq.heappush(self.events, (self.now + delay, self.seq, None, node, True))
+
+    def tick(self, node):                   # <node>'s timer went off.  Send it a MAINTAIN and set the timer again, unless it has gone.
+        q = self.queues.get(node.id)
+        if not node.active or q is None:
+            return
+        q.put(Message(MAINTAIN, node.id))
+        self.start_rounds(node, self.config.stabilize_interval)
+
+    def busy(self):                         # Whether anything besides background work is left to run
+        return len(self.events) > self.background
+
+    def listen(self, name, handler):        # Gives a client a queue called <name>.  <handler> is called with every message delivered to it.
+        self.queues[name] = SimQueue(self, name, handler)
+        return self.queues[name]
+
+    def delivery_time(self, q):             # When a message put on <q> now should arrive
+        t = self.now + self.latency
+        if self.jitter:
+            t = max(t + self.rng.uniform(0, self.jitter), q.last)  # A queue is FIFO.  Never deliver a message before one that was sent earlier.
+            q.last = t
+        return t
+
+    def schedule(self, q, msg, t=None, quiet=None):     # Deliver <msg> to <q> at time <t>, or after the usual delay.  <quiet> says if it's background work, if not the same as what's sending it.
+        if t is None:
+            t = self.delivery_time(q)
+        if quiet is None:
+            quiet = self.quiet
+        self.seq += 1
+        q.depth += 1
+        if quiet:
+            self.background += 1
+        heapq.heappush(self.events, (t, self.seq, q, msg, quiet))
+
+    def run(self, until=None, max_events=None):     # Deliver messages until the event queue is empty, the clock passes <until>, or <max_events> have been handled.
+        events = self.events
+        count = 0
+        while len(events) > self.background or (until is not None and events):    # Only background work left means the ring is idle.  Stop, unless running to a time.
+            if until is not None and events[0][0] > until:
+                self.now = until
+                break
+            if max_events is not None and count >= max_events:
+                break
+            t, seq, q, msg, quiet = heapq.heappop(events)
+            self.now = t
+            count += 1
+            if quiet:
+                self.background -= 1
+            self.quiet = quiet
+            if q is None:                                               # A maintenance timer.  <msg> is the node.
+                self.tick(msg)
+                continue
+            q.depth -= 1
+            if q.handler is None or self.queues.get(q.id) is not q:    # The node left, or crashed, while the message was in flight.
+                self.dropped += 1
+                continue
+            self.delivered += 1
+            try:
+                q.handler(msg)
+            except Exception:                                           # A threaded node would lose its thread here.  Lose the node, not the simulation.
+                traceback.print_exc()
+                q.handler = None
+                self.crashed.append(q.id)
+        self.quiet = False
+        return count
+
+
+# Main
+# Usage: python sim.py [nodes] [hash bits] [iterative|recursive]
+# Builds a ring without threads, stores and retrieves the usual test keys, then prints how long it took.
+# Then checks that a lookup for the key right after each node takes one hop, to its successor.
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    bits = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    recursive = len(sys.argv) > 3 and sys.argv[3] == 'recursive'
+    sim = Simulator(seed=1, config=RingConfig(hash_bits=bits, recursive_lookup=recursive))
+    nodes = sim.build_ring(n)
+    keys = ['Chinchilla', 'Artichoke', 'Mozzerella', 'Spinnach', 'Alfredo', 'Komquat', 'Rosemary', 'Shrimp',
+            'Halibut', 'Corn', 'Yams', 'Horseraddish', 'Garlic', 'Cauliflower', 'Pasta', 'Mushroom']
+
+    client = Client(sim.queues, entry=nodes[0].id, engine=sim)
+    start = time.time()
+    for k in keys:
+        client.set(k, k)
+    sim.run()
+    gets = [client.get(k) for k in keys]
+    sim.run()
+    for i in range(0, len(keys)):
+        print(keys[i] + ' = ' + str(gets[i].result()))
+
+    print('---------------------------------------------------')
+    print('Nodes: ' + str(len(nodes)) + '  Completed: ' + str(client.completed) + '  Delivered: ' + str(sim.delivered) + '  Dropped: ' + str(sim.dropped) +
+          '  Virtual time: ' + str(sim.now) + '  Wall time: ' + str(round(time.time() - start, 3)) + 's')
+
+    for node in nodes if len(nodes) > 1 else []:    # A key right after a node belongs to its successor.  Looking it up from there should take one hop.
+        before = sim.delivered
+        sim.queues[node.id].put(Message(GET_REQUEST, 'root', file_id=(node.id + 1) % node.ring_size, requester='root'))
+        sim.run()
+        assert sim.delivered - before == 3, 'lookup for ' + str(node.id + 1) + ' from ' + str(node.id) + ' took ' + str(sim.delivered - before - 2) + ' hops'   # The request, the hop to the successor, and the answer
+    print('Successor lookups: one hop each')
@@ -0,0 +1,300 @@
+import bisect
+import struct
+import pickle
+import mmap
+import os
+import zlib
+
+# Storage for a node's share of the hash table.
+# A RingStore works like the dict it replaces, but also keeps its IDs in ring order, so a node can pull out
+# every key in a range of the identifier circle without testing each one.  The sorted list is brought up to
+# date lazily: new IDs wait in a list until the next range operation sorts them in, and deleted IDs are
+# remembered and skipped until there are enough of them to be worth clearing out.
+# A DiskStore has the same interface, but keeps the data in an append-only log file and only an index in memory.
+
+ID_BYTES = 20                       # Room for the widest ring ID, 160 bits
+HEADER = struct.Struct('>20sBII')   # Each log record: ID, kind of record, length of the data that follows, CRC-32 of the first three
+COMPACT_MIN = 1024 * 1024           # Don't bother compacting a log until it has at least this many bytes of garbage
+
+# Kinds of log record
+KIND_BYTES      = 0     # Raw bytes.  Read back as a memoryview straight into the mapped file.
+KIND_STR        = 1     # A UTF-8 string
+KIND_PICKLE     = 2     # Anything else
+KIND_TOMBSTONE  = 3     # The ID was deleted
+
+
+class RingStore():
+
+    def __init__(self, items=None):
+        self.data = {}          # ID -> file_data
+        self.ids = []           # Sorted IDs.  May still hold some deleted ones.
+        self.added = []         # IDs stored since the last sort
+        self.stale = set()      # IDs in ids or added that have since been deleted
+        if items is not None:
+            self.update(items)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, id):
+        return id in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, id):
+        return self.data[id]
+
+    def __setitem__(self, id, file_data):
+        if id not in self.data:
+            if id in self.stale:    # Deleted and stored again.  It's still in the sorted list.
+                self.stale.discard(id)
+            else:
+                self.added.append(id)
+        self.data[id] = file_data
+
+    def __delitem__(self, id):
+        del self.data[id]
+        self.stale.add(id)
+
+    def get(self, id, default=None):
+        return self.data.get(id, default)
+
+    def pop(self, id, *default):
+        if id in self.data:
+            self.stale.add(id)
+        return self.data.pop(id, *default)
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
+
+    def update(self, items):                # Takes a dictionary or an iterable of (ID, file_data) pairs
+        if isinstance(items, dict):
+            items = items.items()
+        for id, file_data in items:
+            self[id] = file_data
+
+    def clear(self):
+        self.data.clear()
+        self.ids = []
+        self.added = []
+        self.stale.clear()
+
+    def sort(self):                         # Bring the sorted list up to date
+        if len(self.added) > 0:
+            self.ids.extend(self.added)     # Timsort merges the new run into the sorted one in about linear time
+            self.ids.sort()
+            self.added = []
+        if len(self.stale) > len(self.data):    # Mostly dead weight.  Clear it out.
+            self.ids = [id for id in self.ids if id not in self.stale]
+            self.stale.clear()
+
+    def span(self, lb, ub):                 # Returns (lo, hi) indexes into ids for the IDs in (lb, ub].  lo > hi when the range wraps past zero.
+        self.sort()
+        return bisect.bisect_right(self.ids, lb), bisect.bisect_right(self.ids, ub)
+
+    def range_items(self, lb, ub):          # Yields (ID, file_data) for every ID in (lb, ub], in ring order starting after lb.  (lb, lb] is the whole circle.
+        lo, hi = self.span(lb, ub)
+        ids = self.ids[lo:hi] if lb < ub else self.ids[lo:] + self.ids[:hi]
+        data = self.data
+        for id in ids:
+            if id in data:
+                yield id, data[id]
+
+    def pop_range(self, lb, ub):            # Removes every ID in (lb, ub] and returns a list of their (ID, file_data), in ring order
+        lo, hi = self.span(lb, ub)
+        if lb < ub:
+            ids = self.ids[lo:hi]
+            del self.ids[lo:hi]
+        else:
+            ids = self.ids[lo:] + self.ids[:hi]
+            del self.ids[lo:]
+            del self.ids[:hi]
+        items = []
+        data = self.data
+        stale = self.stale
+        for id in ids:
+            if id in data:
+                items.append((id, data.pop(id)))
+            else:
+                stale.discard(id)           # It's out of the sorted list now
+        return items
+
+
+class DiskStore():
+
+    def __init__(self, path):
+        self.path = path                # The log file.  Reopening the same path gets the same data back.
+        self.index = RingStore()        # ID -> (offset, length, kind) of the ID's latest record.  The only per-key memory the store uses.
+        self.size = 0                   # Bytes in the log
+        self.garbage = 0                # Bytes in the log taken up by overwritten or deleted records
+        self.map = None                 # The log, mapped read-only.  None while it's empty.
+        self.file = open(path, 'a+b')
+        self.load()
+
+    def remap(self):                    # Map the whole log again, after it has grown
+        self.file.flush()
+        self.map = None                 # Don't close the old map.  Values read from it may still be in use.
+        if self.size > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load(self):                     # Rebuild the index from the log headers.  The data itself stays on disk.
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.remap()
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            id, kind, length, check = HEADER.unpack_from(self.map, offset)
+            if check != zlib.crc32(self.map[offset:offset + HEADER.size - 4]) or offset + HEADER.size + length > self.size:    # A record cut short by a crash.  Drop it and everything after.
+                break
+            self.note(int.from_bytes(id, 'big'), kind, offset + HEADER.size, length)
+            offset += HEADER.size + length
+        if offset < self.size:
+            self.map.close()
+            self.file.truncate(offset)
+            self.size = offset
+            self.remap()
+
+    def note(self, id, kind, offset, length):   # Point the index at a record just written or read from the log
+        old = self.index.get(id)
+        if old is not None:
+            self.garbage += HEADER.size + old[1]
+        if kind == KIND_TOMBSTONE:
+            self.index.pop(id, None)
+            self.garbage += HEADER.size
+        else:
+            self.index[id] = (offset, length, kind)
+
+    def append(self, records):          # Write a list of (ID, kind, data) records to the end of the log
+        write = self.file.write
+        offset = self.file.seek(0, 2)
+        for id, kind, data in records:
+            write(self.header(id, kind, len(data)))
+            write(data)
+            self.note(id, kind, offset + HEADER.size, len(data))
+            offset += HEADER.size + len(data)
+        self.file.flush()               # Into the OS before the node carries on.  A crash of the process can't lose it after this.
+        self.size = offset
+        if self.garbage > COMPACT_MIN and self.garbage > self.size - self.garbage:
+            self.compact()
+
+    def header(self, id, kind, length):
+        id = id.to_bytes(ID_BYTES, 'big')
+        return HEADER.pack(id, kind, length, zlib.crc32(HEADER.pack(id, kind, length, 0)[:-4]))
+
+    def encode(self, file_data):        # Returns (kind, bytes) for a value
+        if isinstance(file_data, (bytes, bytearray, memoryview)):
+            return KIND_BYTES, file_data
+        if isinstance(file_data, str):
+            return KIND_STR, file_data.encode()
+        return KIND_PICKLE, pickle.dumps(file_data)
+
+    def read(self, entry, copy=False):  # Returns the value an index entry points at.  Bytes come back as a view into the map unless <copy>.
+        offset, length, kind = entry
+        if self.map is None or offset + length > len(self.map):
+            self.remap()
+        view = memoryview(self.map)[offset:offset + length]
+        if kind == KIND_BYTES:
+            return bytes(view) if copy else view
+        if kind == KIND_STR:
+            return str(view, 'utf-8')
+        return pickle.loads(view)
+
+    def compact(self):                  # Rewrite the log with only the live records.  Replaces the file, so maps of the old one stay valid.
+        tmp = self.path + '.compact'
+        with open(tmp, 'wb') as out:
+            for id, (offset, length, kind) in list(self.index.range_items(0, 0)):
+                if self.map is None or offset + length > len(self.map):
+                    self.remap()
+                out.write(self.header(id, kind, length))
+                out.write(self.map[offset:offset + length])
+        self.reopen(tmp)
+
+    def reopen(self, path):             # Swap in the log at <path> and load it
+        os.replace(path, self.path)
+        self.file.close()
+        self.file = open(self.path, 'a+b')
+        self.index = RingStore()
+        self.garbage = 0
+        self.load()
+
+    def close(self):
+        self.file.close()
+        self.map = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, id):
+        return self.read(self.index[id])
+
+    def __setitem__(self, id, file_data):
+        kind, data = self.encode(file_data)
+        self.append([(id, kind, data)])
+
+    def __delitem__(self, id):
+        if id not in self.index:
+            raise KeyError(id)
+        self.append([(id, KIND_TOMBSTONE, b'')])
+
+    def get(self, id, default=None):
+        entry = self.index.get(id)
+        if entry is None:
+            return default
+        return self.read(entry)
+
+    def pop(self, id, *default):
+        entry = self.index.get(id)
+        if entry is None:
+            if len(default) > 0:
+                return default[0]
+            raise KeyError(id)
+        file_data = self.read(entry, copy=True)
+        self.append([(id, KIND_TOMBSTONE, b'')])
+        return file_data
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        return [self.read(entry, copy=True) for entry in list(self.index.values())]
+
+    def items(self):                    # Copies, since these are usually on their way to another node
+        return [(id, self.read(entry, copy=True)) for id, entry in list(self.index.items())]
+
+    def update(self, items):
+        if isinstance(items, dict):
+            items = items.items()
+        records = []
+        for id, file_data in items:
+            kind, data = self.encode(file_data)
+            records.append((id, kind, data))
+        self.append(records)
+
+    def clear(self):                    # Start a new, empty log
+        tmp = self.path + '.compact'
+        open(tmp, 'wb').close()
+        self.reopen(tmp)
+
+    def range_items(self, lb, ub):
+        for id, entry in self.index.range_items(lb, ub):
+            yield id, self.read(entry)
+
+    def pop_range(self, lb, ub):
+        entries = self.index.pop_range(lb, ub)
+        items = [(id, self.read(entry, copy=True)) for id, entry in entries]
+        for id, entry in entries:       # They're out of the index already, so count them as garbage here
+            self.garbage += HEADER.size + entry[1]
+        self.append([(id, KIND_TOMBSTONE, b'') for id, entry in entries])
+        return items
@@ -0,0 +1,310 @@
+from chord import ChordNode, Finger, Message, RingConfig, MSG_NAMES, LEAVE_NETWORK
+from sim import Simulator
+from client import Client, KINDS
+import codec
+import threading
+import pickle
+import random
+import struct
+import time
+import sys
+
+# Recording every message a ring's nodes handle, and playing it back.  (Not trace.py, which would hide the standard library's.)
+# start(path, config) turns tracing on for every ChordNode in the process.  Each node then writes a record to
+# the trace when it joins, when it is placed by build_ring(), and for every message it handles, stamped with the
+# engine's clock (or seconds since start() for threaded nodes).  Messages are packed with codec.py and records
+# are buffered and written in blocks, so a trace is compact and cheap to take.
+# A trace can be used two ways.  Replayer.replay() rebuilds the nodes and hands each of them exactly the
+# messages it handled, in the recorded order, with no threads and with everything they send thrown away.  A
+# node's state depends only on what it has handled, so the replayed ring goes through the same states as the
+# recorded one, however its threads were scheduled, and the time spent in each handler can be measured on
+# identical input.  Replayer.resimulate() takes only what came from outside the ring (joins, placements and
+# the requests clients sent) and runs it through a Simulator, so two configurations can be compared on exactly
+# the same traffic.  Maintenance rounds are recorded as the MAINTAIN messages that start them.  Nodes that
+# vanish without leaving are not recorded.
+
+MAGIC = b'CHTR'
+VERSION = 1
+HEADER = struct.Struct('>4sBI')     # Magic, version, length of the pickled RingConfig that follows
+RECORD = struct.Struct('>BdI')      # Kind, time, length of the body that follows
+BUFFER_SIZE = 256 * 1024            # Bytes of records buffered before they're written
+
+# Record kinds
+JOIN = 0        # Body: node ID.  The node ran join_network().
+PLACE = 1       # Body: node ID, predecessor, finger count, each finger's node, successor count, each successor.  The node was placed with its state already set.
+DELIVER = 2     # Body: receiving node's ID, then the message
+
+KIND_NAMES = ['JOIN', 'PLACE', 'DELIVER']
+
+
+class TraceWriter():
+
+    def __init__(self, path, config=None):
+        self.config = config or RingConfig()
+        self.width = codec.id_bytes(self.config)
+        self.file = open(path, 'wb')
+        data = pickle.dumps(self.config, pickle.HIGHEST_PROTOCOL)
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(data)) + data)
+        self.buffer = bytearray()
+        self.lock = threading.Lock()    # Threaded nodes all write here
+        self.start = time.perf_counter()
+        self.records = 0
+
+    def now(self, node):
+        if node.engine is not None:
+            return node.engine.now
+        return time.perf_counter() - self.start
+
+    def record(self, kind, t, body):   # <body> is a function that appends the record's body to a bytearray
+        with self.lock:
+            buf = self.buffer
+            start = len(buf)
+            buf += RECORD.pack(kind, t, 0)
+            body(buf)
+            RECORD.pack_into(buf, start, kind, t, len(buf) - start - RECORD.size)
+            self.records += 1
+            if len(buf) >= BUFFER_SIZE:
+                self.file.write(buf)
+                self.buffer = bytearray()
+
+    def join(self, node):
+        self.record(JOIN, self.now(node), lambda buf: codec.encode_key(buf, node.id, self.width))
+
+    def place(self, node):
+        def body(buf):
+            codec.encode_key(buf, node.id, self.width)
+            codec.encode_key(buf, node.predecessor, self.width)
+            buf += codec.U16.pack(len(node.finger_table))
+            for f in node.finger_table:
+                codec.encode_key(buf, f.node, self.width)
+            buf += codec.U16.pack(len(node.successors))
+            for s in node.successors:
+                codec.encode_key(buf, s, self.width)
+        self.record(PLACE, self.now(node), body)
+
+    def deliver(self, node, msg):       # Called before the node acts on <msg>, since handlers change the messages they pass on
+        def body(buf):
+            codec.encode_key(buf, node.id, self.width)
+            codec.encode_into(buf, msg, self.width)
+        self.record(DELIVER, self.now(node), body)
+
+    def close(self):
+        with self.lock:
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+            self.file.close()
+
+
+def start(path, config=None):           # Trace every ChordNode in this process from now on.  Returns the writer.
+    ChordNode.trace = TraceWriter(path, config)
+    return ChordNode.trace
+
+
+def stop():
+    if ChordNode.trace is not None:
+        ChordNode.trace.close()
+        ChordNode.trace = None
+
+
+def read(path):                         # Returns (config, list of (kind, time, node ID, payload)).  The payload is a message for DELIVER, and (predecessor, finger nodes, successors) for PLACE.
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, size = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(path + ' is not a trace')
+    if version != VERSION:
+        raise ValueError('Unknown trace version ' + str(version))
+    pos = HEADER.size
+    config = pickle.loads(data[pos:pos + size])
+    width = codec.id_bytes(config)
+    pos += size
+    view = memoryview(data)
+    records = []
+    while pos + RECORD.size <= len(data):
+        kind, t, size = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        end = pos + size
+        if end > len(data):             # Cut short.  The writer didn't get to close().
+            break
+        id, p = codec.decode_value(view, pos, width, True)
+        if kind == DELIVER:
+            payload = codec.decode_from(view, p)[0]
+        elif kind == PLACE:
+            pred, p = codec.decode_value(view, p, width, True)
+            count = codec.U16.unpack_from(data, p)[0]
+            p += 2
+            fingers = []
+            for i in range(0, count):
+                node, p = codec.decode_value(view, p, width, True)
+                fingers.append(node)
+            successors = []
+            if p < end:                 # Traces from before successor lists don't have them
+                count = codec.U16.unpack_from(data, p)[0]
+                p += 2
+                for i in range(0, count):
+                    node, p = codec.decode_value(view, p, width, True)
+                    successors.append(node)
+            payload = (pred, fingers, successors)
+        else:
+            payload = None
+        records.append((kind, t, id, payload))
+        pos = end
+    return config, records
+
+
+def create(engine, id, payload):        # Make a node on <engine> from a JOIN (<payload> None) or PLACE record
+    node = ChordNode(engine.queues, engine=engine, config=engine.config, id=id)
+    node.trace = None                   # Don't record the replay, if this process happens to be tracing
+    if payload is None:
+        node.join_network()
+        return node
+    pred, fingers, successors = payload
+    node.queues[id] = node.new_queue()
+    node.hash_table = node.new_store()
+    node.predecessor = pred
+    node.successors = successors
+    for k in range(0, len(fingers)):
+        node.finger_table.append(Finger((id + 2**k) % node.ring_size, fingers[k]))
+    node.joined = True
+    return node
+
+
+# Takes the place of a queue during replay.  Everything put on it is counted and dropped.
+class Sink():
+
+    def __init__(self):
+        self.sent = 0
+
+    def put(self, msg):
+        self.sent += 1
+
+    def qsize(self):
+        return 0
+
+
+# The queues dictionary during replay.  Client names always resolve, to the sink, since clients aren't part of a trace.
+class ReplayQueues(dict):
+
+    def __init__(self, sink):
+        dict.__init__(self)
+        self.sink = sink
+
+    def __missing__(self, key):
+        if isinstance(key, str):
+            return self.sink
+        raise KeyError(key)
+
+
+class Replayer():
+
+    def __init__(self, path, config=None, seed=0):
+        self.config, self.records = read(path)
+        if config is not None:          # Replaying under different settings.  Only things that don't change what gets sent make sense here.
+            self.config = config
+        self.config.storage_dir = None  # Never touch the recorded run's data
+        self.rng = random.Random(seed)
+        self.sink = Sink()
+        self.queues = ReplayQueues(self.sink)
+        self.nodes = {}
+        self.now = 0
+        self.handled = [0] * len(MSG_NAMES)     # Messages replayed, by type
+        self.seconds = [0.0] * len(MSG_NAMES)   # Time spent in their handlers, by type
+        self.missing = 0                        # Deliveries to nodes the trace never created
+
+    # The engine interface nodes expect
+    def attach(self, node):
+        self.nodes[node.id] = node
+        return self.sink
+
+    def listen(self, name, handler):
+        self.queues[name] = self.sink
+        return self.sink
+
+    def replay(self):                   # Hand every recorded message to its node, in order.  Returns the nodes by ID.
+        timer = time.perf_counter
+        for kind, t, id, payload in self.records:
+            self.now = t
+            if kind != DELIVER:
+                create(self, id, payload)
+                continue
+            node = self.nodes.get(id)
+            if node is None or not node.active:
+                self.missing += 1
+                continue
+            start = timer()
+            node.handle(payload)
+            if node.update_required and node.active:    # The threaded loop and step() both do this before the next message
+                node.ask_for_fingers()
+            self.seconds[payload.type] += timer() - start
+            self.handled[payload.type] += 1
+        return self.nodes
+
+    def resimulate(self, config=None, latency=None, seed=0):   # Run just the outside traffic through a Simulator.  Returns the Simulator and the client standing in for the recorded ones.
+        sim = Simulator(seed=seed, config=config or self.config, latency=latency if latency is not None else 1)
+        client = Client(sim.queues, engine=sim, window=2**31)  # Requests go out when they did before, not when a window allows
+        seen = set()                    # (requester, request ID) of the requests already sent.  Nodes pass some requests on unchanged.
+        for kind, t, id, payload in self.records:
+            sim.run(until=t)
+            sim.now = max(sim.now, t)
+            if kind != DELIVER:
+                create(sim, id, payload)
+            elif not isinstance(payload.sender_id, str) or id not in sim.queues:
+                continue                # Traffic between nodes.  The simulation makes its own.
+            elif payload.type == LEAVE_NETWORK:
+                sim.schedule(sim.queues[id], payload, t)
+            elif payload.type in KINDS and (payload.requester, payload.request_id) not in seen:     # A client's request, sent through the same entry node
+                seen.add((payload.requester, payload.request_id))
+                client.entry = id
+                expected = len(payload.items) if payload.items is not None else 1
+                client.submit(Message(payload.type, client.name, file_id=payload.file_id), expected, payload.file_name, payload.file_data, payload.items)
+        sim.run()
+        return sim, client
+
+
+# Main
+# Usage: python tracelog.py record <file> [nodes] [requests] [seed]
+#        python tracelog.py replay <file>
+#        python tracelog.py resim <file> [iterative|recursive]
+# record runs a seeded simulation with churn and traces it.  replay plays it back and times each handler.
+# resim runs the same outside traffic again, optionally with the other lookup strategy, and counts messages.
+if __name__ == '__main__':
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'record'
+    path = sys.argv[2] if len(sys.argv) > 2 else 'chord.trace'
+    if cmd == 'record':
+        n = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+        count = int(sys.argv[4]) if len(sys.argv) > 4 else 2000
+        seed = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        config = RingConfig(hash_bits=32)
+        writer = start(path, config)
+        sim = Simulator(seed=seed, config=config)
+        nodes = sim.build_ring(n)
+        client = Client(sim.queues, engine=sim, window=32)
+        for i in range(0, count):
+            client.set('key' + str(i), i)
+            if i % (count // 10 + 1) == 0:  # Some nodes join along the way
+                sim.add_node()
+        sim.run()
+        for i in range(0, 3):               # And some leave
+            leaving = nodes.pop(sim.rng.randrange(len(nodes)))
+            sim.queues[leaving.id].put(Message(LEAVE_NETWORK, 'root'))
+            sim.run()
+        gets = [client.get('key' + str(i)) for i in range(0, count)]
+        sim.run()
+        stop()
+        correct = sum(1 for i in range(0, count) if gets[i].result() == i)
+        print('Recorded ' + str(writer.records) + ' records to ' + path + '  Correct: ' + str(correct) + '/' + str(count))
+    elif cmd == 'replay':
+        replayer = Replayer(path)
+        start_time = time.time()
+        nodes = replayer.replay()
+        print('Replayed ' + str(sum(replayer.handled)) + ' messages to ' + str(len(nodes)) + ' nodes in ' + str(round(time.time() - start_time, 3)) + 's')
+        for t in range(0, len(MSG_NAMES)):
+            if replayer.handled[t] > 0:
+                print(MSG_NAMES[t].ljust(20) + str(replayer.handled[t]).rjust(8) + str(round(replayer.seconds[t] / replayer.handled[t] * 1e6, 2)).rjust(10) + ' us each')
+    else:
+        replayer = Replayer(path)
+        config = replayer.config
+        if len(sys.argv) > 3:
+            config = RingConfig(hash_bits=config.hash_bits, recursive_lookup=sys.argv[3] == 'recursive')
+        sim, client = replayer.resimulate(config)
+        print('Outside requests: ' + str(client.completed) + ' answered  Delivered: ' + str(sim.delivered) + '  Virtual time: ' + str(sim.now))
@@ -0,0 +1,343 @@
+from chord import ChordNode, RingConfig
+from client import Client
+import codec
+import multiprocessing
+import threading
+import socket
+import struct
+import time
+import sys
+
+# Sends messages between processes over TCP on localhost.
+# A SocketTransport takes the place of the queues dictionary.  Nodes and clients in this process store their
+# own queue.Queue in it as usual; that registers the queue locally and publishes this process's address under
+# the same key in a shared directory (a dict, or a multiprocessing Manager dict when there are several
+# processes).  Looking up any other key gives an endpoint whose put() frames the message and hands it to a
+# PeerConnection, one persistent connection per peer process.  Messages are packed with codec.py straight into
+# the connection's output buffer, and a writer thread sends everything packed since its last write in a single
+# sendall(), so a burst of messages to the same peer costs one syscall and no extra copies.  Each process
+# listens on one port and passes arriving messages to the right local queue.
+# Addresses looked up in the directory are cached, since a Manager dict costs a round trip to the manager process
+# per lookup.  When a key is deleted, its process tells every other process in the directory, and they drop it
+# from their caches.  A connection that fails drops every key cached at that address, so the next lookup goes back
+# to the directory.
+
+HOST = '127.0.0.1'
+FRAME = struct.Struct('>I')     # Every frame starts with the length of what follows
+GONE = 0                        # First byte of a frame announcing that the key after it has left its process.  A message's first byte is codec.VERSION.
+RECV_SIZE = 256 * 1024
+
+
+def encode_into(buf, key, msg, width):  # Appends a frame carrying <msg> for the queue stored under <key> to the bytearray <buf>
+    start = len(buf)
+    buf += FRAME.pack(0)
+    codec.encode_into(buf, msg, width)
+    codec.encode_key(buf, key, width)
+    FRAME.pack_into(buf, start, len(buf) - start - FRAME.size)
+    return buf
+
+
+def encode_gone(buf, key, width):   # Appends a frame announcing that <key> has gone to the bytearray <buf>
+    start = len(buf)
+    buf += FRAME.pack(0)
+    buf.append(GONE)
+    codec.encode_key(buf, key, width)
+    FRAME.pack_into(buf, start, len(buf) - start - FRAME.size)
+    return buf
+
+
+def decode(data, width):        # Returns (key, msg) from the body of a frame
+    msg, pos = codec.decode_from(data)
+    return codec.decode_value(data, pos, width, True)[0], msg
+
+
+# What a lookup of a remote key returns.  Looks like a queue to the node putting messages on it.
+class Endpoint():
+
+    __slots__ = ('peer', 'key')
+
+    def __init__(self, peer, key):
+        self.peer = peer        # The connection to the process the key lives in
+        self.key = key          # The key at the other end
+
+    def put(self, msg):
+        self.peer.send(self.key, msg)
+
+    def qsize(self):            # The mailbox is in another process.  Nothing to go on.
+        return 0
+
+
+# A persistent connection to one peer process, with a writer thread that coalesces frames
+class PeerConnection():
+
+    def __init__(self, address, width, on_failure=None):
+        self.address = address      # (host, port) of the peer's listener
+        self.width = width          # Bytes per ring ID on the wire
+        self.on_failure = on_failure    # Called with the address when a connect or write fails
+        self.sock = None            # Connected by the writer thread on the first send
+        self.buffer = bytearray()   # Frames waiting for the next write, already packed
+        self.frames = 0             # How many
+        self.cond = threading.Condition()
+        self.closed = False
+        self.sent = 0               # Frames written
+        self.writes = 0             # sendall() calls it took
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def send(self, key, msg):
+        with self.cond:
+            encode_into(self.buffer, key, msg, self.width)
+            self.frames += 1
+            if self.frames == 1:
+                self.cond.notify()
+
+    def send_gone(self, key):       # Tell the peer <key> has gone, after anything already sent to it
+        with self.cond:
+            encode_gone(self.buffer, key, self.width)
+            self.frames += 1
+            if self.frames == 1:
+                self.cond.notify()
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                while self.frames == 0 and not self.closed:
+                    self.cond.wait()
+                if self.frames == 0:
+                    return
+                data = self.buffer
+                frames = self.frames
+                self.buffer = bytearray()
+                self.frames = 0
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(self.address)
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)    # Coalescing is done here, don't let Nagle add a delay too
+                self.sock.sendall(data)
+            except OSError:         # The peer has gone.  So have these messages, like a put on a queue nobody reads.
+                self.sock = None
+                if self.on_failure is not None:
+                    self.on_failure(self.address)
+                continue
+            self.sent += frames
+            self.writes += 1
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+class SocketTransport():
+
+    def __init__(self, directory=None, host=HOST, config=None):
+        self.directory = {} if directory is None else directory     # Key -> (host, port) of the process holding its queue.  Shared by every process in the ring.
+        self.width = codec.id_bytes(config)     # Bytes per ring ID on the wire.  Every process in the ring must agree.
+        self.local = {}             # Queues held in this process, by key
+        self.peers = {}             # PeerConnections, by address
+        self.endpoints = {}         # Endpoints handed out, by key
+        self.cache = {}             # Key -> address, for keys in other processes looked up so far
+        self.forgotten = 0          # Cache entries dropped so far
+        self.lock = threading.Lock()    # Guards peers, endpoints, cache and forgotten.  GONE frames and failed connections change them from other threads.
+        self.dropped = 0            # Messages that arrived for a key no longer held here
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, 0))
+        self.server.listen(128)
+        self.address = self.server.getsockname()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    # The parts of the dictionary interface the nodes and clients use
+    def __setitem__(self, key, q):
+        self.local[key] = q
+        self.directory[key] = self.address
+
+    def __getitem__(self, key):
+        q = self.local.get(key)
+        if q is not None:
+            return q
+        with self.lock:
+            endpoint = self.endpoints.get(key)
+            forgotten = self.forgotten
+        if endpoint is None:
+            address = self.lookup(key)
+            if address is None:
+                raise KeyError(key)
+            endpoint = self.endpoint(key, address, forgotten)
+        return endpoint
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __delitem__(self, key):
+        del self.directory[key]
+        self.local.pop(key, None)
+        self.forget(key)
+        for address in set(tuple(a) for a in self.directory.values()):    # Every other process may have it cached
+            if address != self.address:
+                self.peer(address).send_gone(key)
+
+    def __contains__(self, key):
+        return key in self.local or self.lookup(key) is not None
+
+    def keys(self):
+        return list(self.directory.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.directory)
+
+    def lookup(self, key):          # The address of the process holding <key>, from the cache if it's there, or None if nobody has it
+        with self.lock:
+            address = self.cache.get(key)
+            forgotten = self.forgotten
+        if address is None:
+            address = self.directory.get(key)   # Outside the lock.  It's a round trip to the manager process.
+            if address is None:     # Not cached when missing.  It may be joining.
+                return None
+            address = tuple(address)
+            with self.lock:
+                if forgotten == self.forgotten:     # Unless something was forgotten meanwhile.  It may have been this.
+                    self.cache[key] = address
+        return address
+
+    def forget(self, key):          # Drop <key> from the cache.  The next lookup asks the directory.
+        with self.lock:
+            self.forgotten += 1
+            self.cache.pop(key, None)
+            self.endpoints.pop(key, None)
+
+    def failed(self, address):      # A connection to <address> failed.  Whatever was cached there may have gone.
+        with self.lock:
+            keys = [key for key, a in self.cache.items() if a == address]
+        for key in keys:
+            self.forget(key)
+
+    def peer(self, address):        # The connection to the process at <address>
+        address = tuple(address)
+        with self.lock:
+            peer = self.peers.get(address)
+            if peer is None:
+                peer = self.peers[address] = PeerConnection(address, self.width, self.failed)
+        return peer
+
+    def endpoint(self, key, address, forgotten):    # An endpoint for <key> at <address>.  Kept for next time if nothing was forgotten since <forgotten> was read.
+        endpoint = Endpoint(self.peer(address), key)
+        with self.lock:
+            if forgotten == self.forgotten:     # Otherwise <key> may have gone after it was looked up.  Don't hand this one out again.
+                self.endpoints[key] = endpoint
+        return endpoint
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, addr = self.server.accept()
+            except OSError:         # Closed
+                return
+            threading.Thread(target=self.read_loop, args=(sock,), daemon=True).start()
+
+    def read_loop(self, sock):      # Split what arrives into frames and pass each message to its queue
+        buf = bytearray()
+        while True:
+            try:
+                data = sock.recv(RECV_SIZE)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            pos = 0
+            while len(buf) - pos >= FRAME.size:
+                size = FRAME.unpack_from(buf, pos)[0]
+                end = pos + FRAME.size + size
+                if end > len(buf):
+                    break
+                if buf[pos + FRAME.size] == GONE:   # Another process's key has gone
+                    self.forget(codec.decode_value(memoryview(buf)[pos + FRAME.size + 1:end], 0, self.width, True)[0])
+                    pos = end
+                    continue
+                key, msg = decode(memoryview(buf)[pos + FRAME.size:end], self.width)
+                q = self.local.get(key)
+                if q is None:
+                    self.dropped += 1
+                else:
+                    q.put(msg)
+                pos = end
+            del buf[:pos]
+
+    def stats(self):                # Frames sent and the writes it took, over every peer connection
+        return {'sent': sum(p.sent for p in self.peers.values()), 'writes': sum(p.writes for p in self.peers.values()), 'dropped': self.dropped}
+
+    def close(self):
+        self.server.close()
+        for peer in self.peers.values():
+            peer.close()
+
+
+def host(conn, directory, config):  # Body of each process in the demo.  Joins nodes when told to, all at once, and answers once they're in.
+    transport = SocketTransport(directory, config=config)
+    nodes = []
+    while True:
+        cmd = conn.recv()
+        if cmd[0] == 'join':
+            joining = [ChordNode(transport, config=config) for i in range(0, cmd[1])]
+            for node in joining:
+                node.start()
+            while not all(node.joined for node in joining):
+                time.sleep(0.01)
+            nodes.extend(joining)
+            conn.send([node.id for node in joining])
+        elif cmd[0] == 'stats':
+            conn.send(transport.stats())
+        else:
+            conn.send(None)
+            return
+
+
+# Main
+# Usage: python transport.py [processes] [nodes per process] [requests]
+# Starts a ring spread over several processes talking over localhost sockets, then times a client against it.
+if __name__ == '__main__':
+    procs = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    per = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    config = RingConfig(hash_bits=32)
+    manager = multiprocessing.Manager()
+    directory = manager.dict()
+    conns = []
+    for i in range(0, procs):
+        conn, child = multiprocessing.Pipe()
+        multiprocessing.Process(target=host, args=(child, directory, config), daemon=True).start()
+        conns.append(conn)
+    conns[0].send(('join', 1))      # One node starts the ring.  Every other node joins at once.
+    conns[0].recv()
+    for i in range(0, procs):
+        conns[i].send(('join', per - 1 if i == 0 else per))
+    for conn in conns:
+        conn.recv()
+    transport = SocketTransport(directory, config=config)
+    client = Client(transport, window=128, config=config)
+    start = time.time()
+    futures = [client.set('key' + str(i), i) for i in range(0, count)]
+    for f in futures:
+        f.result(timeout=30)
+    futures = [client.get('key' + str(i)) for i in range(0, count)]
+    correct = sum(1 for i in range(0, count) if futures[i].result(timeout=30) == i)
+    elapsed = time.time() - start
+    keys = client.broadcast('keys').result(timeout=30)     # Counted by every node, added up on the way back
+    sent = 0
+    writes = 0
+    for conn in conns:
+        conn.send(('stats',))
+        stats = conn.recv()
+        sent += stats['sent']
+        writes += stats['writes']
+        conn.send(('stop',))
+        conn.recv()
+    print('---------------------------------------------------')
+    print('Nodes: ' + str(procs * per) + ' in ' + str(procs) + ' processes  Requests: ' + str(2 * count) + '  Correct: ' + str(correct) +
+          '  Time: ' + str(round(elapsed, 2)) + 's  Frames: ' + str(sent) + ' in ' + str(writes) + ' writes  Keys in the ring: ' + str(keys))
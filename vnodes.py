@@ -0,0 +1,183 @@
+from chord import ChordNode, Message, RingConfig, LEAVE_NETWORK, MAINTAIN
+import chord
+import threading
+import itertools
+import queue
+import random
+import time
+import sys
+
+# Virtual nodes: one physical node holding several IDs on the identifier circle.
+# With one random ID per node, the arcs between neighbours vary a lot in length, so a few nodes own several times
+# their share of the keys and take several times their share of the requests.  A Host runs a ChordNode for each
+# of its virtual IDs, each with its own finger table, predecessor and partition, behind one mailbox and, when
+# threaded, one thread.  Each virtual node's entry in the queues dictionary is a VirtualQueue, which tags every
+# message with the virtual node's ID and puts it in the host's mailbox, so the rest of the ring can't tell the
+# difference.  The host is the engine its virtual nodes run on, so they join and handle messages through step(),
+# like simulated nodes, whether the host has a thread of its own or is driven by a Simulator or AsyncRuntime.
+# The more virtual IDs each host has, the more evenly the keys spread.  rebalance() evens out what's left by
+# splitting the busiest host's largest partition at its median key, with a new virtual node for the least busy
+# host.  Each virtual node keeps its own store, since handoffs move a partition's whole contents by range.
+
+HOST_NAMES = itertools.count()  # Numbers the hosts' mailboxes in the queues dictionary
+
+
+# A virtual node's entry in the queues dictionary.  Messages put on it go in its host's mailbox.
+class VirtualQueue():
+
+    __slots__ = ('inbox', 'id')
+
+    def __init__(self, inbox, id):
+        self.inbox = inbox      # The host's mailbox
+        self.id = id            # The virtual node's ID
+
+    def put(self, msg):
+        self.inbox.put((self.id, msg))
+
+    def qsize(self):            # Messages waiting for any of the host's virtual nodes.  They all wait in the same line.
+        return self.inbox.qsize()
+
+
+class Host(threading.Thread):
+
+    def __init__(self, queues, engine=None, config=None):
+        threading.Thread.__init__(self)
+        self.queues = queues                # Shared with the rest of the ring
+        self.engine = engine                # The engine delivering to this host's mailbox, or None if the host runs as its own thread
+        self.config = config or (engine.config if engine else RingConfig())
+        self.rng = engine.rng if engine else random     # The virtual nodes draw their IDs from this
+        self.key = 'host' + str(next(HOST_NAMES))       # The mailbox's name.  A string, so clients don't mistake it for a node.
+        self.vnodes = {}                    # Every virtual node this host has run, by ID
+        self.dropped = 0                    # Messages for virtual nodes that had left by the time they were read
+        self.leaving = False                # Set while the virtual nodes leave one after another
+        self.active = True                  # Cleared to stop the thread
+        if engine is None:
+            self.inbox = queue.Queue()
+        else:
+            self.inbox = engine.listen(self.key, self.deliver)
+
+    @property
+    def now(self):                          # Traces stamp the virtual nodes' records with this
+        if self.engine is not None:
+            return self.engine.now
+        return time.perf_counter()
+
+    def attach(self, node):                 # Called by ChordNode.new_queue() once a virtual node has its ID
+        self.vnodes[node.id] = node
+        if self.engine is not None:
+            self.engine.nodes[node.id] = node
+            self.engine.start_rounds(node)  # The engine's timers drive its maintenance rounds.  Threaded hosts run them in run().
+        return VirtualQueue(self.inbox, node.id)
+
+    def listen(self, name, handler):        # Clients don't run on hosts.  Give them the engine's own mailbox.
+        return self.engine.listen(name, handler)
+
+    def deliver(self, item):                # Hand a message from the mailbox to the virtual node it was sent to
+        id, msg = item
+        node = self.vnodes.get(id)
+        if node is None or not node.active:
+            self.dropped += 1
+            return
+        node.step(msg)
+        if self.leaving and not node.active:    # That one has gone.  Send the next one off.
+            self.leave()
+
+    def run(self):                          # Threaded hosts read their mailbox here
+        interval = self.config.stabilize_interval
+        next_round = time.perf_counter() + (interval * self.rng.random() if interval is not None else 0)
+        while chord.running and self.active:
+            if interval is not None and time.perf_counter() >= next_round:     # Every virtual node gets a maintenance round, including any still joining
+                next_round = time.perf_counter() + interval
+                for node in [node for node in self.vnodes.values() if node.active]:
+                    self.deliver((node.id, Message(MAINTAIN, node.id)))
+            try:
+                item = self.inbox.get(timeout=chord.TIMEOUT if interval is None else max(0, next_round - time.perf_counter()))
+            except queue.Empty:
+                if interval is None:        # Nothing heard for a while.  Virtual nodes still joining or leaving treat the timeout as a round, and may try again.
+                    for node in [node for node in self.vnodes.values() if node.active and (not node.joined or node.leaving)]:
+                        self.deliver((node.id, Message(MAINTAIN, node.id)))
+                continue
+            self.deliver(item)
+
+    def add(self, id=None):                 # Join a new virtual node, at <id> or at random.  It finishes joining as messages arrive.
+        node = ChordNode(self.queues, engine=self, config=self.config, id=id)
+        node.join_network()
+        return node
+
+    def remove(self, id):                   # The virtual node <id> leaves, handing its keys on as usual
+        self.queues[id].put(Message(LEAVE_NETWORK, self.key))
+
+    def leave(self):                        # Every virtual node leaves, one at a time.  Each goes once the last has handed on its keys,
+        self.leaving = True                 # so its neighbours' notices reach a sibling through this mailbox before that sibling leaves too.
+        live = self.live()
+        if len(live) > 0:
+            self.remove(live[0].id)
+        else:
+            self.active = False             # Nothing left to run
+
+    def crash(self):                        # Every virtual node vanishes without leaving
+        for node in [node for node in self.vnodes.values() if node.active and self.queues.get(node.id) is not None]:
+            node.active = False
+            del self.queues[node.id]
+
+    def live(self):                         # Virtual nodes that have joined and haven't started leaving
+        return [node for node in self.vnodes.values() if node.active and node.joined and not node.leaving and self.queues.get(node.id) is not None]
+
+    def keys(self):                         # Keys held across all the virtual nodes
+        return sum(len(node.hash_table) for node in self.live())
+
+    def handled(self):                      # Messages handled across all the virtual nodes, including ones that have left
+        return sum(node.metrics.total() for node in self.vnodes.values())
+
+
+def imbalance(loads):                       # The largest load over the mean.  1.0 is perfectly even.
+    if len(loads) == 0 or sum(loads) == 0:
+        return 1.0
+    return max(loads) * len(loads) / float(sum(loads))
+
+
+def rebalance(hosts, cap, settle=None, limit=None):     # Split partitions until no host holds more than <cap> times the mean number of keys.  Returns the number of splits.
+    hosts = [h for h in hosts if len(h.live()) > 0]
+    if limit is None:
+        limit = 4 * len(hosts)
+    moves = 0
+    while moves < limit:
+        loads = [h.keys() for h in hosts]
+        if imbalance(loads) <= cap:
+            break
+        heavy = hosts[loads.index(max(loads))]
+        light = hosts[loads.index(min(loads))]
+        node = max(heavy.live(), key=lambda n: len(n.hash_table))
+        ids = [id for id, file_data in node.hash_table.range_items(node.predecessor, node.id)]
+        if heavy is light or len(ids) < 2 or ids[len(ids) // 2 - 1] in heavy.queues:
+            break
+        light.add(ids[len(ids) // 2 - 1])   # The new node owns (predecessor, median], so it takes half the keys
+        if settle is not None:
+            settle()
+        moves += 1
+    return moves
+
+
+# Main
+# Usage: python vnodes.py [hosts] [virtual nodes per host] [keys]
+# Builds simulated rings of hosts with one virtual node each and with several, loads the same keys into both,
+# and prints how unevenly the keys are spread, then rebalances the second ring.
+if __name__ == '__main__':
+    from sim import Simulator
+    from client import Client
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    keys = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    for v in (1, count):
+        sim = Simulator(seed=1, config=RingConfig(hash_bits=32))
+        hosts = sim.build_hosts(n, v)
+        client = Client(sim.queues, engine=sim, window=256)
+        for start in range(0, keys, 256):
+            client.multi_set(dict(('key' + str(i), i) for i in range(start, min(start + 256, keys))))
+        sim.run()
+        loads = [h.keys() for h in hosts]
+        print(str(n) + ' hosts x ' + str(v) + ' virtual nodes:  most keys on a host ' + str(max(loads)) + ', fewest ' + str(min(loads)) +
+              ', imbalance ' + str(round(imbalance(loads), 2)))
+    moves = rebalance(hosts, 1.25, sim.run)
+    loads = [h.keys() for h in hosts]
+    print('After ' + str(moves) + ' splits:  most keys on a host ' + str(max(loads)) + ', fewest ' + str(min(loads)) + ', imbalance ' + str(round(imbalance(loads), 2)))